@@ -78,6 +78,13 @@ Preprocessor Syntax
 - The expression after #if/elif may be a Python statement. It is an
   error to refer to a variable that has not been defined by a -D
   option or by an in-content #define.
+- With --safe, <expr> is evaluated without eval() and may only use
+  names, number and string literals, tuples, lists, comparisons,
+  and, or, not and defined().
+- With -s, defines are substituted wherever their names occur in
+  emitted lines. With --markers as well, only markers such as ${NAME}
+  are substituted, with markers for each content type set in
+  content-types.yaml; markers of undefined names are left as they are.
 - Special built-in methods for expressions:
     defined(varName)    Return true if given variable is defined.
 
@@ -87,21 +94,45 @@ import logging
 __version_info__ = (1, 1, 0)
 __version__ = '.'.join(map(str, __version_info__))
 
+import __builtin__
+import bisect
+import codecs
+import cPickle as pickle
+import hashlib
+import multiprocessing
 import os
+import shutil
+import stat
 import sys
+import tempfile
 import types
 import re
+from collections import namedtuple
 # We don't use cStringIO because it may have issues with writing UTF-8 encoded files.
 # http://mail.python.org/pipermail/python-list/2007-June/1097078.html
 from StringIO import StringIO
 from pkg_resources import resource_filename
 from pathtools.path import absolute_path
 
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional and only used by the ``numpy`` engine.
+    numpy = None
+
 try:
     from pepe.content_types import ContentTypesDatabase
+    from pepe.caching import DiskCache, LRUCache
+    from pepe.environment import DefineEnvironment
+    from pepe.expressions import analyze_expression, get_expression_names, \
+        get_result_names, compile_safe_expression
 # TODO: Remove this later.
 except ImportError:
     from content_types import ContentTypesDatabase
+    from caching import DiskCache, LRUCache
+    from environment import DefineEnvironment
+    from expressions import analyze_expression, get_expression_names, \
+        get_result_names, compile_safe_expression
 
 
 DEFAULT_CONTENT_TYPES_FILE = resource_filename(__name__, "content-types.yaml")
@@ -119,6 +150,41 @@ PREPROCESSOR_STATEMENT_REGEXP_PATTERNS = [
     r'#\s*(?P<op>include)\s+(?P<var>[^\s]+?)',
 ]
 
+# Compiled statement matchers keyed by frozen comment groups. Shared by
+# all preprocess() calls in the process including those for #include'd
+# files.
+statement_matcher_cache = LRUCache(maxsize=64)
+
+# Parsed templates keyed by path, modification time, size and comment
+# groups of their files. Used by the ``template`` engine.
+template_cache = LRUCache(maxsize=256)
+
+# Expansions of #include'd files, used with
+# ``options.should_memoize_includes``. This is library-only API: a single
+# run #includes a file at most once (a repeated #include is an error), so
+# entries are only reused by later preprocess() calls in the process.
+include_cache = LRUCache(maxsize=128)
+
+# Compiled #if, #elif and #define expressions keyed by expression. Shared
+# by all preprocess() calls in the process.
+expression_cache = LRUCache(maxsize=1024)
+
+# Results of #if and #elif expressions keyed by the expression and the
+# values of the names it reads.
+expression_result_cache = LRUCache(maxsize=4096)
+
+# Values of #define statements that needed evaluation, keyed by the text
+# of the value.
+define_value_cache = LRUCache(maxsize=1024)
+
+# Tables of define names for substitution keyed by the set of names.
+substitution_table_cache = LRUCache(maxsize=16)
+
+# On-disk template caches keyed by directory and size limit.
+_disk_caches = {}
+
+DEFAULT_CACHE_SIZE_LIMIT = 64 # megabytes
+
 
 class PreprocessorError(Exception):
     def __init__(self, error_message, filename=None, line_number=None,
@@ -131,327 +197,4402 @@ class PreprocessorError(Exception):
 
     def __str__(self):
         """
-        Usage:
+        Usage:
+
+            >>> assert str(PreprocessorError("whatever", filename="somefile.py", line_number=20, line="blahblah")) == "somefile.py:20: whatever"
+            >>> assert str(PreprocessorError("whatever", line_number=20, line="blahblah")) == "20: whatever"
+            >>> assert str(PreprocessorError("whatever", filename="somefile.py", line="blahblah")) == "somefile.py: whatever"
+            >>> assert str(PreprocessorError("whatever", line="blahblah")) == "whatever"
+        """
+        s = ":".join([str(f) for f in [self.filename, self.line_number] if f])
+        if s:
+            s += ": "
+        s += self.error_message
+        return s
+
+
+# A compiled expression. ``code`` is ``None`` if the expression does not
+# compile and ``names`` are the names from ``get_result_names()``.
+# ``function`` is the function from ``compile_safe_expression()`` or
+# ``None``, and ``reads_builtins`` is ``True`` if the expression reads
+# built-ins that ``function`` cannot find.
+CompiledExpression = namedtuple("CompiledExpression", ["code", "names",
+                                                       "function",
+                                                       "reads_builtins"])
+
+
+def get_compiled_expression(expression):
+    """
+    Returns the ``CompiledExpression`` of an #if, #elif or #define
+    expression, reusing the one in ``expression_cache`` if available.
+
+    Usage::
+
+        >>> e = get_compiled_expression("A > 1 and defined('B')")
+        >>> eval(e.code, {'defined': lambda v: False}, {'A': 2})
+        False
+        >>> e.names
+        ('A', 'B', 'defined')
+        >>> e.function({'A': 2, 'B': 0})
+        True
+        >>> get_compiled_expression("A >").code is None
+        True
+        >>> get_compiled_expression("len(A)").function is None
+        True
+    """
+    compiled = expression_cache.get(expression)
+    if compiled is None:
+        try:
+            # eval() ignores leading spaces and tabs but compile() does not.
+            code = compile(expression.lstrip(" \t"), "<string>", "eval")
+        except Exception:
+            code = None
+        function = None
+        reads_builtins = False
+        if code is not None:
+            safe_expression = compile_safe_expression(expression)
+            if safe_expression is not None:
+                function = safe_expression.function
+                for name in safe_expression.names:
+                    if (name not in ('True', 'False', 'None')
+                        and hasattr(__builtin__, name)):
+                        reads_builtins = True
+        compiled = CompiledExpression(code, get_result_names(expression),
+                                      function, reads_builtins)
+        expression_cache[expression] = compiled
+    return compiled
+
+
+# Types of define values that are equal only if expressions behave the same
+# for them. Floats are left out because 0.0 == -0.0.
+_MEMOIZABLE_TYPES = (types.NoneType, bool, int, long, str, unicode)
+
+
+def _get_expression_result_key(expression, names, defines):
+    """
+    Returns the key of the result of an expression in
+    ``expression_result_cache`` or ``None`` if a name it reads has a value
+    that cannot be part of the key.
+    """
+    key = [expression]
+    for name in names:
+        value = defines.get(name, _missing)
+        if value is not _missing and type(value) not in _MEMOIZABLE_TYPES:
+            return None
+        key.append(type(value))
+        key.append(value)
+    return tuple(key)
+
+
+# The dictionary of defines of the last evaluation and the globals for it.
+_evaluation_globals = [None, None]
+
+
+def _get_evaluation_globals(defines):
+    if _evaluation_globals[0] is not defines:
+        _evaluation_globals[:] = [defines, {'defined': (lambda v: v in defines)}]
+    return _evaluation_globals[1]
+
+
+def _evaluate(expression, defines, compiled=None, safe=False):
+    """Evaluate the given expression string with the given context.
+
+    ``defines`` is a dictionary or another mapping of defines, such as a
+    ``DefineEnvironment``. ``compiled`` is the ``CompiledExpression`` of
+    the expression, if available. Results of expressions whose names have simple values are
+    reused from ``expression_result_cache``.
+
+    Expressions made of names, literals, comparisons, boolean operators
+    and ``defined()`` are evaluated without eval() by the function from
+    ``compile_safe_expression()``. With ``safe``, other expressions are an
+    error and names are only looked up in the defines.
+
+    .. WARNING:
+        Without ``safe``, other expressions are passed to eval(), which
+        is unsafe for untrusted input.
+    """
+    #interpolated = _interpolate(s, defines)
+    if compiled is None:
+        compiled = get_compiled_expression(expression)
+    function = compiled.function
+    if safe:
+        if function is None and compiled.code is not None:
+            raise PreprocessorError("cannot evaluate `%s` safely" % expression,
+                                    defines['__FILE__'], defines['__LINE__'])
+    elif compiled.reads_builtins:
+        function = None
+    key = None
+    if compiled.names is not None and not (safe and compiled.reads_builtins):
+        key = _get_expression_result_key(expression, compiled.names, defines)
+        if key is not None:
+            return_value = expression_result_cache.get(key, _missing)
+            if return_value is not _missing:
+                return return_value
+    try:
+        if function is not None:
+            return_value = function(defines)
+        else:
+            code = compiled.code
+            if code is None:
+                # Let eval() report the syntax error.
+                code = expression
+            return_value = eval(code, _get_evaluation_globals(defines), defines)
+    except Exception, ex:
+        message = str(ex)
+        if message.startswith("name '") and message.endswith("' is not defined"):
+            # A common error (at least this is presumed:) is to have
+            #   defined(FOO)   instead of   defined('FOO')
+            # We should give a little insight into what might be wrong.
+            # message == "name 'FOO' is not defined"
+            #    -->  variable_name == "FOO"
+            variable_name = message[len("name '"):-len("' is not defined")]
+            if expression.find("defined(%s)" % variable_name) > -1:
+                # "defined(FOO)" in expr instead of "defined('FOO')"
+                message += ''' (perhaps you want `defined('%s')` instead of `defined(%s)`)''' % (variable_name, variable_name)
+        elif message.startswith("invalid syntax"):
+            message = "invalid syntax: `%s`" % expression
+        raise PreprocessorError(message, defines['__FILE__'], defines['__LINE__'])
+
+    if key is not None:
+        expression_result_cache[key] = return_value
+    logger.debug("evaluate %r -> %s (defines=%r)", expression, return_value, defines)
+    return return_value
+
+
+def get_statement_regexps(comment_groups):
+    # Generate statement parsing regexes. Basic format:
+    #       <comment-prefix> <preprocessor-stmt> <comment-suffix>
+    #  Examples:
+    #       <!-- #if foo -->
+    #       ...
+    #       <!-- #endif -->
+    #
+    #       # #if BAR
+    #       ...
+    #       # #else
+    #       ...
+    #       # #endif
+    patterns = []
+    for preprocessor_statement_regexp in PREPROCESSOR_STATEMENT_REGEXP_PATTERNS:
+        # The comment group prefix and suffix can either be just a
+        # string or a compiled regex.
+        for cprefix, csuffix in comment_groups:
+            if hasattr(cprefix, "pattern"):
+                pattern = cprefix.pattern
+            else:
+                pattern = r"^\s*%s\s*" % re.escape(cprefix)
+            pattern += preprocessor_statement_regexp
+            if hasattr(csuffix, "pattern"):
+                pattern += csuffix.pattern
+            else:
+                pattern += r"\s*%s\s*$" % re.escape(csuffix)
+            patterns.append(pattern)
+    statement_regexps = [re.compile(p) for p in patterns]
+    return statement_regexps
+
+
+def get_statement_prefix_regexp(comment_groups, flags=0):
+    """
+    Generates a single regular expression that matches the
+    ``<comment-prefix> #`` part common to all preprocessor statements
+    of the given comment groups.
+
+    :param comment_groups:
+        A list of (comment-prefix, comment-suffix) pairs.
+    :param flags:
+        Flags to compile the regular expression with. With
+        ``re.MULTILINE`` the whitespace around plain string comment
+        prefixes does not match newlines, so that a search does not
+        rescan runs of blank lines.
+    :return:
+        A compiled regular expression.
+
+    Usage::
+
+        >>> r = get_statement_prefix_regexp([['/*', '*/'], ['//', '']])
+        >>> bool(r.match("  // #if FOO"))
+        True
+        >>> bool(r.match("/*#endif */"))
+        True
+        >>> bool(r.match("var foo = 1; // #if FOO"))
+        False
+        >>> r = get_statement_prefix_regexp([['//', '']], re.MULTILINE)
+        >>> r.search("x\\n\\n  // #if FOO\\n").start()
+        3
+        >>> r.search("//\\n#if FOO\\n") is None
+        True
+    """
+    if flags & re.MULTILINE:
+        whitespace = r"[^\S\n]*"
+    else:
+        whitespace = r"\s*"
+    patterns = []
+    for cprefix, csuffix in comment_groups:
+        if hasattr(cprefix, "pattern"):
+            pattern = cprefix.pattern
+        else:
+            pattern = r"^%s%s%s" % (whitespace, re.escape(cprefix), whitespace)
+        patterns.append("(?:%s#)" % pattern)
+    return re.compile("|".join(patterns), flags)
+
+
+# Whitespace as matched by ``\s`` in the statement regular expressions.
+_WHITESPACE = " \t\n\r\v\f"
+
+# The operators of the built-in PREPROCESSOR_STATEMENT_REGEXP_PATTERNS.
+_BUILTIN_STATEMENT_OPS = ("if", "elif", "ifdef", "ifndef", "else", "endif",
+                          "error", "define", "undef", "include")
+_BUILTIN_STATEMENT_PATTERN_COUNT = len(PREPROCESSOR_STATEMENT_REGEXP_PATTERNS)
+
+# Operators of the statements added with register_statement_handler() in
+# the order their patterns were appended to
+# PREPROCESSOR_STATEMENT_REGEXP_PATTERNS.
+_custom_statement_ops = []
+
+
+class StatementMatch(object):
+    """
+    The result of parsing a preprocessor statement line without regular
+    expressions. Provides the parts of the regular expression match
+    object interface used by pepe.
+
+    Usage::
+
+        >>> m = StatementMatch({'op': 'define', 'var': 'FOO', 'val': None})
+        >>> m.group('op')
+        'define'
+        >>> m.group('var', 'val')
+        ('FOO', None)
+        >>> sorted(m.groupdict())
+        ['op', 'val', 'var']
+    """
+
+    def __init__(self, groups):
+        self._groups = groups
+
+    def group(self, *names):
+        if len(names) == 1:
+            return self._groups[names[0]]
+        return tuple(self._groups[name] for name in names)
+
+    def groupdict(self):
+        return dict(self._groups)
+
+
+def _parse_statement_body(op, body, has_separator, trailing_whitespace=""):
+    """
+    Parses the text between the operator and the comment suffix of a
+    preprocessor statement line the same way the corresponding pattern in
+    ``PREPROCESSOR_STATEMENT_REGEXP_PATTERNS`` would, but in time linear
+    in the length of the line.
+
+    :param op:
+        The statement operator.
+    :param body:
+        The text following the operator with the comment suffix and
+        trailing whitespace removed.
+    :param has_separator:
+        ``True`` if the operator is followed by whitespace in the line.
+    :param trailing_whitespace:
+        Whitespace following ``body`` in the line that is not part of the
+        comment suffix, excluding a final newline character.
+    :return:
+        A (pattern-index, groups-dict) tuple or ``None`` if the line is
+        not a valid statement.
+
+    Usage::
+
+        >>> _parse_statement_body('define', ' FOO  1 + 2', True)
+        (3, {'var': 'FOO', 'val': '1 + 2', 'op': 'define'})
+        >>> _parse_statement_body('include', ' "foo.h"', True)
+        (5, {'fname': 'foo.h', 'op': 'include'})
+        >>> _parse_statement_body('else', ' junk', True) is None
+        True
+
+        The define pattern gives a value of a single whitespace character
+        to a variable followed by two or more whitespace characters.
+
+        >>> _parse_statement_body('define', ' FOO', True, '  ')
+        (3, {'var': 'FOO', 'val': ' ', 'op': 'define'})
+    """
+    stripped = body.strip(_WHITESPACE)
+    if op in ("else", "endif"):
+        if stripped:
+            return None
+        return 1, {'op': op}
+    if not has_separator:
+        return None
+    if op in ("if", "elif", "ifdef", "ifndef"):
+        return 0, {'op': op, 'expr': stripped}
+    if op == "error":
+        return 2, {'op': op, 'error': stripped}
+    words = stripped.split(None, 1)
+    if op == "define":
+        if not words:
+            return 3, {'op': op, 'var': '', 'val': None}
+        if len(words) > 1:
+            return 3, {'op': op, 'var': words[0], 'val': words[1]}
+        whitespace = (body + trailing_whitespace)[len(body.rstrip(_WHITESPACE)):]
+        return 3, {'op': op, 'var': words[0],
+                   'val': whitespace[-1] if len(whitespace) > 1 else None}
+    if op == "undef":
+        if len(words) > 1:
+            return None
+        return 4, {'op': op, 'var': stripped}
+    if op == "include":
+        if len(stripped) > 1 and stripped[0] == '"' and stripped[-1] == '"':
+            return 5, {'op': op, 'fname': stripped[1:-1]}
+        if len(words) == 1:
+            return 6, {'op': op, 'var': stripped}
+    return None
+
+
+class StatementMatcher(object):
+    """
+    Matches preprocessor statement lines for a list of comment groups.
+
+    Nearly all lines of a file are not preprocessor statements, so each
+    line is first checked against a single combined prefix regular
+    expression. Only lines that start with a comment prefix followed by
+    ``#`` are parsed further.
+
+    For comment groups with plain string delimiters a statement is parsed
+    in time linear in the length of the line: a short regular expression
+    finds the operator, the comment suffix is checked with ``endswith``
+    and the remainder is split without backtracking. Comment groups with
+    regular expression delimiters use the full statement regular
+    expressions.
+    """
+
+    def __init__(self, comment_groups):
+        self.comment_groups = comment_groups
+        self.prefix_regexp = get_statement_prefix_regexp(comment_groups)
+        self.multiline_prefix_regexp = get_statement_prefix_regexp(
+            comment_groups, re.MULTILINE)
+        # Longest first, so that no operator hides another it is a prefix of.
+        ops = sorted(_BUILTIN_STATEMENT_OPS + tuple(_custom_statement_ops),
+                     key=len, reverse=True)
+        head_pattern = r"#\s*(?P<op>%s)" % "|".join(re.escape(op) for op in ops)
+        self._parsers = []
+        for cprefix, csuffix in comment_groups:
+            statement_regexps = get_statement_regexps([(cprefix, csuffix)])
+            if hasattr(cprefix, "pattern") or hasattr(csuffix, "pattern"):
+                self._parsers.append((None, None, statement_regexps, None))
+            else:
+                head_regexp = re.compile(r"^\s*%s\s*%s" % (re.escape(cprefix),
+                                                          head_pattern))
+                # Custom statements are matched with their full regular
+                # expressions.
+                custom_regexps = {}
+                for index in range(_BUILTIN_STATEMENT_PATTERN_COUNT,
+                                   len(statement_regexps)):
+                    op = _custom_statement_ops[index - _BUILTIN_STATEMENT_PATTERN_COUNT]
+                    custom_regexps[op] = (index, statement_regexps[index])
+                self._parsers.append((head_regexp, csuffix, None, custom_regexps))
+
+    def match(self, line):
+        """
+        Matches a line against the preprocessor statement syntax.
+
+        :param line:
+            The line to match.
+        :return:
+            A match object or ``None`` if the line is not a preprocessor
+            statement.
+
+        Usage::
+
+            >>> m = StatementMatcher([['<!--', '-->'], ['//', '']])
+            >>> m.match("<!-- #if FOO -->").group("op", "expr")
+            ('if', 'FOO')
+            >>> m.match("// #define BAR 1").group("var", "val")
+            ('BAR', '1')
+            >>> m.match("<p>Hello</p>") is None
+            True
+            >>> m.match("<!-- #bogus -->") is None
+            True
+            >>> m.match("<!-- #endif --> <p>") is None
+            True
+        """
+        if not self.prefix_regexp.match(line):
+            return None
+        best_index = None
+        best_match = None
+        for head_regexp, csuffix, statement_regexps, custom_regexps in self._parsers:
+            if statement_regexps is not None:
+                for index, statement_regexp in enumerate(statement_regexps):
+                    match = statement_regexp.match(line)
+                    if match:
+                        break
+                else:
+                    continue
+            else:
+                head = head_regexp.match(line)
+                if not head:
+                    continue
+                op = head.group("op")
+                if op in custom_regexps:
+                    index, statement_regexp = custom_regexps[op]
+                    match = statement_regexp.match(line)
+                    if match and (best_index is None or index < best_index):
+                        best_index, best_match = index, match
+                    continue
+                body_start = head.end()
+                body_end = len(line.rstrip(_WHITESPACE))
+                if csuffix:
+                    trailing_whitespace = ""
+                    body_end -= len(csuffix)
+                    if (body_end < body_start
+                        or not line.startswith(csuffix, body_end)):
+                        continue
+                elif line.endswith("\n"):
+                    trailing_whitespace = line[body_end:-1]
+                else:
+                    trailing_whitespace = line[body_end:]
+                has_separator = (body_start < len(line)
+                                 and line[body_start] in _WHITESPACE)
+                parsed = _parse_statement_body(op,
+                                               line[body_start:body_end],
+                                               has_separator,
+                                               trailing_whitespace)
+                if parsed is None:
+                    continue
+                index, groups = parsed
+                match = StatementMatch(groups)
+            # Statement patterns take precedence over comment groups.
+            if best_index is None or index < best_index:
+                best_index, best_match = index, match
+        return best_match
+
+
+def _freeze_comment_groups(comment_groups):
+    """
+    Converts a list of comment groups into a hashable key.
+
+    Usage::
+
+        >>> _freeze_comment_groups([['/*', '*/'], ['//', '']])
+        (('/*', '*/'), ('//', ''))
+    """
+    def freeze(delimiter):
+        if hasattr(delimiter, "pattern"):
+            return (delimiter.pattern, delimiter.flags)
+        return delimiter
+    return tuple((freeze(cprefix), freeze(csuffix))
+                 for cprefix, csuffix in comment_groups)
+
+
+def get_statement_matcher(comment_groups):
+    """
+    Returns a ``StatementMatcher`` for the given comment groups reusing
+    a previously compiled one from ``statement_matcher_cache`` if
+    available. Use ``statement_matcher_cache.info()`` to inspect the
+    number of cache hits and misses.
+
+    :param comment_groups:
+        A list of (comment-prefix, comment-suffix) pairs.
+    :return:
+        A ``StatementMatcher`` instance.
+
+    Usage::
+
+        >>> m = get_statement_matcher([['#', '']])
+        >>> m is get_statement_matcher([('#', '')])
+        True
+    """
+    key = _freeze_comment_groups(comment_groups)
+    statement_matcher = statement_matcher_cache.get(key)
+    if statement_matcher is None:
+        statement_matcher = StatementMatcher(comment_groups)
+        statement_matcher_cache[key] = statement_matcher
+    return statement_matcher
+
+
+SKIP, EMIT = range(2) # states
+
+# The values of ``options.engine``, implemented by ``_preprocess_lines()``,
+# ``_preprocess_buffer()``, ``_preprocess_buffer()`` with NumPy,
+# ``_render_template()`` and ``_render_compiled_template()``.
+ENGINES = ('line', 'buffer', 'numpy', 'template', 'compiled')
+
+
+def _substitute_sequentially(line, defines, keys=None):
+    # XXX Should avoid recursive substitutions. But that
+    #     would be a pain right now.
+    if keys is None:
+        keys = defines
+    for name in reversed(sorted(keys, key=len)):
+        value = defines[name]
+        line = line.replace(name, str(value))
+    return line
+
+
+def _get_trie_pattern(names):
+    """
+    Returns a regular expression matching the longest of ``names`` that
+    starts where it is tried, with the names arranged as a trie so that a
+    match only tries the names that share its prefix.
+
+    Usage::
+
+        >>> _get_trie_pattern(["AB", "ABC", "B"])
+        '(?:AB(?:C)?|B)'
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for c in name:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def get_pattern(node):
+        alternatives = []
+        for c in sorted(node):
+            if c:
+                alternatives.append(re.escape(c) + get_pattern(node[c]))
+        if not alternatives:
+            return ""
+        if '' in node:
+            # The longest name first, then the name that ends here.
+            return "(?:%s)?" % "|".join(alternatives)
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:%s)" % "|".join(alternatives)
+
+    return get_pattern(trie)
+
+
+class _SubstitutionTable(object):
+    """
+    Finds which of a set of define names occur in a line with a single
+    scan.
+    """
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+        # Captures the longest name starting at every position.
+        self.matcher = re.compile("(?=(%s))" % _get_trie_pattern(self.names))
+        self.prefixes = {}
+
+    def find_names(self, line):
+        """
+        Returns the set of the names that occur in a line.
+        """
+        found_names = set()
+        for name in self.matcher.findall(line):
+            if name not in found_names:
+                found_names.add(name)
+                found_names.update(self._get_prefixes(name))
+        return found_names
+
+    def _get_prefixes(self, name):
+        # The other names that start where ``name`` does.
+        prefixes = self.prefixes.get(name)
+        if prefixes is None:
+            prefixes = [name[:length] for length in range(1, len(name))
+                        if name[:length] in self.names]
+            self.prefixes[name] = prefixes
+        return prefixes
+
+
+# The ``_SubstitutionTable`` of the last substitution.
+_substitution_table = [None]
+
+
+def _get_substitution_table(defines):
+    """
+    Returns a ``_SubstitutionTable`` for the names of the defines and the
+    names of the defines that it lacks, or ``(None, None)`` if the names
+    cannot be scanned for. A table is reused until the names differ from
+    its own by more than half of them, so #define and #undef statements
+    rarely lead to building another.
+    """
+    table = _substitution_table[0]
+    if table is not None:
+        if isinstance(defines, dict):
+            added_names = defines.viewkeys() - table.names
+        else:
+            added_names = set(defines).difference(table.names)
+        removed_count = len(table.names) - len(defines) + len(added_names)
+        if len(added_names) + removed_count <= 8 + len(table.names) // 2:
+            for name in added_names:
+                if type(name) is not str or not name:
+                    return None, None
+            return table, added_names
+    names = frozenset(defines)
+    for name in names:
+        if type(name) is not str or not name:
+            return None, None
+    table = substitution_table_cache.get(names)
+    if table is None:
+        table = _SubstitutionTable(names)
+        substitution_table_cache[names] = table
+    _substitution_table[0] = table
+    return table, ()
+
+
+class _Substituter(object):
+    """
+    Substitutes the values of defines into lines for as long as the names
+    of the defines do not change, which they only do at statements.
+
+    Defines are substituted one after another, the longest names first,
+    into the values substituted before them as well. Only the names that
+    a ``_SubstitutionTable`` finds in a line are substituted, and the line
+    is scanned again after each substitution, which gives the same result
+    as trying every name.
+    """
+
+    def __init__(self, defines, keys=None):
+        self.table, self.added_names = _get_substitution_table(defines)
+        # The names of the defines in order, unless given in ``keys``, and
+        # the positions of names in it, which order names of equal length.
+        self.keys = None if keys is None else list(keys)
+        self.positions = {}
+
+    def substitute(self, line, defines):
+        table = self.table
+        if table is None:
+            return _substitute_sequentially(line, defines, self.keys)
+        names = self._find_names(line, defines)
+        last_name = None
+        last_priority = None
+        while names:
+            if last_name is None and len(names) == 1:
+                name = names[0]
+            else:
+                priorities = [(len(name), self._get_position(name, defines),
+                               name) for name in names]
+                if last_name is not None:
+                    if last_priority is None:
+                        last_priority = (len(last_name),
+                                         self._get_position(last_name, defines),
+                                         last_name)
+                    # Names after the last one substituted.
+                    priorities = [priority for priority in priorities
+                                  if priority < last_priority]
+                    if not priorities:
+                        break
+                last_priority = max(priorities)
+                name = last_priority[2]
+            line = line.replace(name, str(defines[name]))
+            last_name = name
+            names = self._find_names(line, defines)
+        return line
+
+    def _find_names(self, line, defines):
+        names = [name for name in self.table.find_names(line)
+                 if name in defines]
+        names.extend(name for name in self.added_names if name in line)
+        return names
+
+    def _get_position(self, name, defines):
+        # Names of equal length are substituted in the reverse order of the
+        # defines, as sorted() leaves them.
+        position = self.positions.get(name)
+        if position is None:
+            if self.keys is None:
+                self.keys = list(defines)
+            position = self.keys.index(name)
+            self.positions[name] = position
+        return position
+
+
+def _substitute(line, defines):
+    """
+    Substitutes the values of all defines into a line.
+
+    Usage::
+
+        >>> _substitute("print FOO, FOOBAR\\n", {'FOO': 1, 'FOOBAR': 2})
+        'print 1, 2\\n'
+        >>> _substitute("AA B", {'AA': 'B', 'B': 'C'})
+        'C C'
+        >>> _substitute("ABCD", {'AB': 1, 'BCD': 2})
+        'A2'
+    """
+    return _Substituter(defines).substitute(line, defines)
+
+
+class _MarkerSubstituter(object):
+    """
+    Substitutes the values of defines for markers such as ``${NAME}``.
+    Each line is scanned once for markers and each marker is one lookup,
+    however many defines there are. Markers of undefined names are kept
+    and substituted values are not substituted into again.
+
+    Usage::
+
+        >>> s = _MarkerSubstituter(('${', '}'))
+        >>> s.substitute("${A} ${B} ${C} B\\n", {'A': '${B}', 'B': 1})
+        '${B} 1 ${C} B\\n'
+        >>> _MarkerSubstituter(('$', '')).substitute("$A.", {'A': 1})
+        '1.'
+    """
+
+    def __init__(self, markers):
+        prefix, suffix = markers
+        self.prefix = prefix
+        if suffix:
+            name_pattern = r"(\S+?)"
+        else:
+            name_pattern = r"(\w+)"
+        self.regexp = re.compile(re.escape(prefix) + name_pattern
+                                 + re.escape(suffix))
+
+    def substitute(self, line, defines):
+        if self.prefix not in line:
+            return line
+
+        def replace(match):
+            name = match.group(1)
+            if name in defines:
+                return str(defines[name])
+            return match.group(0)
+
+        return self.regexp.sub(replace, line)
+
+
+# Substituters of markers keyed by their (prefix, suffix) tuple.
+_marker_substituters = {}
+
+
+def _get_substituter(defines, markers=None):
+    """
+    Returns an object whose ``substitute(line, defines)`` method
+    substitutes defines into lines until the next statement: between
+    ``markers``, a (prefix, suffix) tuple, or wherever their names occur
+    if ``markers`` is ``None``.
+    """
+    if markers is None:
+        return _Substituter(defines)
+    substituter = _marker_substituters.get(markers)
+    if substituter is None:
+        substituter = _marker_substituters[markers] = _MarkerSubstituter(
+            markers)
+    return substituter
+
+
+def _get_substitution_markers(filename, options, content_types_db):
+    """
+    Returns the (prefix, suffix) markers that defines are substituted
+    between in a file, or ``None`` if defines are not substituted between
+    markers.
+    """
+    if not (options.should_substitute
+            and getattr(options, 'should_substitute_markers', False)):
+        return None
+    return content_types_db.get_substitution_markers_for_path(
+        filename, options.default_content_type)
+
+
+# The number of characters of text that substitution is done for in a
+# worker process at a time with ``options.jobs``.
+SUBSTITUTION_CHUNK_SIZE = 1 << 20
+
+
+class _SubstitutionSpans(object):
+    """
+    The output buffer of ``preprocess()`` when defines are substituted in
+    parallel. The statements of the input are processed first, recording
+    the emitted blocks of lines with the defines that apply to each, and
+    ``getvalue()`` then substitutes into them in ``jobs`` processes.
+
+    Usage::
+
+        >>> spans = _SubstitutionSpans(2)
+        >>> spans.write("# kept\\n")
+        >>> spans.write_span("A __LINE__\\nB\\n", 3,
+        ...                  {'A': 1, 'B': 'A', '__LINE__': 3}, None)
+        >>> spans.getvalue()
+        '# kept\\n1 3\\n1\\n'
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        # Text written as it is and (block, first-line-number, snapshot,
+        # markers) spans.
+        self.items = []
+        self._last_snapshot = None
+        self._last_values = None
+        self._last_key = None
+
+    def write(self, text):
+        self.items.append(text)
+
+    def write_span(self, block, first_line_number, defines, markers):
+        """
+        Records a block of lines to substitute the defines into, as they
+        are now, between ``markers`` or wherever their names occur if
+        ``markers`` is ``None``. ``defines['__LINE__']`` must be set.
+        """
+        snapshot = self._get_snapshot(defines)
+        start = 0
+        while start < len(block):
+            end = (block.find("\n", start + SUBSTITUTION_CHUNK_SIZE) + 1
+                   or len(block))
+            text = block[start:end]
+            self.items.append((text, first_line_number, snapshot, markers))
+            first_line_number += text.count("\n")
+            start = end
+
+    def _get_snapshot(self, defines):
+        # A snapshot is the names of the defines, in order as they break
+        # ties, and their values, with mutable values converted to strings
+        # as they are now. Consecutive spans with the same immutable values
+        # share a snapshot, so that it is sent to a worker only once.
+        names, values = zip(*defines.items())
+        key = map(id, values)
+        key[names.index('__LINE__')] = None
+        key = (names, key)
+        if (key == self._last_key
+            and set(map(type, values)).issubset(_IMMUTABLE_TYPES)):
+            return self._last_snapshot
+        self._last_key = key
+        # Keeps the values alive so that their ids are not reused.
+        self._last_values = values
+        self._last_snapshot = (names, tuple(
+            value if type(value) in _IMMUTABLE_TYPES else str(value)
+            for value in values))
+        return self._last_snapshot
+
+    def getvalue(self):
+        output = StringIO()
+        self.write_to(output)
+        return output.getvalue()
+
+    def write_to(self, output):
+        """
+        Substitutes the defines into the recorded spans and writes the
+        output in order, one chunk at a time.
+        """
+        chunks = []
+        chunk = []
+        size = 0
+        for item in self.items:
+            chunk.append(item)
+            if type(item) is tuple:
+                size += len(item[0])
+                if size >= SUBSTITUTION_CHUNK_SIZE:
+                    chunks.append(chunk)
+                    chunk = []
+                    size = 0
+        if chunk:
+            chunks.append(chunk)
+        if self.jobs > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(chunks)))
+            try:
+                for text in pool.imap(_substitute_spans, chunks, 1):
+                    output.write(text)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for chunk in chunks:
+                output.write(_substitute_spans(chunk))
+
+    def close(self):
+        self.items = []
+
+
+def _substitute_spans(items):
+    """
+    Substitutes defines into a chunk of the items of a
+    ``_SubstitutionSpans``, in a worker process.
+    """
+    texts = []
+    last_snapshot = None
+    substituters = {}
+    for item in items:
+        if type(item) is not tuple:
+            texts.append(item)
+            continue
+        block, line_number, snapshot, markers = item
+        if snapshot is not last_snapshot:
+            names, values = snapshot
+            defines = dict(zip(names, values))
+            last_snapshot = snapshot
+            substituters = {}
+        substituter = substituters.get(markers)
+        if substituter is None:
+            if markers is None:
+                substituter = _Substituter(defines, names)
+            else:
+                substituter = _get_substituter(defines, markers)
+            substituters[markers] = substituter
+        for line in _split_lines(block):
+            defines['__LINE__'] = line_number
+            texts.append(substituter.substitute(line, defines))
+            line_number += 1
+    return "".join(texts)
+
+
+class StatementContext(object):
+    """
+    The state of a ``preprocess()`` call that statement handlers work on.
+
+    :ivar input_filename:
+        The path of the file being preprocessed.
+    :ivar output:
+        The file-like object that output is written to.
+    :ivar states:
+        The stack of #if block states. A state is a tuple of
+        (<emit-or-skip-lines-in-this-section>,
+         <have-emitted-in-this-if-block>,
+         <have-seen-'else'-in-this-if-block>).
+    :ivar defines:
+        The dictionary of defined variables. Handlers may replace it.
+    :ivar options:
+        A ``Namespace`` of command-line options.
+    :ivar content_types_db:
+        An instance of ``ContentTypesDatabase``.
+    :ivar preprocessed_files:
+        Absolute paths of the files preprocessed so far, used to detect
+        recursive #includes.
+    :ivar substitution_markers:
+        The (prefix, suffix) markers that defines are substituted between
+        in the file, or ``None`` to substitute the names of defines.
+    """
+
+    def __init__(self,
+                 input_filename,
+                 output,
+                 states,
+                 defines,
+                 options,
+                 content_types_db,
+                 preprocessed_files,
+                 substitution_markers=None):
+        self.input_filename = input_filename
+        self.output = output
+        self.states = states
+        self.defines = defines
+        self.options = options
+        self.content_types_db = content_types_db
+        self.preprocessed_files = preprocessed_files
+        self.substitution_markers = substitution_markers
+
+    @property
+    def is_skipping(self):
+        """
+        ``True`` if the current line is in a skipped section of an #if
+        block.
+        """
+        return bool(self.states) and self.states[-1][0] == SKIP
+
+    def error(self, message, line=None):
+        """
+        Returns a ``PreprocessorError`` for the current file and line.
+        """
+        return PreprocessorError(message, self.defines['__FILE__'],
+                                 self.defines['__LINE__'], line)
+
+
+_DECIMAL_REGEXP = re.compile(r"^-?(?:[1-9][0-9]*|0)$")
+_HEXADECIMAL_REGEXP = re.compile(r"^-?0[xX][0-9a-fA-F]+$")
+_FLOAT_REGEXP = re.compile(r"^-?(?:[0-9]+\.[0-9]*|\.[0-9]+)$")
+_IDENTIFIER_REGEXP = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_NAMED_CONSTANTS = {'True': True, 'False': False, 'None': None}
+
+
+def _parse_define_value(value, safe=False):
+    """
+    Converts the value of a #define statement to a Python object. Common
+    literals are converted directly and anything else is evaluated as a
+    Python expression, without eval() if ``safe``. A value that cannot be
+    evaluated is kept as a string.
+
+    Usage::
+
+        >>> _parse_define_value("42")
+        42
+        >>> _parse_define_value("0x40")
+        64
+        >>> _parse_define_value("3.14")
+        3.14
+        >>> _parse_define_value("'foo'")
+        'foo'
+        >>> _parse_define_value("foo")
+        'foo'
+        >>> _parse_define_value("None") is None
+        True
+        >>> _parse_define_value("[1, 'a', 2.5]")
+        [1, 'a', 2.5]
+        >>> _parse_define_value("010")
+        8
+        >>> _parse_define_value("08")
+        '08'
+    """
+    literal = _parse_define_literal(value)
+    if literal is not None:
+        return literal[0]
+    return _evaluate_define_value(value, safe)
+
+
+def _parse_define_literal(value):
+    """
+    Converts the value of a #define statement to a Python object without
+    evaluating it if it is a common literal.
+
+    :return:
+        A 1-tuple holding the converted value or ``None`` if the value
+        must be evaluated.
+
+    Usage::
+
+        >>> _parse_define_literal("-12")
+        (-12,)
+        >>> _parse_define_literal("None")
+        (None,)
+        >>> _parse_define_literal("1 + 2") is None
+        True
+    """
+    if _DECIMAL_REGEXP.match(value):
+        return (int(value),)
+    if _HEXADECIMAL_REGEXP.match(value):
+        return (int(value, 16),)
+    if _FLOAT_REGEXP.match(value):
+        return (float(value),)
+    if value in _NAMED_CONSTANTS:
+        return (_NAMED_CONSTANTS[value],)
+    if (_IDENTIFIER_REGEXP.match(value) and value != '__builtins__'
+        and not hasattr(__builtin__, value)):
+        # Evaluating an unknown name raises a NameError or, for keywords,
+        # a SyntaxError, which keeps the value as a string.
+        return (value,)
+    if (len(value) > 1 and value[0] == value[-1] and value[0] in "'\""
+        and value[0] not in value[1:-1] and "\\" not in value):
+        return (value[1:-1],)
+    return None
+
+
+def _evaluate_define_value(value, safe=False):
+    """
+    Evaluates the value of a #define statement as a Python expression,
+    keeping it as a string if that fails. Values that do not read any
+    names are evaluated once and kept in ``define_value_cache`` if they
+    are immutable.
+
+    With ``safe`` only values that ``compile_safe_expression()`` accepts
+    are evaluated, without any defines or built-ins.
+
+    Usage::
+
+        >>> _evaluate_define_value("1 << 4")
+        16
+        >>> _evaluate_define_value("1 << 4", safe=True)
+        '1 << 4'
+        >>> _evaluate_define_value("(1, -2)", safe=True)
+        (1, -2)
+        >>> _evaluate_define_value("foo bar")
+        'foo bar'
+    """
+    key = (value, safe)
+    result = define_value_cache.get(key, _missing)
+    if result is not _missing:
+        return result
+    compiled = get_compiled_expression(value)
+    code = compiled.code
+    if safe:
+        if (compiled.function is None or compiled.names is None
+            or 'defined' in compiled.names):
+            # eval() would not find defined() either.
+            result = value
+        else:
+            try:
+                result = compiled.function({})
+            except Exception:
+                result = value
+    elif code is None:
+        result = value
+    else:
+        try:
+            result = eval(code, {}, {})
+        except NameError:
+            # Only built-ins can be found, so the name never will be.
+            result = value
+        except:
+            return value
+        if code.co_names and result is not value:
+            return result
+    if isinstance(result, _IMMUTABLE_TYPES):
+        define_value_cache[key] = result
+    return result
+
+
+def _evaluate_condition(op, expression, defines, safe=False):
+    """
+    Evaluates the condition of an #if, #ifdef or #ifndef statement.
+    #ifdef and #ifndef on a plain name are a dictionary lookup.
+
+    Usage::
+
+        >>> _evaluate_condition("ifdef", "FOO", {'FOO': 0})
+        True
+        >>> _evaluate_condition("ifndef", "FOO", {'FOO': 0})
+        False
+        >>> _evaluate_condition("if", "FOO", {'FOO': 0})
+        0
+    """
+    if op == "if":
+        return _evaluate(expression, defines, safe=safe)
+    if "'" in expression or "\\" in expression:
+        # Not a plain name; let eval() decide what it means.
+        if op == "ifdef":
+            return _evaluate("defined('%s')" % expression, defines, safe=safe)
+        return _evaluate("not defined('%s')" % expression, defines, safe=safe)
+    if op == "ifdef":
+        return expression in defines
+    return expression not in defines
+
+
+def _is_safe(context):
+    return getattr(context.options, 'should_evaluate_safely', False)
+
+
+def _handle_define(context, match, line):
+    if not context.is_skipping:
+        var, val = match.group("var", "val")
+        if val is not None:
+            val = _parse_define_value(val, _is_safe(context))
+        context.defines[var] = val
+
+
+def _undefine(defines, name):
+    """
+    Removes a define if it is defined. A ``DefineEnvironment`` records the
+    removal even if it is not, so that a recorded #include also removes
+    the define when it is replayed where the define exists.
+    """
+    if isinstance(defines, DefineEnvironment):
+        defines.discard(name)
+    else:
+        defines.pop(name, None)
+
+
+def _handle_undef(context, match, line):
+    if not context.is_skipping:
+        _undefine(context.defines, match.group("var"))
+
+
+def _find_include_file(filename, input_filename, include_paths):
+    """
+    Finds an #include'd file as ``_handle_include`` does.
+
+    :return:
+        The path of the file or ``None`` if it cannot be found.
+    """
+    for d in [os.path.dirname(input_filename)] + include_paths:
+        path = os.path.normpath(os.path.join(d, filename))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _handle_include(context, match, line):
+    if not context.is_skipping:
+        include_paths = context.options.include_paths
+        if "var" in match.groupdict():
+            # This is the second include form: #include VAR
+            var = match.group("var")
+            f = context.defines[var]
+        else:
+            # This is the first include form: #include "path"
+            f = match.group("fname")
+
+        fname = _find_include_file(f, context.input_filename, include_paths)
+        if fname is None:
+            raise PreprocessorError(
+                "could not find #include'd file "\
+                "\"%s\" on include path: %r"\
+                % (f, include_paths))
+        _preprocess_include(fname, context)
+
+
+def _handle_if(context, match, line):
+    # Handles #if, #ifdef and #ifndef.
+    op = match.group("op")
+    states = context.states
+    try:
+        if context.is_skipping:
+            # Were are nested in a SKIP-portion of an if-block.
+            states.append((SKIP, 0, 0))
+        elif _evaluate_condition(op, match.group("expr"), context.defines,
+                                 _is_safe(context)):
+            states.append((EMIT, 1, 0))
+        else:
+            states.append((SKIP, 0, 0))
+    except KeyError:
+        raise context.error("use of undefined variable in #%s stmt" % op, line)
+
+
+def _handle_elif(context, match, line):
+    states = context.states
+    try:
+        if states[-1][2]: # already had #else in this if-block
+            raise context.error("illegal #elif after #else in same #if block",
+                                line)
+        elif states[-1][1]: # if have emitted in this if-block
+            states[-1] = (SKIP, 1, 0)
+        elif states[:-1] and states[-2][0] == SKIP:
+            # Were are nested in a SKIP-portion of an if-block.
+            states[-1] = (SKIP, 0, 0)
+        elif _evaluate(match.group("expr"), context.defines,
+                       safe=_is_safe(context)):
+            states[-1] = (EMIT, 1, 0)
+        else:
+            states[-1] = (SKIP, 0, 0)
+    except IndexError:
+        raise context.error("#elif stmt without leading #if stmt", line)
+
+
+def _handle_else(context, match, line):
+    states = context.states
+    try:
+        if states[-1][2]: # already had #else in this if-block
+            raise context.error("illegal #else after #else in same #if block",
+                                line)
+        elif states[-1][1]: # if have emitted in this if-block
+            states[-1] = (SKIP, 1, 1)
+        elif states[:-1] and states[-2][0] == SKIP:
+            # Were are nested in a SKIP-portion of an if-block.
+            states[-1] = (SKIP, 0, 1)
+        else:
+            states[-1] = (EMIT, 1, 1)
+    except IndexError:
+        raise context.error("#else stmt without leading #if stmt", line)
+
+
+def _handle_endif(context, match, line):
+    try:
+        context.states.pop()
+    except IndexError:
+        raise context.error("#endif stmt without leading #ifstmt", line)
+
+
+def _handle_error(context, match, line):
+    if not context.is_skipping:
+        raise context.error("#error: " + match.group("error"), line)
+
+
+# Handlers of preprocessor statements keyed by operator. A handler is
+# called as handler(context, match, line) with a ``StatementContext``, the
+# statement's match object and the statement line.
+STATEMENT_HANDLERS = {
+    'define': _handle_define,
+    'undef': _handle_undef,
+    'include': _handle_include,
+    'if': _handle_if,
+    'ifdef': _handle_if,
+    'ifndef': _handle_if,
+    'elif': _handle_elif,
+    'else': _handle_else,
+    'endif': _handle_endif,
+    'error': _handle_error,
+}
+
+
+def register_statement_handler(op, handler, pattern=None):
+    """
+    Registers a handler for a preprocessor statement.
+
+    Handlers of statements other than the built-in ones are only called
+    for statements outside skipped sections of #if blocks.
+
+    :param op:
+        The name of the statement, for example ``warning`` for
+        ``#warning``.
+    :param handler:
+        A callable invoked as ``handler(context, match, line)`` where
+        ``context`` is a ``StatementContext``.
+    :param pattern:
+        A regular expression for the text that follows the name of a new
+        statement, using named groups for the parts the handler needs.
+        Defaults to an optional argument string captured as ``args``.
+        Must be ``None`` when replacing the handler of a built-in
+        statement.
+
+    Usage::
+
+        >>> def handle_warning(context, match, line):
+        ...     logger.warning(match.group("args"))
+        >>> register_statement_handler("warning", handle_warning)
+        >>> m = get_statement_matcher([['//', '']])
+        >>> m.match("// #warning deprecated").group("op", "args")
+        ('warning', 'deprecated')
+        >>> unregister_statement_handler("warning")
+        >>> m = get_statement_matcher([['//', '']])
+        >>> m.match("// #warning deprecated") is None
+        True
+    """
+    if op in _BUILTIN_STATEMENT_OPS:
+        if pattern is not None:
+            raise ValueError("cannot change the syntax of the built-in "
+                             "#%s statement" % op)
+    else:
+        if not _IDENTIFIER_REGEXP.match(op):
+            raise ValueError("invalid statement name `%s`" % op)
+        if op in _custom_statement_ops:
+            unregister_statement_handler(op)
+        if pattern is None:
+            pattern = r"(?:\s+(?P<args>.*?))?"
+        PREPROCESSOR_STATEMENT_REGEXP_PATTERNS.append(
+            r"#\s*(?P<op>%s)%s" % (re.escape(op), pattern))
+        _custom_statement_ops.append(op)
+        statement_matcher_cache.clear()
+        template_cache.clear()
+    STATEMENT_HANDLERS[op] = handler
+
+
+def unregister_statement_handler(op):
+    """
+    Removes a statement registered with ``register_statement_handler()``.
+    The handler of a built-in statement is restored to its default.
+    """
+    if op in _BUILTIN_STATEMENT_OPS:
+        STATEMENT_HANDLERS[op] = _DEFAULT_STATEMENT_HANDLERS[op]
+        return
+    index = _custom_statement_ops.index(op)
+    del _custom_statement_ops[index]
+    del PREPROCESSOR_STATEMENT_REGEXP_PATTERNS[
+        _BUILTIN_STATEMENT_PATTERN_COUNT + index]
+    del STATEMENT_HANDLERS[op]
+    statement_matcher_cache.clear()
+    template_cache.clear()
+
+
+_DEFAULT_STATEMENT_HANDLERS = dict(STATEMENT_HANDLERS)
+
+
+def _process_statement(context, match, line):
+    """
+    Processes a single preprocessor statement line by dispatching it to
+    its handler in ``STATEMENT_HANDLERS``.
+
+    ``context.defines['__LINE__']`` must already refer to the line being
+    processed.
+    """
+    op = match.group("op")
+    logger.debug("%r stmt (states: %r)", op, context.states)
+    if op in _BUILTIN_STATEMENT_OPS or not context.is_skipping:
+        STATEMENT_HANDLERS[op](context, match, line)
+    logger.debug("states: %r", context.states)
+
+
+def _preprocess_lines(input_file, statement_matcher, context):
+    """
+    The line engine, the default. Matches and processes the input one line
+    at a time, substituting defines into emitted lines as it goes.
+    """
+    should_keep_lines = context.options.should_keep_lines
+    should_substitute = context.options.should_substitute
+    output = context.output
+    states = context.states
+
+    line_number = 0
+    substituter = None
+    for line in input_file:
+        line_number += 1
+        logger.debug("line %d: %r", line_number, line)
+        context.defines['__LINE__'] = line_number
+
+        # Is this line a preprocessor stmt line?
+        match = statement_matcher.match(line)
+
+        if match:
+            _process_statement(context, match, line)
+            substituter = None
+            if should_keep_lines:
+                output.write("\n")
+        else:
+            try:
+                if states[-1][0] == EMIT:
+                    logger.debug("emit line (%s)" % states[-1][1])
+                    # Substitute all defines into line.
+                    sline = line
+                    if should_substitute:
+                        if substituter is None:
+                            substituter = _get_substituter(
+                                context.defines, context.substitution_markers)
+                        sline = substituter.substitute(sline, context.defines)
+                    output.write(sline)
+                elif should_keep_lines:
+                    logger.debug("keep blank line (%s)" % states[-1][1])
+                    output.write("\n")
+                else:
+                    logger.debug("skip line (%s)" % states[-1][1])
+            except IndexError:
+                raise context.error("superfluous #endif before this line")
+
+
+def _iter_statement_candidates(text, statement_matcher, position=0):
+    """
+    Finds the lines of ``text`` that may be preprocessor statement lines
+    using a single multi-line search for comment prefixes.
+
+    :param position:
+        The offset of the line to start at.
+    :return:
+        A generator of (line-start-offset, line-end-offset) tuples where
+        the end offset is just past the newline character of the line.
+    """
+    scanner = statement_matcher.multiline_prefix_regexp
+    text_length = len(text)
+    while position < text_length:
+        match = scanner.search(text, position)
+        if not match:
+            break
+        # Only a regular expression comment prefix may match across
+        # lines, so the candidate is the line holding the `#'.
+        line_start = text.rfind("\n", 0, match.end() - 1) + 1
+        line_end = text.find("\n", match.end())
+        if line_end < 0:
+            line_end = text_length
+        else:
+            line_end += 1
+        yield line_start, line_end
+        position = line_end
+
+
+# Whitespace other than the newline character.
+_LINE_WHITESPACE_BYTES = [ord(c) for c in " \t\r\v\f"]
+
+
+def _iter_statement_candidates_numpy(text, comment_groups):
+    """
+    Finds the lines of ``text`` that may be preprocessor statement lines
+    using vectorized NumPy operations over the bytes of the input. A line
+    is a candidate if its first non-whitespace characters are a comment
+    prefix followed, after optional whitespace, by ``#``.
+
+    :return:
+        A list of (line-start-offset, line-end-offset) tuples where the
+        end offset is just past the newline character of the line.
+    """
+    data = numpy.frombuffer(text, dtype=numpy.uint8)
+    length = len(data)
+    newlines = numpy.flatnonzero(data == ord("\n"))
+    line_starts = numpy.concatenate(([0], newlines + 1))
+    line_ends = numpy.concatenate((newlines + 1, [length]))
+
+    whitespace = numpy.zeros(length, dtype=bool)
+    for byte in _LINE_WHITESPACE_BYTES:
+        whitespace |= data == byte
+    # A sentinel past the end keeps every lookup in bounds.
+    non_whitespace = numpy.append(numpy.flatnonzero(~whitespace), length)
+    padded = numpy.append(data, numpy.uint8(0))
+
+    def skip_whitespace(offsets):
+        return non_whitespace[numpy.searchsorted(non_whitespace, offsets)]
+
+    first = skip_whitespace(line_starts)
+    candidates = numpy.zeros(len(line_starts), dtype=bool)
+    for cprefix, csuffix in comment_groups:
+        matches = numpy.ones(len(line_starts), dtype=bool)
+        for i, c in enumerate(cprefix):
+            matches &= padded[numpy.minimum(first + i, length)] == ord(c)
+        hashes = skip_whitespace(numpy.minimum(first + len(cprefix), length))
+        matches &= padded[hashes] == ord("#")
+        candidates |= matches
+
+    indices = numpy.flatnonzero(candidates)
+    return zip(line_starts[indices].tolist(), line_ends[indices].tolist())
+
+
+def _can_use_numpy(comment_groups):
+    """
+    Determines whether NumPy is installed and all the comment prefixes
+    are plain strings that can be compared byte by byte.
+    """
+    if numpy is None:
+        return False
+    for cprefix, csuffix in comment_groups:
+        if hasattr(cprefix, "pattern"):
+            return False
+    return True
+
+
+def _scan_statements(text, statement_matcher, use_numpy=False):
+    """
+    Finds all preprocessor statement lines in ``text``.
+
+    :param use_numpy:
+        Find candidate lines with ``_iter_statement_candidates_numpy``.
+    :return:
+        A list of (line-number, line-start-offset, line-end-offset, line,
+        match) tuples in order of appearance.
+    """
+    if use_numpy:
+        candidates = _iter_statement_candidates_numpy(
+            text, statement_matcher.comment_groups)
+    else:
+        candidates = _iter_statement_candidates(text, statement_matcher)
+    return list(_iter_statements(text, statement_matcher, candidates))
+
+
+def _iter_statements(text, statement_matcher, candidates, line_number=1,
+                     position=0):
+    """
+    Matches candidate statement lines.
+
+    :param candidates:
+        An iterable of (line-start-offset, line-end-offset) tuples of
+        candidate lines at or after ``position``.
+    :param line_number:
+        The line number of the line at offset ``position``.
+    :return:
+        A generator of (line-number, line-start-offset, line-end-offset,
+        line, match) tuples of the statement lines.
+    """
+    for line_start, line_end in candidates:
+        line = text[line_start:line_end]
+        match = statement_matcher.match(line)
+        if match:
+            line_number += text.count("\n", position, line_start)
+            position = line_start
+            yield line_number, line_start, line_end, line, match
+
+
+def _build_jump_table(statements):
+    """
+    Pairs every #if, #ifdef, #ifndef, #elif and #else statement with the
+    next #elif, #else or #endif statement of the same #if block, so that
+    a skipped branch can be passed over without looking at its contents.
+
+    A branch is only paired if nothing in it could raise an error while it
+    is being skipped, that is, if no #if block nested within it has an
+    #elif or #else after its #else.
+
+    :param statements:
+        A list of statements as returned by ``_scan_statements``.
+    :return:
+        A dictionary mapping the index of a statement to the index of the
+        statement that ends its branch.
+
+    Usage::
+
+        >>> m = StatementMatcher([['#', '']])
+        >>> text = "# #if A\\n# #if B\\n# #endif\\n# #else\\nx\\n# #endif\\n"
+        >>> sorted(_build_jump_table(_scan_statements(text, m)).items())
+        [(0, 3), (1, 2), (3, 4)]
+    """
+    jump_table = {}
+    # Each open block is [<index-of-branch-statement>, <have-seen-else>,
+    #                     <branch-is-safe-to-skip>, <block-is-safe-to-skip>].
+    blocks = []
+    for index, statement in enumerate(statements):
+        op = statement[4].group("op")
+        if op in ("if", "ifdef", "ifndef"):
+            blocks.append([index, False, True, True])
+        elif op in ("elif", "else", "endif") and blocks:
+            block = blocks[-1]
+            if block[2]:
+                jump_table[block[0]] = index
+            if op == "endif":
+                blocks.pop()
+                if blocks and not block[3]:
+                    blocks[-1][2] = blocks[-1][3] = False
+            else:
+                if block[1]:
+                    # An #elif or #else after #else is an error even
+                    # within a skipped branch.
+                    block[3] = False
+                block[0] = index
+                block[1] = block[1] or op == "else"
+                block[2] = True
+    return jump_table
+
+
+def _preprocess_buffer(text, statement_matcher, context, use_numpy=False):
+    """
+    The buffer engine. Works on the entire input text at once, finds all
+    statement lines with a multi-line search and emits the literal text
+    between statements as whole slices. Skipped branches of #if blocks
+    are passed over using a jump table built from the statements.
+    Produces the same output and error line numbers as the line engine.
+
+    With ``use_numpy``, the ``numpy`` engine, the candidate lines are
+    found with ``_iter_statement_candidates_numpy`` instead. The ``numpy``
+    engine falls back to the buffer engine if NumPy is not installed or
+    a comment prefix is a regular expression.
+    """
+    should_keep_lines = context.options.should_keep_lines
+    output = context.output
+    states = context.states
+
+    statements = _scan_statements(text, statement_matcher, use_numpy)
+    jump_table = _build_jump_table(statements)
+    # Offset and line number of the first pending literal line.
+    literal_start = 0
+    literal_line_number = 1
+    index = 0
+    while index < len(statements):
+        line_number, line_start, line_end, line, match = statements[index]
+        if line_start > literal_start:
+            _write_literal_block(text[literal_start:line_start],
+                                 literal_line_number, context)
+        context.defines['__LINE__'] = line_number
+        logger.debug("line %d: %r", line_number, line)
+        _process_statement(context, match, line)
+        if should_keep_lines:
+            output.write("\n")
+        literal_start = line_end
+        literal_line_number = line_number + 1
+        index += 1
+        if states and states[-1][0] == SKIP and (index - 1) in jump_table:
+            # Jump to the statement that ends the skipped branch.
+            index = jump_table[index - 1]
+            next_line_number, literal_start = statements[index][:2]
+            logger.debug("skip lines %d-%d (%s)", literal_line_number,
+                         next_line_number - 1, states[-1][1])
+            if should_keep_lines:
+                output.write("\n" * (next_line_number - literal_line_number))
+            literal_line_number = next_line_number
+    if literal_start < len(text):
+        _write_literal_block(text[literal_start:], literal_line_number, context)
+
+
+def _split_lines(text):
+    """
+    Splits text into lines keeping the newline characters. Unlike
+    ``str.splitlines``, only ``\\n`` ends a line, as with ``readlines()``.
+
+    Usage::
+
+        >>> _split_lines("a\\rb\\nc\\n\\nd")
+        ['a\\rb\\n', 'c\\n', '\\n', 'd']
+        >>> _split_lines("a\\n")
+        ['a\\n']
+    """
+    lines = [line + "\n" for line in text.split("\n")]
+    last_line = lines.pop()[:-1]
+    if last_line:
+        lines.append(last_line)
+    return lines
+
+
+def _write_literal_block(block, first_line_number, context):
+    """
+    Writes a block of non-statement lines for the buffer engine, leaving
+    ``defines['__LINE__']`` at the last line of the block just as the line
+    engine would.
+    """
+    output = context.output
+    states = context.states
+    defines = context.defines
+    line_count = block.count("\n")
+    if not block.endswith("\n"):
+        line_count += 1
+    last_line_number = first_line_number + line_count - 1
+    if not states:
+        defines['__LINE__'] = first_line_number
+        raise context.error("superfluous #endif before this line")
+    if states[-1][0] == EMIT:
+        logger.debug("emit lines %d-%d (%s)", first_line_number,
+                     last_line_number, states[-1][1])
+        if (context.options.should_substitute
+            and isinstance(output, _SubstitutionSpans)):
+            defines['__LINE__'] = first_line_number
+            output.write_span(block, first_line_number, defines,
+                              context.substitution_markers)
+        elif context.options.should_substitute:
+            line_number = first_line_number
+            substituter = None
+            for line in _split_lines(block):
+                defines['__LINE__'] = line_number
+                if substituter is None:
+                    substituter = _get_substituter(
+                        defines, context.substitution_markers)
+                output.write(substituter.substitute(line, defines))
+                line_number += 1
+        else:
+            output.write(block)
+    elif context.options.should_keep_lines:
+        logger.debug("keep blank lines %d-%d (%s)", first_line_number,
+                     last_line_number, states[-1][1])
+        output.write("\n" * line_count)
+    else:
+        logger.debug("skip lines %d-%d (%s)", first_line_number,
+                     last_line_number, states[-1][1])
+    defines['__LINE__'] = last_line_number
+
+
+# Nodes of a parsed template.
+#
+# A run of lines that are not preprocessor statements.
+Literal = namedtuple("Literal", ["text", "line_number"])
+# A statement other than those forming #if blocks. ``value`` holds the
+# value of a #define statement as a 1-tuple if it is a literal that
+# needs no evaluation.
+Statement = namedtuple("Statement", ["line_number", "line", "groups", "value"])
+# An #if block as a list of (statement, nodes) branches for its #if, #elif
+# and #else statements followed by its #endif statement.
+Conditional = namedtuple("Conditional", ["branches", "end"])
+
+
+class Template(object):
+    """
+    A preprocessor input parsed into a tree of literal text, statements
+    and #if blocks that can be rendered any number of times without
+    matching its lines again.
+
+    :ivar filename:
+        The path of the parsed file.
+    :ivar comment_groups:
+        The comment groups the file was parsed with.
+    :ivar nodes:
+        The list of top-level nodes, or ``None`` if the #if blocks of the
+        input are not properly nested. Such templates keep their ``text``
+        and are rendered by the buffer engine, which reports the error
+        where the line engine would.
+    :ivar text:
+        The input text of a template without ``nodes``.
+    """
+
+    def __init__(self, filename, comment_groups, nodes, text=None):
+        self.filename = filename
+        self.comment_groups = comment_groups
+        self.nodes = nodes
+        self.text = text
+        # Render functions from ``compile_template()`` keyed by options.
+        self.render_functions = {}
+        # The ``TemplateSummary`` from ``get_template_summary()``.
+        self.summary = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Functions cannot be pickled.
+        del state['render_functions']
+        return state
+
+    def __setstate__(self, state):
+        self.summary = None
+        self.__dict__.update(state)
+        self.render_functions = {}
+
+
+def _make_template_statement(line_number, line, match):
+    groups = match.groupdict()
+    value = None
+    if groups['op'] == 'define':
+        if groups['val'] is None:
+            value = (None,)
+        else:
+            value = _parse_define_literal(groups['val'])
+    return Statement(line_number, line, groups, value)
+
+
+def parse_template(text, comment_groups, filename=None):
+    """
+    Parses preprocessor input into a ``Template``.
+
+    :param text:
+        The input text.
+    :param comment_groups:
+        A list of (comment-prefix, comment-suffix) pairs.
+    :param filename:
+        The path of the input.
+    :return:
+        A ``Template`` instance.
+
+    Usage::
+
+        >>> t = parse_template("a\\n# #if A\\nb\\n# #else\\nc\\n# #endif\\n",
+        ...                    [['#', '']])
+        >>> t.nodes[0]
+        Literal(text='a\\n', line_number=1)
+        >>> [(s.line_number, [n.text for n in nodes])
+        ...  for s, nodes in t.nodes[1].branches]
+        [(2, ['b\\n']), (4, ['c\\n'])]
+        >>> t.nodes[1].end.line_number
+        6
+        >>> parse_template("# #endif\\n", [['#', '']]).nodes is None
+        True
+    """
+    statement_matcher = get_statement_matcher(comment_groups)
+    statements = _scan_statements(text, statement_matcher)
+    nodes = []
+    # Each open #if block is (<enclosing-nodes>, <branches>, <have-seen-else>).
+    blocks = []
+    literal_start = 0
+    literal_line_number = 1
+    for line_number, line_start, line_end, line, match in statements:
+        if line_start > literal_start:
+            nodes.append(Literal(text[literal_start:line_start],
+                                 literal_line_number))
+        literal_start = line_end
+        literal_line_number = line_number + 1
+        statement = _make_template_statement(line_number, line, match)
+        op = statement.groups['op']
+        if op in ("if", "ifdef", "ifndef"):
+            branches = [(statement, [])]
+            blocks.append((nodes, branches, False))
+            nodes = branches[-1][1]
+        elif op in ("elif", "else"):
+            if not blocks or blocks[-1][2]:
+                return Template(filename, comment_groups, None, text)
+            enclosing_nodes, branches, seen_else = blocks.pop()
+            branches.append((statement, []))
+            blocks.append((enclosing_nodes, branches, op == "else"))
+            nodes = branches[-1][1]
+        elif op == "endif":
+            if not blocks:
+                return Template(filename, comment_groups, None, text)
+            nodes, branches, seen_else = blocks.pop()
+            nodes.append(Conditional(branches, statement))
+        else:
+            nodes.append(statement)
+    if blocks:
+        return Template(filename, comment_groups, None, text)
+    if literal_start < len(text):
+        nodes.append(Literal(text[literal_start:], literal_line_number))
+    return Template(filename, comment_groups, nodes)
+
+
+def _get_template_cache_key(input_file, comment_groups, input_file_absolute_path):
+    """
+    Returns the key of the template of a file in ``template_cache`` or
+    ``None`` if the input is not a regular file.
+    """
+    try:
+        stat_result = os.fstat(input_file.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    return (input_file_absolute_path,
+            stat_result.st_mtime,
+            stat_result.st_size,
+            _freeze_comment_groups(comment_groups))
+
+
+def get_disk_cache(directory, size_limit=DEFAULT_CACHE_SIZE_LIMIT):
+    """
+    Returns the ``DiskCache`` of parsed templates stored in a directory.
+
+    :param directory:
+        The cache directory.
+    :param size_limit:
+        The size limit of the cache in megabytes.
+    :return:
+        A ``DiskCache`` instance, the same one for every call with the
+        same arguments.
+    """
+    key = (absolute_path(directory), size_limit)
+    disk_cache = _disk_caches.get(key)
+    if disk_cache is None:
+        disk_cache = DiskCache(key[0], maxsize=size_limit * 1024 * 1024)
+        _disk_caches[key] = disk_cache
+    return disk_cache
+
+
+def get_output_cache(directory, size_limit=DEFAULT_CACHE_SIZE_LIMIT):
+    """
+    Returns the ``DiskCache`` of preprocessed outputs, which is kept in
+    the ``outputs`` subdirectory of a cache directory.
+
+    :param directory:
+        The cache directory.
+    :param size_limit:
+        The size limit of the output cache in megabytes.
+    """
+    return get_disk_cache(os.path.join(directory, "outputs"), size_limit)
+
+
+def _get_template_disk_cache_key(text, comment_groups):
+    """
+    Returns the key of the template of ``text`` in a ``DiskCache``. The key
+    depends on the text, the comment groups, the statement patterns,
+    including those of statements registered with
+    ``register_statement_handler()``, and the version of pepe.
+
+        >>> key = _get_template_disk_cache_key("# #note hello\\n", [['#', '']])
+        >>> register_statement_handler("note", lambda *args: None)
+        >>> key == _get_template_disk_cache_key("# #note hello\\n", [['#', '']])
+        False
+        >>> unregister_statement_handler("note")
+        >>> key == _get_template_disk_cache_key("# #note hello\\n", [['#', '']])
+        True
+    """
+    digest = hashlib.sha1()
+    digest.update(__version__)
+    digest.update(repr(_freeze_comment_groups(comment_groups)))
+    digest.update(repr(PREPROCESSOR_STATEMENT_REGEXP_PATTERNS))
+    digest.update(text)
+    return digest.hexdigest()
+
+
+def get_template(input_file,
+                 comment_groups,
+                 input_file_absolute_path=None,
+                 disk_cache=None):
+    """
+    Returns the ``Template`` of an input file, reusing the one in
+    ``template_cache`` if the file has not changed since it was parsed.
+    A file is considered unchanged as long as its modification time and
+    size stay the same. Use ``template_cache.info()`` to inspect the
+    number of cache hits and misses.
+
+    Templates not found in ``template_cache`` are looked up by the
+    content of the file in ``disk_cache``, if given, before parsing.
+
+    :param input_file:
+        The input file (NOT path).
+    :param comment_groups:
+        A list of (comment-prefix, comment-suffix) pairs.
+    :param input_file_absolute_path:
+        The absolute path of the input file. Determined from
+        ``input_file.name`` if not specified.
+    :param disk_cache:
+        A ``DiskCache`` as returned by ``get_disk_cache()`` or ``None``.
+    :return:
+        A ``Template`` instance.
+    """
+    if input_file_absolute_path is None:
+        input_file_absolute_path = absolute_path(input_file.name)
+    key = _get_template_cache_key(input_file, comment_groups,
+                                  input_file_absolute_path)
+    if key is not None:
+        template = template_cache.get(key)
+        if template is not None:
+            return template
+    text = input_file.read()
+    template = None
+    if disk_cache is not None:
+        disk_cache_key = _get_template_disk_cache_key(text, comment_groups)
+        template = disk_cache.get(disk_cache_key)
+        if template is not None:
+            template.filename = input_file.name
+    if template is None:
+        template = parse_template(text, comment_groups, input_file.name)
+        if disk_cache is not None:
+            disk_cache[disk_cache_key] = template
+    if key is not None:
+        template_cache[key] = template
+    return template
+
+
+def _render_template(template, context):
+    """
+    The template engine. Renders a ``Template`` producing the same output
+    and errors as the line engine. Templates come from ``get_template()``,
+    which keeps them in ``template_cache`` and, with ``options.cache_dir``,
+    on disk, so that an unchanged file is only parsed once.
+    """
+    if template.nodes is None:
+        logger.debug("'%s' has unbalanced #if blocks; using the buffer "
+                     "engine", template.filename)
+        _preprocess_buffer(template.text,
+                           get_statement_matcher(template.comment_groups),
+                           context)
+    else:
+        _render_nodes(template.nodes, context)
+
+
+def _render_statement(statement, context):
+    context.defines['__LINE__'] = statement.line_number
+    groups = statement.groups
+    if groups['op'] == 'define' and STATEMENT_HANDLERS['define'] is _handle_define:
+        # Skips matching the value against the literal regular expressions.
+        if statement.value is not None:
+            value = statement.value[0]
+        else:
+            value = _evaluate_define_value(groups['val'], _is_safe(context))
+        context.defines[groups['var']] = value
+    else:
+        _process_statement(context, StatementMatch(statement.groups),
+                           statement.line)
+    if context.options.should_keep_lines:
+        context.output.write("\n")
+
+
+def _render_nodes(nodes, context):
+    """
+    Renders the nodes of an emitted section of a template.
+    """
+    should_keep_lines = context.options.should_keep_lines
+    states = context.states
+    for node in nodes:
+        if type(node) is Literal:
+            _write_literal_block(node.text, node.line_number, context)
+        elif type(node) is Statement:
+            _render_statement(node, context)
+        else:
+            branches = node.branches
+            for index, (statement, branch_nodes) in enumerate(branches):
+                _render_statement(statement, context)
+                if states[-1][0] == EMIT:
+                    _render_nodes(branch_nodes, context)
+                else:
+                    if index + 1 < len(branches):
+                        next_line_number = branches[index + 1][0].line_number
+                    else:
+                        next_line_number = node.end.line_number
+                    logger.debug("skip lines %d-%d (%s)",
+                                 statement.line_number + 1,
+                                 next_line_number - 1, states[-1][1])
+                    if should_keep_lines:
+                        context.output.write(
+                            "\n" * (next_line_number - statement.line_number - 1))
+            _render_statement(node.end, context)
+
+
+def _render_statement_for_variants(statement, contexts, errors):
+    """
+    Renders a statement for each context, leaving out the contexts it
+    fails for and recording their errors in ``errors``.
+    """
+    rendered_contexts = []
+    for context in contexts:
+        try:
+            _render_statement(statement, context)
+        except PreprocessorError, ex:
+            errors[context] = ex
+        else:
+            rendered_contexts.append(context)
+    return rendered_contexts
+
+
+def _render_nodes_for_variants(nodes, contexts, errors):
+    """
+    Renders the nodes of an emitted section of a template for several
+    contexts at once, as ``_render_nodes`` does for one. The branches of
+    an #if block are rendered once for all the contexts that take them.
+
+    :return:
+        The contexts that did not fail.
+    """
+    should_keep_lines = contexts[0].options.should_keep_lines
+    for node in nodes:
+        if not contexts:
+            break
+        if type(node) is Literal:
+            for context in contexts:
+                _write_literal_block(node.text, node.line_number, context)
+        elif type(node) is Statement:
+            contexts = _render_statement_for_variants(node, contexts, errors)
+        else:
+            branches = node.branches
+            for index, (statement, branch_nodes) in enumerate(branches):
+                contexts = _render_statement_for_variants(statement, contexts,
+                                                          errors)
+                if index + 1 < len(branches):
+                    next_line_number = branches[index + 1][0].line_number
+                else:
+                    next_line_number = node.end.line_number
+                emitting_contexts = []
+                for context in contexts:
+                    if context.states[-1][0] == EMIT:
+                        emitting_contexts.append(context)
+                    elif should_keep_lines:
+                        context.output.write(
+                            "\n" * (next_line_number - statement.line_number - 1))
+                if emitting_contexts:
+                    _render_nodes_for_variants(branch_nodes,
+                                               emitting_contexts, errors)
+                    contexts = [context for context in contexts
+                                if context not in errors]
+            contexts = _render_statement_for_variants(node.end, contexts,
+                                                      errors)
+    return contexts
+
+
+def _is_known_name(name, defines, defined_names):
+    if name in defines:
+        return True
+    # Names that are not defines are looked up in the built-ins, unless
+    # a define by that name is checked for with defined().
+    return ((name == 'defined' or hasattr(__builtin__, name))
+            and name not in defined_names)
+
+
+def _partially_evaluate_condition(op, expression, defines, safe=False):
+    """
+    Evaluates the condition of an #if, #ifdef, #ifndef or #elif statement
+    if it only reads names that are defined.
+
+    :return:
+        ``True`` or ``False``, or ``None`` if the condition depends on
+        names that are not defined.
+
+    Usage::
+
+        >>> _partially_evaluate_condition("if", "A > 1", {'A': 2})
+        True
+        >>> _partially_evaluate_condition("if", "A > 1 and B", {'A': 2}) is None
+        True
+        >>> _partially_evaluate_condition("ifndef", "A", {'A': 2})
+        False
+        >>> _partially_evaluate_condition("ifdef", "B", {'A': 2}) is None
+        True
+        >>> _partially_evaluate_condition("if", "defined('len')", {}) is None
+        True
+    """
+    if op in ("ifdef", "ifndef") and "'" not in expression \
+            and "\\" not in expression:
+        if expression not in defines:
+            return None
+        return op == "ifdef"
+    expression_names = analyze_expression(expression)
+    if expression_names is None:
+        return None
+    for name in expression_names.names:
+        if not _is_known_name(name, defines, expression_names.defined_names):
+            return None
+    for name in expression_names.defined_names:
+        if name not in defines:
+            return None
+    if op == "elif":
+        op = "if"
+    return bool(_evaluate_condition(op, expression, defines, safe))
+
+
+def _rewrite_statement_line(statement, op, expression=None):
+    """
+    Changes the operator of a statement line, replacing its expression if
+    ``expression`` is given and keeping the comment delimiters.
+
+    Usage::
+
+        >>> m = StatementMatcher([['<!--', '-->']])
+        >>> line = "<!--  #elif A > 1 -->\\n"
+        >>> s = _make_template_statement(3, line, m.match(line))
+        >>> _rewrite_statement_line(s, "if")
+        '<!--  #if A > 1 -->\\n'
+        >>> _rewrite_statement_line(s, "else", "")
+        '<!--  #else -->\\n'
+    """
+    line = statement.line
+    old_op = statement.groups['op']
+    head = re.search(r"#\s*(%s)\b" % old_op, line)
+    op_start, op_end = head.span(1)
+    if expression is None:
+        return line[:op_start] + op + line[op_end:]
+    old_expression = statement.groups['expr']
+    expression_end = line.index(old_expression, op_end) + len(old_expression)
+    if expression:
+        expression = " " + expression
+    return line[:op_start] + op + expression + line[expression_end:]
+
+
+def _partially_render_template(template, context):
+    """
+    Renders a template evaluating only the #if blocks whose conditions
+    depend on defined names alone. Other #if blocks are kept in the output
+    along with their statement lines, and so are #define and #undef
+    statements, so that the output can be preprocessed again with more
+    names defined. Substitution is left to that final pass.
+    """
+    if template.nodes is None:
+        _render_template(template, context)
+    else:
+        _partially_render_nodes(template.nodes, context)
+
+
+def _get_nodes_text(nodes):
+    """
+    Returns the input text that template nodes were parsed from.
+    """
+    text = []
+    for node in nodes:
+        if type(node) is Literal:
+            text.append(node.text)
+        elif type(node) is Statement:
+            text.append(node.line)
+        else:
+            for statement, branch_nodes in node.branches:
+                text.append(statement.line)
+                text.append(_get_nodes_text(branch_nodes))
+            text.append(node.end.line)
+    return "".join(text)
+
+
+def _forget_defines(defines):
+    """
+    Removes all defines when it can no longer be known which names are
+    defined.
+    """
+    for name in defines.keys():
+        if name not in ('__FILE__', '__LINE__'):
+            del defines[name]
+
+
+def _partially_render_nodes(nodes, context):
+    should_keep_lines = context.options.should_keep_lines
+    for node in nodes:
+        if type(node) is Literal:
+            context.output.write(node.text)
+            line_count = node.text.count("\n")
+            if not node.text.endswith("\n"):
+                line_count += 1
+            context.defines['__LINE__'] = node.line_number + line_count - 1
+        elif type(node) is Statement:
+            groups = node.groups
+            op = groups['op']
+            context.defines['__LINE__'] = node.line_number
+            if op in ('define', 'undef'):
+                _process_statement(context, StatementMatch(groups), node.line)
+                context.output.write(node.line)
+            elif (op == 'include' and 'var' in groups
+                  and groups['var'] not in context.defines):
+                context.output.write(node.line)
+                # The #include'd file may define anything.
+                _forget_defines(context.defines)
+            else:
+                _process_statement(context, StatementMatch(groups), node.line)
+                if should_keep_lines:
+                    context.output.write("\n")
+        else:
+            _partially_render_conditional(node, context)
+
+
+def _partially_render_conditional(conditional, context):
+    should_keep_lines = context.options.should_keep_lines
+    output = context.output
+    # The branches that remain as (statement-line, nodes) pairs, and with
+    # ``should_keep_lines`` the empty lines of the branches dropped after
+    # them as (lines, None) pairs.
+    kept_branches = []
+    taken_nodes = None
+    branches = conditional.branches
+    for index, (statement, nodes) in enumerate(branches):
+        if index + 1 < len(branches):
+            next_line_number = branches[index + 1][0].line_number
+        else:
+            next_line_number = conditional.end.line_number
+        op = statement.groups['op']
+        context.defines['__LINE__'] = statement.line_number
+        if taken_nodes is not None:
+            condition = False
+        elif op == 'else':
+            condition = True
+        else:
+            condition = _partially_evaluate_condition(
+                op, statement.groups['expr'], context.defines,
+                _is_safe(context))
+        if condition is None:
+            if kept_branches or op != 'elif':
+                line = statement.line
+            else:
+                line = _rewrite_statement_line(statement, 'if')
+            kept_branches.append((line, nodes))
+        elif condition:
+            taken_nodes = nodes
+            if kept_branches:
+                if op == 'else':
+                    line = statement.line
+                else:
+                    line = _rewrite_statement_line(statement, 'else', '')
+                kept_branches.append((line, nodes))
+            else:
+                if should_keep_lines:
+                    output.write("\n")
+                _partially_render_nodes(nodes, context)
+        elif should_keep_lines:
+            lines = "\n" * (next_line_number - statement.line_number)
+            if kept_branches:
+                # They follow the kept branches, which are written last.
+                kept_branches.append((lines, None))
+            else:
+                output.write(lines)
+    if kept_branches:
+        _partially_render_kept_branches(kept_branches, context)
+        output.write(conditional.end.line)
+    elif should_keep_lines:
+        output.write("\n")
+    context.defines['__LINE__'] = conditional.end.line_number
+
+
+def _partially_render_kept_branches(kept_branches, context):
+    """
+    Renders each branch of an #if block that could not be evaluated as if
+    it were taken. Names any of them change are no longer known after the
+    #if block.
+    """
+    output = context.output
+    defines = context.defines
+    preprocessed_file_count = len(context.preprocessed_files)
+    changed_names = set()
+    is_opaque = False
+    for line, nodes in kept_branches:
+        output.write(line)
+        if nodes is None:
+            # The empty lines of a dropped branch.
+            continue
+        context.defines = DefineEnvironment(defines)
+        context.output = StringIO()
+        try:
+            _partially_render_nodes(nodes, context)
+            output.write(context.output.getvalue())
+        except PreprocessorError, ex:
+            # The branch may never be taken, so its errors are left to the
+            # final pass.
+            logger.debug("keeping branch with error: %s", ex)
+            output.write(_get_nodes_text(nodes))
+            is_opaque = True
+        context.output.close()
+        context.output = output
+        # Only one of the branches will be taken, so each may #include
+        # the same files.
+        del context.preprocessed_files[preprocessed_file_count:]
+        branch_defines = context.defines
+        if isinstance(branch_defines, DefineEnvironment):
+            names = branch_defines.written_names
+        else:
+            # A handler replaced the defines.
+            names = set(defines) | set(branch_defines)
+        for name in names:
+            if defines.get(name, _missing) is not branch_defines.get(name, _missing):
+                changed_names.add(name)
+    context.defines = defines
+    if is_opaque:
+        _forget_defines(defines)
+    for name in changed_names:
+        if name not in ('__FILE__', '__LINE__'):
+            defines.pop(name, None)
+
+
+# Marks a name missing from a dictionary of defines.
+_missing = object()
+
+
+def _iter_template_statements(nodes, literals):
+    """
+    Yields all statements of template nodes, in every branch of every #if
+    block, and appends the text of all literal nodes to ``literals``.
+    """
+    for node in nodes:
+        if type(node) is Literal:
+            literals.append(node.text)
+        elif type(node) is Statement:
+            yield node
+        else:
+            for statement, branch_nodes in node.branches:
+                yield statement
+                for nested_statement in _iter_template_statements(branch_nodes,
+                                                                  literals):
+                    yield nested_statement
+            yield node.end
+
+
+# What a template reads and #includes, in any branch of its #if blocks.
+# ``names`` is ``None`` if an expression cannot be analyzed. ``includes``
+# holds the file names of ``#include "path"`` statements and the variables
+# of ``#include VAR`` statements as (file-name, variable) pairs.
+# ``define_values`` holds the (name, parsed-value, value-text) triples of
+# #define statements, where ``parsed-value`` is the ``Statement.value``.
+TemplateSummary = namedtuple("TemplateSummary", ["names", "defined_names",
+                                                 "includes", "literal_text",
+                                                 "define_values"])
+
+
+def _get_template_statements(template):
+    """
+    Returns all statements of a template and its literal text.
+    """
+    if template.nodes is None:
+        statement_matcher = get_statement_matcher(template.comment_groups)
+        statements = [_make_template_statement(line_number, line, match)
+                      for line_number, line_start, line_end, line, match
+                      in _scan_statements(template.text, statement_matcher)]
+        return statements, template.text
+    literals = []
+    statements = list(_iter_template_statements(template.nodes, literals))
+    return statements, "".join(literals)
+
+
+def get_template_summary(template):
+    """
+    Returns the ``TemplateSummary`` of a template, which is computed once
+    and kept with the template.
+
+    Usage::
+
+        >>> t = parse_template("# #if A and defined('B')\\n# #define C 1\\n"
+        ...                    "# #include D\\nC\\n# #endif\\n", [['#', '']])
+        >>> s = get_template_summary(t)
+        >>> sorted(s.names), sorted(s.defined_names), s.includes
+        (['A', 'B', 'defined'], ['C'], [(None, 'D')])
+        >>> s.literal_text
+        'C\\n'
+    """
+    if template.summary is not None:
+        return template.summary
+    statements, literal_text = _get_template_statements(template)
+    names = set()
+    defined_names = set()
+    includes = []
+    define_values = []
+    for statement in statements:
+        groups = statement.groups
+        op = groups['op']
+        if op in ('if', 'elif'):
+            expression_names = get_expression_names(groups['expr'])
+            if expression_names is None:
+                names = None
+            elif names is not None:
+                names.update(expression_names)
+        elif op in ('ifdef', 'ifndef'):
+            if "'" in groups['expr'] or "\\" in groups['expr']:
+                names = None
+            elif names is not None:
+                names.add(groups['expr'])
+        elif op == 'define':
+            defined_names.add(groups['var'])
+            define_values.append((groups['var'], statement.value,
+                                  groups['val']))
+        elif op == 'include':
+            if 'var' in groups:
+                includes.append((None, groups['var']))
+            else:
+                includes.append((groups['fname'], None))
+    template.summary = TemplateSummary(names, defined_names, includes,
+                                       literal_text, define_values)
+    return template.summary
+
+
+def _get_template_disk_cache(options):
+    """
+    Returns the ``DiskCache`` of parsed templates in ``options.cache_dir``
+    or ``None`` if no cache directory is set.
+    """
+    cache_dir = getattr(options, 'cache_dir', None)
+    if not cache_dir:
+        return None
+    return get_disk_cache(cache_dir, getattr(options, 'cache_size_limit',
+                                             DEFAULT_CACHE_SIZE_LIMIT))
+
+
+def _get_file_template(filename, path, comment_groups, disk_cache):
+    with open(filename, 'rb') as input_file:
+        return get_template(input_file, comment_groups, path, disk_cache)
+
+
+def _walk_included_files(input_filename, options, content_types_db, defines):
+    """
+    Yields a file and every file it can #include, in any branch of its
+    #if blocks. Files of ``#include VAR`` statements are only followed if
+    ``VAR`` is in ``defines``.
+
+    :return:
+        An iterator of (filename, absolute-path, comment-groups,
+        template-summary) tuples.
+    """
+    disk_cache = _get_template_disk_cache(options)
+    pending_filenames = [input_filename]
+    seen_paths = set()
+    while pending_filenames:
+        filename = pending_filenames.pop()
+        path = absolute_path(filename)
+        if path in seen_paths:
+            continue
+        seen_paths.add(path)
+        comment_groups = content_types_db.get_comment_group_for_path(
+            filename, options.default_content_type)
+        template = _get_file_template(filename, path, comment_groups,
+                                      disk_cache)
+        summary = get_template_summary(template)
+        include_paths = []
+        for include_filename, var in summary.includes:
+            if var is not None:
+                if var not in defines:
+                    continue
+                include_filename = defines[var]
+            include_path = _find_include_file(include_filename, filename,
+                                              options.include_paths)
+            if include_path is not None:
+                include_paths.append(include_path)
+        pending_filenames.extend(reversed(include_paths))
+        yield filename, path, comment_groups, summary
+
+
+def _get_substituted_names(text, values):
+    """
+    Returns the names that substitution can find in a text, directly or
+    in the values substituted for other names.
+
+    :param values:
+        A dictionary of the strings that each name can be substituted
+        with.
+
+    Usage::
+
+        >>> values = {'AA': ['B'], 'B': ['C', 'D'], 'C': [], 'D': [], 'E': []}
+        >>> sorted(_get_substituted_names("AA", values))
+        ['AA', 'B', 'C', 'D']
+    """
+    found_names = set()
+    texts = [text]
+    while texts:
+        text = texts.pop()
+        for name, name_values in values.iteritems():
+            if name not in found_names and name in text:
+                found_names.add(name)
+                texts.extend(name_values)
+    return found_names
+
+
+def get_symbols_read(input_filename,
+                     options,
+                     content_types_db,
+                     defines=None,
+                     _files=None):
+    """
+    Determines the names of the defines that preprocessing a file can
+    read, in any branch of its #if blocks and in the files it #includes:
+    the names in #if and #elif expressions, the targets of #ifdef and
+    #ifndef, the variables of ``#include VAR`` statements and, with
+    ``options.should_substitute``, the names of defines that occur in
+    literal text or in the values that can be substituted for those. The
+    output of the file only depends on the values of these defines.
+
+    :param input_filename:
+        The input path.
+    :param options:
+        A ``Namespace`` of command-line options.
+    :param content_types_db:
+        An instance of ``ContentTypesDatabase``.
+    :param defines:
+        The dictionary of defines the file would be preprocessed with.
+        Used to find the files of ``#include VAR`` statements and as
+        candidates for substitution.
+    :param _files:
+        (for internal use only) a list that (absolute-path,
+        modification-time, size, comment-groups) tuples of the files
+        that were analyzed are appended to.
+    :return:
+        A set of names, or ``None`` if the names cannot be determined
+        because an expression cannot be analyzed or the file of an
+        ``#include VAR`` statement is unknown.
+    """
+    if defines is None:
+        defines = {}
+    names = set()
+    defined_names = set(defines)
+    literals = []
+    filenames = []
+    define_values = []
+    for filename, path, comment_groups, summary in _walk_included_files(
+            input_filename, options, content_types_db, defines):
+        if summary.names is None:
+            return None
+        filenames.append(filename)
+        define_values.extend(summary.define_values)
+        if _files is not None:
+            stat_result = os.stat(path)
+            _files.append((path, stat_result.st_mtime, stat_result.st_size,
+                           _freeze_comment_groups(comment_groups)))
+        names.update(summary.names)
+        defined_names.update(summary.defined_names)
+        for include_filename, var in summary.includes:
+            if var is not None:
+                names.add(var)
+                if var not in defines:
+                    return None
+        literals.append(summary.literal_text)
+    if options.should_substitute:
+        safe = bool(getattr(options, 'should_evaluate_safely', False))
+        values = dict((name, []) for name in defined_names)
+        try:
+            for name, value in defines.iteritems():
+                values[name].append(str(value))
+            for name, value, value_text in define_values:
+                if value is None:
+                    value = (_evaluate_define_value(value_text, safe),)
+                values[name].append(str(value[0]))
+        except Exception, ex:
+            logger.debug("cannot convert a define value to a string: %s", ex)
+            return None
+        values.setdefault('__FILE__', []).extend(filenames)
+        names.update(_get_substituted_names("".join(literals), values))
+    # Names of built-ins are only read if they are defined.
+    names = set(name for name in names
+                if name in defined_names or not (name == 'defined' or
+                                                 hasattr(__builtin__, name)))
+    names.discard('__FILE__')
+    names.discard('__LINE__')
+    return names
+
+
+_IMMUTABLE_TYPES = (types.NoneType, bool, int, long, float, str, unicode)
+
+
+def _get_include_cache_key(filename, context):
+    """
+    Returns the key of the expansion of an #include'd file in
+    ``include_cache``, or ``None`` if it cannot be memoized. The key holds
+    the paths, modification times, sizes and comment groups of the file
+    and the files it can #include, the options that affect the output and
+    the values of the defines the file can read.
+    """
+    options = context.options
+    if (_custom_statement_ops or not _has_default_statement_handlers()
+        or getattr(options, 'should_partially_evaluate', False)):
+        return None
+    files = []
+    names = get_symbols_read(filename, options, context.content_types_db,
+                             context.defines, _files=files)
+    if names is None:
+        return None
+    defines = context.defines
+    values = tuple((name, name in defines, defines.get(name))
+                   for name in sorted(names))
+    key = (tuple(files), bool(options.should_keep_lines),
+           bool(options.should_substitute),
+           bool(getattr(options, 'should_substitute_markers', False)),
+           bool(getattr(options, 'should_evaluate_safely', False)), values)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _preprocess_include(filename, context):
+    """
+    Preprocesses an #include'd file into the output of the including file.
+    With ``options.should_memoize_includes`` the output and the changes
+    to the defines are kept in ``include_cache`` and reused whenever the
+    file is #include'd again with the same values of the defines it reads.
+    The prelude named by ``options.prelude`` or ``options.prelude_snapshot``
+    is handled by ``_preprocess_prelude``.
+    """
+    options = context.options
+    if (getattr(options, 'prelude_snapshot', None)
+        and _is_prelude(filename, options)):
+        _preprocess_prelude(filename, context)
+        return
+
+    if not getattr(options, 'should_memoize_includes', False):
+        with open(filename, 'rb') as f:
+            context.defines = preprocess(f,
+                                         context.output,
+                                         defines=context.defines,
+                                         options=options,
+                                         content_types_db=context.content_types_db,
+                                         _preprocessed_files=context.preprocessed_files,
+                                         _depth=1)
+        return
+
+    try:
+        key = _get_include_cache_key(filename, context)
+    except (IOError, OSError), ex:
+        logger.debug("cannot memoize '%s': %s", filename, ex)
+        key = None
+    if key is not None:
+        expansion = include_cache.get(key)
+        if expansion is not None and _can_replay_expansion(expansion, context):
+            logger.debug("using memoized expansion of '%s'", filename)
+            _replay_expansion(expansion, context)
+            return
+
+    expansion = _expand_include(filename, context)
+    if key is not None and all(value is _missing or
+                               isinstance(value, _IMMUTABLE_TYPES)
+                               for name, value in expansion[1]):
+        include_cache[key] = expansion
+
+
+def _expand_include(filename, context):
+    """
+    Preprocesses an #include'd file into the output of the including file,
+    recording what it does.
+
+    :return:
+        An (output, changes, paths) tuple of the output of the file, the
+        (name, value) pairs of the defines it wrote, where ``value`` is
+        ``_missing`` for removed defines, and the absolute paths of the
+        files it preprocessed.
+    """
+    defines = context.defines
+    preprocessed_files = context.preprocessed_files
+    # The names the file writes are those in the overlay.
+    recording_defines = DefineEnvironment(defines)
+    preprocessed_file_count = len(preprocessed_files)
+    output = StringIO()
+    try:
+        with open(filename, 'rb') as f:
+            recording_defines = preprocess(f,
+                                           output,
+                                           defines=recording_defines,
+                                           options=context.options,
+                                           content_types_db=context.content_types_db,
+                                           _preprocessed_files=preprocessed_files,
+                                           _depth=1)
+    finally:
+        context.output.write(output.getvalue())
+        changes = []
+        for name in recording_defines.written_names:
+            value = recording_defines.get(name, _missing)
+            changes.append((name, value))
+            if value is _missing:
+                _undefine(defines, name)
+            else:
+                defines[name] = value
+    return (output.getvalue(), changes,
+            preprocessed_files[preprocessed_file_count:])
+
+
+def _can_replay_expansion(expansion, context):
+    # An expansion that would #include a file again is preprocessed to
+    # report the error.
+    for path in expansion[2]:
+        if path in context.preprocessed_files:
+            return False
+    return True
+
+
+def _replay_expansion(expansion, context):
+    """
+    Repeats an expansion recorded by ``_expand_include``.
+    """
+    output, changes, paths = expansion
+    context.output.write(output)
+    context.preprocessed_files.extend(paths)
+    for name, value in changes:
+        if value is _missing:
+            _undefine(context.defines, name)
+        else:
+            context.defines[name] = value
+
+
+# A recorded expansion of a prelude. ``defines`` are the defines the
+# prelude was #include'd with, apart from __FILE__ and __LINE__, and
+# ``files`` are (absolute-path, SHA-1) pairs of the files it preprocessed.
+# ``removed_names`` are the defines it removed and ``written_defines``
+# those it set.
+PreludeSnapshot = namedtuple("PreludeSnapshot", [
+    "version", "filename", "path", "options", "defines", "files", "output",
+    "written_defines", "removed_names"])
+
+# (stamps, snapshot, is-current) tuples of the loaded prelude snapshots
+# keyed by the path of their snapshot file, where ``stamps`` are those of
+# the snapshot file and the files of the snapshot when it was loaded.
+_prelude_snapshots = {}
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _get_file_stamp(path):
+    """
+    Returns the (modification-time, size) pair of a file, or ``None`` if
+    it does not exist.
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return stat_result.st_mtime, stat_result.st_size
+
+
+def _get_prelude_snapshot_stamps(snapshot_filename, snapshot):
+    paths = [snapshot_filename]
+    if snapshot is not None:
+        paths.extend(path for path, digest in snapshot.files)
+    return [_get_file_stamp(path) for path in paths]
+
+
+def _get_prelude_options(options):
+    return (bool(options.should_keep_lines),
+            bool(options.should_substitute),
+            bool(getattr(options, 'should_substitute_markers', False)),
+            bool(getattr(options, 'should_evaluate_safely', False)),
+            options.default_content_type,
+            tuple(options.include_paths))
+
+
+def load_prelude_snapshot(snapshot_filename):
+    """
+    Loads a prelude snapshot written by an earlier run.
+
+    :param snapshot_filename:
+        The path of the snapshot file.
+    :return:
+        A ``PreludeSnapshot``, or ``None`` if the file does not exist, was
+        written by another version of pepe or the prelude or a file it
+        #includes has changed since.
+    """
+    snapshot, is_current = _read_prelude_snapshot(snapshot_filename)
+    if is_current:
+        return snapshot
+    return None
+
+
+def _read_prelude_snapshot(snapshot_filename):
+    """
+    Returns a (snapshot, is-current) pair for a snapshot file. Snapshots
+    of a prelude that has changed are returned so that the prelude can
+    still be recognized and its snapshot rewritten. A snapshot is loaded
+    again, and its files hashed again, whenever the modification time or
+    size of the snapshot file or one of its files has changed.
+    """
+    if snapshot_filename in _prelude_snapshots:
+        stamps, snapshot, is_current = _prelude_snapshots[snapshot_filename]
+        if stamps == _get_prelude_snapshot_stamps(snapshot_filename,
+                                                  snapshot):
+            return snapshot, is_current
+    # Stamps are taken before reading, so that changes made while reading
+    # are noticed next time.
+    stamps = _get_prelude_snapshot_stamps(snapshot_filename, None)
+    snapshot = None
+    is_current = False
+    try:
+        with open(snapshot_filename, 'rb') as f:
+            snapshot = pickle.load(f)
+        if (not isinstance(snapshot, PreludeSnapshot)
+            or snapshot.version != __version__):
+            snapshot = None
+        else:
+            stamps = stamps + [_get_file_stamp(path)
+                               for path, digest in snapshot.files]
+            is_current = True
+            for path, digest in snapshot.files:
+                if _hash_file(path) != digest:
+                    logger.debug("'%s' has changed since the prelude "
+                                 "snapshot was written", path)
+                    is_current = False
+                    break
+    except (IOError, OSError), ex:
+        logger.debug("cannot load prelude snapshot '%s': %s",
+                     snapshot_filename, ex)
+        is_current = False
+    except Exception, ex:
+        logger.warning("ignoring invalid prelude snapshot '%s': %s",
+                       snapshot_filename, ex)
+        snapshot = None
+    _prelude_snapshots[snapshot_filename] = (stamps, snapshot, is_current)
+    return snapshot, is_current
+
+
+def _save_prelude_snapshot(snapshot_filename, snapshot):
+    directory = os.path.dirname(os.path.abspath(snapshot_filename))
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, snapshot_filename)
+    except:
+        os.remove(temp_path)
+        raise
+    # The files may have changed since they were hashed, so the snapshot
+    # is checked when it is next loaded.
+    _prelude_snapshots.pop(snapshot_filename, None)
+
+
+def _is_prelude(filename, options):
+    prelude = getattr(options, 'prelude', None)
+    if prelude:
+        return absolute_path(filename) == absolute_path(prelude)
+    snapshot, is_current = _read_prelude_snapshot(options.prelude_snapshot)
+    return snapshot is not None and absolute_path(filename) == snapshot.path
+
+
+def _get_prelude_defines(defines):
+    return dict((name, value) for name, value in defines.items()
+                if name not in ('__FILE__', '__LINE__'))
+
+
+def _preprocess_prelude(filename, context):
+    """
+    Preprocesses an #include'd prelude, repeating the expansion recorded
+    in the snapshot file ``options.prelude_snapshot`` if the prelude is
+    #include'd with the same defines and options as when the snapshot was
+    written. Otherwise the prelude is preprocessed and a new snapshot is
+    written.
+    """
+    options = context.options
+    # Custom statement handlers and partial evaluation change what the
+    # prelude expands to without changing its text.
+    if (_custom_statement_ops or not _has_default_statement_handlers()
+        or getattr(options, 'should_partially_evaluate', False)):
+        _expand_include(filename, context)
+        return
+    snapshot_filename = options.prelude_snapshot
+    snapshot = load_prelude_snapshot(snapshot_filename)
+    prelude_options = _get_prelude_options(options)
+    prelude_defines = _get_prelude_defines(context.defines)
+    if (snapshot is not None
+        and snapshot.filename == filename
+        and snapshot.options == prelude_options
+        and snapshot.defines == prelude_defines):
+        changes = snapshot.written_defines.items()
+        changes.extend((name, _missing) for name in snapshot.removed_names)
+        expansion = (snapshot.output, changes,
+                     [path for path, digest in snapshot.files])
+        if _can_replay_expansion(expansion, context):
+            logger.debug("using prelude snapshot '%s'", snapshot_filename)
+            _replay_expansion(expansion, context)
+            return
+
+    output, changes, paths = _expand_include(filename, context)
+    snapshot = PreludeSnapshot(
+        __version__,
+        filename,
+        absolute_path(filename),
+        prelude_options,
+        prelude_defines,
+        [(path, _hash_file(path)) for path in paths],
+        output,
+        dict((name, value) for name, value in changes if value is not _missing),
+        [name for name, value in changes if value is _missing])
+    try:
+        _save_prelude_snapshot(snapshot_filename, snapshot)
+    except (IOError, OSError, pickle.PicklingError, TypeError), ex:
+        logger.warning("cannot write prelude snapshot '%s': %s",
+                       snapshot_filename, ex)
+
+
+def _get_output_cache_key(input_filename, options, content_types_db, defines):
+    """
+    Returns the key of the output of a file in the output cache, or ``None``
+    if the output cannot be cached. The key is a digest of the contents
+    and comment groups of the file and all files it can #include, the
+    defines, the options that affect the output and the version of pepe.
+    """
+    if (_custom_statement_ops or not _has_default_statement_handlers()):
+        return None
+    digest = hashlib.sha1()
+    digest.update(repr((__version__,
+                        input_filename,
+                        sorted(defines.items()),
+                        bool(options.should_keep_lines),
+                        bool(options.should_substitute),
+                        bool(getattr(options, 'should_substitute_markers',
+                                     False)),
+                        bool(getattr(options, 'should_partially_evaluate',
+                                     False)),
+                        bool(getattr(options, 'should_evaluate_safely',
+                                     False)))))
+    for filename, path, comment_groups, summary in _walk_included_files(
+            input_filename, options, content_types_db, defines):
+        for include_filename, var in summary.includes:
+            if var is not None and var not in defines:
+                return None
+        with open(filename, 'rb') as f:
+            text = f.read()
+        digest.update(repr((path, _freeze_comment_groups(comment_groups),
+                            _get_substitution_markers(filename, options,
+                                                      content_types_db),
+                            len(text))))
+        digest.update(text)
+    return digest.hexdigest()
+
+
+def preprocess_cached(input_file,
+                      output_file,
+                      defines=None,
+                      options=None,
+                      content_types_db=None):
+    """
+    Preprocesses a file like ``preprocess()`` does, reusing the output of
+    an earlier run from the output cache in ``options.cache_dir`` if the
+    file, the files it can #include, the defines and the options that
+    affect the output are the same. The cache is limited to
+    ``options.cache_size_limit`` megabytes.
+
+    Files with ``#include VAR`` statements whose ``VAR`` is not in
+    ``defines`` are always preprocessed, and so is everything while
+    custom statement handlers are registered.
+
+    :return:
+        Modified dictionary of defines or raises ``PreprocessorError`` if
+        an error occurred.
+    """
+    if defines is None:
+        defines = {}
+    output_cache = get_output_cache(options.cache_dir,
+                                    getattr(options, 'cache_size_limit',
+                                            DEFAULT_CACHE_SIZE_LIMIT))
+    try:
+        key = _get_output_cache_key(input_file.name, options,
+                                    content_types_db, defines)
+    except (IOError, OSError), ex:
+        logger.debug("cannot cache the output of '%s': %s",
+                     input_file.name, ex)
+        key = None
+    if key is None:
+        return preprocess(input_file, output_file, defines, options,
+                          content_types_db)
+    cached = output_cache.get(key)
+    if cached is not None:
+        logger.debug("using cached output of '%s'", input_file.name)
+        output, cached_defines = cached
+        output_file.write(output)
+        defines.clear()
+        defines.update(cached_defines)
+        return defines
+    output_buffer = StringIO()
+    defines = preprocess(input_file, output_buffer, defines, options,
+                         content_types_db)
+    output = output_buffer.getvalue()
+    output_file.write(output)
+    try:
+        output_cache[key] = (output, defines)
+    except (pickle.PicklingError, TypeError), ex:
+        logger.debug("cannot cache the output of '%s': %s",
+                     input_file.name, ex)
+    return defines
+
+
+def _write_substituted(lines, first_line_number, defines, write,
+                       markers=None):
+    line_number = first_line_number
+    substituter = None
+    for line in lines:
+        defines['__LINE__'] = line_number
+        if substituter is None:
+            substituter = _get_substituter(defines, markers)
+        write(substituter.substitute(line, defines))
+        line_number += 1
+
+
+class _TemplateCompiler(object):
+    """
+    Generates the Python source of the render function of a template.
+    Literal text, define values, match objects and compiled expressions
+    are stored in the namespace of the function and referred to by name.
+    """
+
+    def __init__(self, should_keep_lines, should_substitute,
+                 should_evaluate_safely=False, substitution_markers=None):
+        self.should_keep_lines = should_keep_lines
+        self.should_substitute = should_substitute
+        self.substitution_markers = substitution_markers
+        # Appended to the arguments of evaluation functions.
+        self.safe_argument = ", True" if should_evaluate_safely else ""
+        self.lines = []
+        self.namespace = {
+            '_evaluate': _evaluate,
+            '_evaluate_condition': _evaluate_condition,
+            '_evaluate_define_value': _evaluate_define_value,
+            '_process_statement': _process_statement,
+            '_undefine': _undefine,
+            '_write_substituted': _write_substituted,
+        }
+        self.name_count = 0
+
+    def name(self, prefix, value=None):
+        self.name_count += 1
+        name = "_%s%d" % (prefix, self.name_count)
+        self.namespace[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def compile(self, nodes):
+        self.emit(0, "def render(defines, write, context):")
+        self.compile_nodes(nodes, 1)
+        self.emit(1, "return defines")
+        return "\n".join(self.lines) + "\n"
+
+    def compile_nodes(self, nodes, indent):
+        if not nodes:
+            self.emit(indent, "pass")
+        for node in nodes:
+            if type(node) is Literal:
+                self.compile_literal(node, indent)
+            elif type(node) is Statement:
+                self.compile_statement(node, indent)
+            else:
+                self.compile_conditional(node, indent)
+
+    def compile_literal(self, literal, indent):
+        line_count = literal.text.count("\n")
+        if not literal.text.endswith("\n"):
+            line_count += 1
+        if self.should_substitute:
+            lines = self.name("lines", tuple(_split_lines(literal.text)))
+            if self.substitution_markers is None:
+                markers = ""
+            else:
+                markers = ", " + self.name("markers",
+                                           self.substitution_markers)
+            self.emit(indent, "_write_substituted(%s, %d, defines, write%s)"
+                      % (lines, literal.line_number, markers))
+        else:
+            self.emit(indent, "write(%s)" % self.name("text", literal.text))
+        self.emit(indent, "defines['__LINE__'] = %d"
+                  % (literal.line_number + line_count - 1))
+
+    def emit_newlines(self, indent, count):
+        if self.should_keep_lines and count > 0:
+            self.emit(indent, "write(%r)" % ("\n" * count))
+            return True
+        return False
+
+    def compile_statement(self, statement, indent):
+        groups = statement.groups
+        op = groups['op']
+        self.emit(indent, "defines['__LINE__'] = %d" % statement.line_number)
+        if op == 'define':
+            if statement.value is not None:
+                value = self.name("value", statement.value[0])
+            else:
+                value = "_evaluate_define_value(%r%s)" % (groups['val'],
+                                                          self.safe_argument)
+            self.emit(indent, "defines[%r] = %s" % (groups['var'], value))
+        elif op == 'undef':
+            self.emit(indent, "_undefine(defines, %r)" % groups['var'])
+        else:
+            self.emit(indent, "_process_statement(context, %s, %s)"
+                      % (self.name("match", StatementMatch(groups)),
+                         self.name("line", statement.line)))
+            # #include may replace the dictionary of defines.
+            self.emit(indent, "defines = context.defines")
+        self.emit_newlines(indent, 1)
+
+    def compile_condition(self, statement):
+        """
+        Returns a Python expression for the condition of an #if, #ifdef,
+        #ifndef or #elif statement.
+        """
+        op = statement.groups['op']
+        expression = statement.groups['expr']
+        if op in ("ifdef", "ifndef"):
+            if "'" in expression or "\\" in expression:
+                return "bool(_evaluate_condition(%r, %r, defines%s))" % (
+                    op, expression, self.safe_argument)
+            return "(%r %s defines)" % (expression,
+                                        "in" if op == "ifdef" else "not in")
+        compiled = self.name("expression", get_compiled_expression(expression))
+        return "bool(_evaluate(%r, defines, %s%s))" % (expression, compiled,
+                                                       self.safe_argument)
+
+    def compile_branch_body(self, taken, statement, body, next_line_number,
+                            indent):
+        self.emit(indent, "if %s:" % taken)
+        self.compile_nodes(body, indent + 1)
+        skipped_line_count = next_line_number - statement.line_number - 1
+        self.emit(indent, "else:")
+        if not self.emit_newlines(indent + 1, skipped_line_count):
+            self.emit(indent + 1, "pass")
+
+    def compile_conditional(self, conditional, indent):
+        taken = self.name("taken")
+        branches = conditional.branches
+        for index, (statement, body) in enumerate(branches):
+            if index + 1 < len(branches):
+                next_line_number = branches[index + 1][0].line_number
+            else:
+                next_line_number = conditional.end.line_number
+            skipped_line_count = next_line_number - statement.line_number - 1
+            op = statement.groups['op']
+            self.emit(indent, "defines['__LINE__'] = %d" % statement.line_number)
+            if index == 0:
+                self.emit(indent, "%s = %s" % (taken,
+                                               self.compile_condition(statement)))
+                self.emit_newlines(indent, 1)
+                self.compile_branch_body(taken, statement, body,
+                                         next_line_number, indent)
+            elif op == "elif":
+                # Once a branch has been taken the remaining ones are
+                # skipped without evaluating their conditions.
+                self.emit(indent, "if %s:" % taken)
+                if not self.emit_newlines(indent + 1, 1 + skipped_line_count):
+                    self.emit(indent + 1, "pass")
+                self.emit(indent, "else:")
+                self.emit(indent + 1, "%s = %s" % (taken,
+                                                   self.compile_condition(statement)))
+                self.emit_newlines(indent + 1, 1)
+                self.compile_branch_body(taken, statement, body,
+                                         next_line_number, indent + 1)
+            else:
+                self.emit_newlines(indent, 1)
+                self.emit(indent, "%s = not %s" % (taken, taken))
+                self.compile_branch_body(taken, statement, body,
+                                         next_line_number, indent)
+        self.emit(indent, "defines['__LINE__'] = %d"
+                  % conditional.end.line_number)
+        self.emit_newlines(indent, 1)
+
+
+def template_to_python(template, should_keep_lines=False,
+                       should_substitute=False, should_evaluate_safely=False,
+                       substitution_markers=None):
+    """
+    Generates the Python source of the render function of a template.
+
+    :param template:
+        A ``Template`` with ``nodes``.
+    :param should_keep_lines:
+        ``True`` to emit empty lines for statement lines and skipped lines.
+    :param should_substitute:
+        ``True`` to substitute defines into emitted lines.
+    :param should_evaluate_safely:
+        ``True`` to evaluate expressions without eval() (see
+        ``_evaluate()``).
+    :param substitution_markers:
+        The (prefix, suffix) markers to substitute defines between, or
+        ``None`` to substitute their names.
+    :return:
+        A (source, namespace) tuple where ``namespace`` holds the
+        constants the source refers to.
+
+    Usage::
+
+        >>> t = parse_template("# #ifdef A\\na\\n# #endif\\n", [['#', '']])
+        >>> source, namespace = template_to_python(t)
+        >>> print source,
+        def render(defines, write, context):
+            defines['__LINE__'] = 1
+            _taken1 = ('A' in defines)
+            if _taken1:
+                write(_text2)
+                defines['__LINE__'] = 2
+            else:
+                pass
+            defines['__LINE__'] = 3
+            return defines
+        >>> namespace['_text2']
+        'a\\n'
+    """
+    compiler = _TemplateCompiler(should_keep_lines, should_substitute,
+                                 should_evaluate_safely, substitution_markers)
+    source = compiler.compile(template.nodes)
+    return source, compiler.namespace
+
+
+def compile_template(template, should_keep_lines=False,
+                     should_substitute=False, should_evaluate_safely=False,
+                     substitution_markers=None):
+    """
+    Compiles a template into a Python function
+    ``render(defines, write, context)`` that writes the output of the
+    template for a dictionary of defines using ``write`` and returns the
+    (possibly replaced) dictionary of defines. ``context`` is the
+    ``StatementContext`` passed to the handlers of #include, #error and
+    custom statements; it may be ``None`` for templates without such
+    statements.
+
+    Render functions are kept with the template, so each template is
+    compiled only once for each combination of options.
+
+    :return:
+        The render function, or ``None`` if the template has no ``nodes``
+        or is nested too deeply to be compiled.
+
+    Usage::
+
+        >>> t = parse_template("# #if A > 1\\nbig\\n# #else\\nsmall\\n# #endif\\n",
+        ...                    [['#', '']])
+        >>> render = compile_template(t)
+        >>> output = StringIO()
+        >>> defines = render({'A': 2}, output.write, None)
+        >>> output.getvalue()
+        'big\\n'
+    """
+    key = (should_keep_lines, should_substitute, should_evaluate_safely,
+           substitution_markers)
+    if key in template.render_functions:
+        return template.render_functions[key]
+    render = None
+    if template.nodes is not None:
+        source, namespace = template_to_python(template, should_keep_lines,
+                                               should_substitute,
+                                               should_evaluate_safely,
+                                               substitution_markers)
+        try:
+            code = compile(source, "<template %s>" % template.filename, "exec")
+            exec code in namespace
+            render = namespace['render']
+        except (SyntaxError, RuntimeError, MemoryError), ex:
+            # Python limits the nesting depth of blocks.
+            logger.debug("cannot compile '%s': %s", template.filename, ex)
+    template.render_functions[key] = render
+    return render
+
+
+def _has_default_statement_handlers():
+    for op in _BUILTIN_STATEMENT_OPS:
+        if STATEMENT_HANDLERS[op] is not _DEFAULT_STATEMENT_HANDLERS[op]:
+            return False
+    return True
+
+
+def _render_compiled_template(template, context):
+    """
+    The compiled engine. Renders a template with its compiled render
+    function, falling back to the template engine if it cannot be
+    compiled or built-in statement handlers have been replaced.
+    """
+    render = None
+    if _has_default_statement_handlers():
+        render = compile_template(template,
+                                  context.options.should_keep_lines,
+                                  context.options.should_substitute,
+                                  _is_safe(context),
+                                  context.substitution_markers)
+    if render is None:
+        _render_template(template, context)
+    else:
+        context.defines = render(context.defines, context.output.write,
+                                 context)
+
+
+# The number of characters of output that ``preprocess()`` keeps in
+# memory before spooling the output to a temporary file.
+OUTPUT_SPOOL_SIZE = 8 << 20
+
+# The number of bytes of a spooled output file decoded at a time.
+OUTPUT_SPOOL_CHUNK_SIZE = 1 << 20
+
+
+class _OutputSpool(object):
+    """
+    A temporary output buffer that keeps output in a ``StringIO`` until it
+    holds more than ``max_size`` characters, and in a temporary file after
+    that. Like a ``StringIO`` it takes both ``str`` and ``unicode`` text;
+    ``unicode`` text is encoded as UTF-8 in the temporary file and decoded
+    again by ``write_to()``.
+
+    Usage::
+
+        >>> spool = _OutputSpool(4)
+        >>> spool.write(u"h\\xe9")
+        >>> spool.write(u"llo\\n")
+        >>> output = StringIO()
+        >>> spool.write_to(output)
+        >>> output.getvalue()
+        u'h\\xe9llo\\n'
+        >>> spool.close()
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = StringIO()
+        self.size = 0
+        self.file = None
+        self.is_unicode = False
+
+    def write(self, text):
+        if self.file is None:
+            self.buffer.write(text)
+            self.size += len(text)
+            if self.size > self.max_size:
+                self.file = tempfile.TemporaryFile()
+                self._write_to_file(self.buffer.getvalue())
+                self.buffer.close()
+        else:
+            self._write_to_file(text)
+
+    def _write_to_file(self, text):
+        if isinstance(text, unicode):
+            self.is_unicode = True
+            text = text.encode("utf-8")
+        self.file.write(text)
+
+    def write_to(self, output_file):
+        if self.file is None:
+            output_file.write(self.buffer.getvalue())
+            return
+        self.file.seek(0)
+        if not self.is_unicode:
+            shutil.copyfileobj(self.file, output_file)
+            return
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while True:
+            data = self.file.read(OUTPUT_SPOOL_CHUNK_SIZE)
+            output_file.write(decoder.decode(data, not data))
+            if not data:
+                break
+
+    def close(self):
+        if self.file is None:
+            self.buffer.close()
+        else:
+            self.file.close()
+
+
+def _create_output_spool():
+    return _OutputSpool(OUTPUT_SPOOL_SIZE)
+
+
+def _copy_output_spool(spool, output_file):
+    spool.write_to(output_file)
+    spool.close()
+
+
+def preprocess(input_file,
+               output_file,
+               defines=None,
+               options=None,
+               content_types_db=None,
+               _preprocessed_files=None,
+               _depth=0):
+    """
+    Preprocesses the specified file.
+
+    :param input_filename:
+        The input path.
+    :param output_filename:
+        The output file (NOT path). It is only written to if preprocessing
+        succeeds; until then the output is kept in an ``_OutputSpool``.
+    :param defines:
+        a dictionary of defined variables that will be
+        understood in preprocessor statements. Keys must be strings and,
+        currently, only the truth value of any key's value matters.
+        It is changed in place; pass a ``DefineEnvironment`` over a
+        dictionary to keep that dictionary unchanged without copying it.
+    :param options:
+        A ``Namespace`` of command-line options, of which these are
+        optional:
+
+        - ``engine``: one of ``ENGINES``. Defaults to ``template`` with
+          ``cache_dir``, to ``buffer`` with ``jobs`` and to ``line``.
+        - ``cache_dir``: a directory of parsed templates shared with
+          other processes (see ``get_disk_cache()``).
+        - ``cache_size_limit``: the size limit of ``cache_dir`` in
+          megabytes.
+        - ``should_partially_evaluate``: only evaluate the #if blocks
+          that depend on defined names alone (see
+          ``_partially_render_template()``).
+        - ``should_memoize_includes``: reuse the expansions of
+          #include'd files across calls (see ``include_cache``). There is
+          no command-line option for it.
+        - ``prelude`` and ``prelude_snapshot``: a prelude file and the
+          file its expansion is kept in across runs (see
+          ``_preprocess_prelude()``).
+        - ``should_evaluate_safely``: evaluate expressions without
+          eval() (see ``_evaluate()``).
+        - ``should_substitute_markers``: with ``should_substitute``,
+          only substitute defines between markers.
+        - ``jobs``: the number of processes to substitute defines in
+          (see ``_SubstitutionSpans``).
+    :param content_types_db:
+        is an instance of ``ContentTypesDatabase``.
+    :param _preprocessed_files:
+        (for internal use only) is used to ensure files
+        are not recursively preprocessed.
+    :param _depth:
+        When the call reaches _depth == 0, the output file is actually
+        written. For all internal recursive calls _depth == 1.
+    :return:
+        Modified dictionary of defines or raises ``PreprocessorError`` if
+        an error occurred.
+    """
+
+    # Options that can later be turned into function parameters.
+    default_content_type = options.default_content_type
+    engine = getattr(options, 'engine', None)
+    cache_dir = getattr(options, 'cache_dir', None)
+    should_partially_evaluate = getattr(options, 'should_partially_evaluate',
+                                        False)
+    jobs = getattr(options, 'jobs', None) or 1
+    should_substitute_in_parallel = options.should_substitute and jobs > 1
+    if engine is None:
+        if cache_dir:
+            engine = 'template'
+        elif should_substitute_in_parallel:
+            engine = 'buffer'
+        else:
+            engine = 'line'
+    input_filename = input_file.name
+
+    if defines is None:
+        defines = {}
+
+    # Ensure preprocessing isn't cyclic(?).
+    _preprocessed_files = _preprocessed_files or []
+    input_file_absolute_path = absolute_path(input_filename)
+    if input_file_absolute_path in _preprocessed_files:
+        raise PreprocessorError("detected recursive #include of '%s'"\
+                                % input_filename)
+    _preprocessed_files.append(input_file_absolute_path)
+
+    # Determine the content type and comment info for the input file.
+    comment_groups = content_types_db.get_comment_group_for_path(input_filename, default_content_type)
+    statement_matcher = get_statement_matcher(comment_groups)
+
+    # Process the input file.
+    # (Would be helpful if I knew anything about lexing and parsing
+    # simple grammars.)
+    if _depth == 0 and should_substitute_in_parallel:
+        temp_output_buffer = _SubstitutionSpans(jobs)
+    elif _depth == 0:
+        # Only at recursion depth 0 is the temporary buffer created. Nothing
+        # is written to the output file unless preprocessing succeeds, and
+        # large outputs are kept on disk rather than in memory.
+        temp_output_buffer = _create_output_spool()
+    else:
+        # At deeper levels, the temporary buffer is the output file.
+        temp_output_buffer = output_file
+
+    defines['__FILE__'] = input_filename
+    states = [(EMIT, # a state is (<emit-or-skip-lines-in-this-section>,
+               0, #             <have-emitted-in-this-if-block>,
+               0)]     #             <have-seen-'else'-in-this-if-block>)
+    context = StatementContext(input_filename, temp_output_buffer, states,
+                               defines, options, content_types_db,
+                               _preprocessed_files,
+                               _get_substitution_markers(input_filename,
+                                                         options,
+                                                         content_types_db))
+    if engine == 'numpy' and not _can_use_numpy(comment_groups):
+        logger.debug("cannot use the numpy engine for '%s'; using the "
+                     "buffer engine", input_filename)
+        engine = 'buffer'
+    if engine in ('template', 'compiled') or should_partially_evaluate:
+        if cache_dir:
+            disk_cache = get_disk_cache(
+                cache_dir,
+                getattr(options, 'cache_size_limit', DEFAULT_CACHE_SIZE_LIMIT))
+        else:
+            disk_cache = None
+        template = get_template(input_file, comment_groups,
+                                input_file_absolute_path, disk_cache)
+        if should_partially_evaluate:
+            _partially_render_template(template, context)
+        elif engine == 'compiled':
+            _render_compiled_template(template, context)
+        else:
+            _render_template(template, context)
+    elif engine in ('buffer', 'numpy'):
+        _preprocess_buffer(input_file.read(), statement_matcher, context,
+                           use_numpy=(engine == 'numpy'))
+    else:
+        _preprocess_lines(input_file, statement_matcher, context)
+    defines = context.defines
+    if len(states) > 1:
+        raise PreprocessorError("unterminated #if block", defines['__FILE__'],
+                                defines['__LINE__'])
+    elif len(states) < 1:
+        raise PreprocessorError("superfluous #endif on or before this line",
+                                defines['__FILE__'], defines['__LINE__'])
+
+    #if temp_output_buffer != output_file:
+    #    temp_output_buffer.close()
+    if _depth == 0:
+        if isinstance(temp_output_buffer, _SubstitutionSpans):
+            spans = temp_output_buffer
+            temp_output_buffer = _create_output_spool()
+            spans.write_to(temp_output_buffer)
+            spans.close()
+        _copy_output_spool(temp_output_buffer, output_file)
+
+    return defines
+
+
+def preprocess_variants(input_file,
+                        output_files,
+                        defines_list,
+                        options=None,
+                        content_types_db=None):
+    """
+    Preprocesses a file once for each of several dictionaries of defines,
+    reading and parsing it only once.
+
+    The input is parsed into a ``Template`` and its nodes are walked once
+    for all variants: each #if block is evaluated for every variant that
+    reaches it and each of its branches is rendered once for all the
+    variants that take it. Inputs whose #if blocks are not properly nested
+    are rendered for each variant in turn. #include'd files are
+    preprocessed for each variant as ``options`` select.
+
+    :param input_file:
+        The input file (NOT path).
+    :param output_files:
+        The output files (NOT paths), one for each dictionary of defines.
+    :param defines_list:
+        The dictionaries of defines of the variants. They are not changed
+        or copied: each variant writes to a ``DefineEnvironment`` over its
+        dictionary, so variants may share one.
+    :param options:
+        A ``Namespace`` of command-line options, as for ``preprocess()``.
+    :param content_types_db:
+        An instance of ``ContentTypesDatabase``.
+    :return:
+        A list with, for each variant, its modified dictionary of defines
+        or the ``PreprocessorError`` it failed with. Nothing is written to
+        the output files of variants that fail.
+    """
+    if len(output_files) != len(defines_list):
+        raise ValueError("expected %d output files, got %d"
+                         % (len(defines_list), len(output_files)))
+    input_filename = input_file.name
+    input_file_absolute_path = absolute_path(input_filename)
+    comment_groups = content_types_db.get_comment_group_for_path(
+        input_filename, options.default_content_type)
+    template = get_template(input_file, comment_groups,
+                            input_file_absolute_path,
+                            _get_template_disk_cache(options))
+    substitution_markers = _get_substitution_markers(input_filename, options,
+                                                     content_types_db)
+    contexts = []
+    for defines in defines_list:
+        defines = DefineEnvironment(defines)
+        defines['__FILE__'] = input_filename
+        contexts.append(StatementContext(input_filename,
+                                         _create_output_spool(),
+                                         [(EMIT, 0, 0)], defines, options,
+                                         content_types_db,
+                                         [input_file_absolute_path],
+                                         substitution_markers))
+    errors = {}
+    if (template.nodes is None
+        or getattr(options, 'should_partially_evaluate', False)):
+        for context in contexts:
+            try:
+                if template.nodes is None:
+                    _render_template(template, context)
+                else:
+                    _partially_render_template(template, context)
+            except PreprocessorError, ex:
+                errors[context] = ex
+    elif contexts:
+        _render_nodes_for_variants(template.nodes, contexts, errors)
+    results = []
+    for context, output_file in zip(contexts, output_files):
+        defines = context.defines
+        if context not in errors:
+            if len(context.states) > 1:
+                errors[context] = PreprocessorError(
+                    "unterminated #if block", defines['__FILE__'],
+                    defines['__LINE__'])
+            elif len(context.states) < 1:
+                errors[context] = PreprocessorError(
+                    "superfluous #endif on or before this line",
+                    defines['__FILE__'], defines['__LINE__'])
+        if context in errors:
+            results.append(errors[context])
+            context.output.close()
+        else:
+            _copy_output_spool(context.output, output_file)
+            results.append(defines)
+    return results
+
+
+def _common_prefix_length(a, b):
+    """
+    Returns the length of the longest common prefix of two strings using
+    a binary search over slice comparisons.
+
+    Usage::
+
+        >>> _common_prefix_length("abcd", "abxd")
+        2
+        >>> _common_prefix_length("abc", "abc")
+        3
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix_length(a, b, limit):
+    """
+    Returns the length of the longest common suffix of two strings that
+    is no longer than ``limit``.
+
+    Usage::
+
+        >>> _common_suffix_length("abcd", "xbcd", 4)
+        3
+        >>> _common_suffix_length("abcd", "xbcd", 2)
+        2
+    """
+    low, high = 0, min(len(a), len(b), limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+# The state of an ``IncrementalPreprocessor`` run just after a statement
+# that leaves no #if block open: the offsets in the input of the next line
+# and in the output, the number of the next line, the #if block states, a
+# copy of the defines without __LINE__, the value of __LINE__ and the
+# absolute paths of the files preprocessed so far.
+Checkpoint = namedtuple("Checkpoint", ["input_offset", "output_offset",
+                                       "line_number", "states", "defines",
+                                       "last_line_number",
+                                       "preprocessed_files"])
+
+
+class IncrementalPreprocessor(object):
+    """
+    Preprocesses successive versions of a file, such as the contents of an
+    editor buffer, redoing only the work that an edit affects.
+
+    Every run records a ``Checkpoint`` after each statement that leaves no
+    #if block open. After an edit, preprocessing restarts from the last
+    checkpoint before the first changed character. It stops as soon as it
+    reaches such a statement past the edit where the #if block states, the
+    defines and the preprocessed files are the same as at a checkpoint of
+    the previous run; the rest of the previous output is then reused. Runs that change
+    the number of lines only stop early if the rest of the input does not
+    mention ``__LINE__``.
+
+    Files #include'd by the input are assumed not to change between runs.
+    Produces the same output and errors as the buffer engine. A run that
+    raises an error leaves the previous result in place.
+
+    :ivar output:
+        The output of the last successful run.
+    :ivar defines:
+        The dictionary of defines at the end of the last successful run.
+    :ivar checkpoints:
+        The checkpoints of the last successful run, in input order.
+    :ivar reprocessed:
+        The (start-offset, end-offset) range of the input that the last run
+        scanned.
+
+    Usage::
+
+        >>> from argparse import Namespace
+        >>> options = Namespace(default_content_type=None, include_paths=[],
+        ...                     should_keep_lines=False,
+        ...                     should_substitute=False)
+        >>> content_types_db = ContentTypesDatabase(DEFAULT_CONTENT_TYPES_FILE)
+        >>> p = IncrementalPreprocessor("foo.py", {'A': 1}, options,
+        ...                             content_types_db)
+        >>> text = "# #if A\\na\\n# #endif\\nb\\n# #define C\\nc\\n"
+        >>> p.update(text)
+        'a\\nb\\nc\\n'
+        >>> p.update(text.replace("b", "B"))
+        'a\\nB\\nc\\n'
+        >>> p.reprocessed
+        (19, 33)
+    """
+
+    def __init__(self, filename, defines=None, options=None,
+                 content_types_db=None):
+        self.filename = filename
+        self.options = options
+        self.content_types_db = content_types_db
+        self.initial_defines = dict(defines or {})
+        self.initial_defines['__FILE__'] = filename
+        self.initial_line_number = self.initial_defines.pop('__LINE__', None)
+        comment_groups = content_types_db.get_comment_group_for_path(
+            filename, options.default_content_type)
+        self.statement_matcher = get_statement_matcher(comment_groups)
+        self.substitution_markers = _get_substitution_markers(
+            filename, options, content_types_db)
+        self.text = None
+        self.output = None
+        self.defines = None
+        self.checkpoints = []
+        self.reprocessed = None
+
+    def update(self, text):
+        """
+        Preprocesses a new version of the file.
+
+        :param text:
+            The contents of the file.
+        :return:
+            The output, or raises ``PreprocessorError`` if an error
+            occurred.
+        """
+        if text == self.text:
+            self.reprocessed = (len(text), len(text))
+            return self.output
+        if self.text is None:
+            checkpoint = Checkpoint(0, 0, 1, ((EMIT, 0, 0),),
+                                    self.initial_defines,
+                                    self.initial_line_number,
+                                    (absolute_path(self.filename),))
+            index = 0
+            offset_delta = 0
+            edit_end = 0
+            convergence_points = {}
+        else:
+            prefix_length = _common_prefix_length(self.text, text)
+            suffix_length = _common_suffix_length(
+                self.text, text, min(len(self.text), len(text)) - prefix_length)
+            offset_delta = len(text) - len(self.text)
+            edit_end = len(text) - suffix_length
+            offsets = [c.input_offset for c in self.checkpoints]
+            index = bisect.bisect_right(offsets, prefix_length) - 1
+            checkpoint = self.checkpoints[index]
+            convergence_points = dict(
+                (c.input_offset, i) for i, c in enumerate(self.checkpoints)
+                if c.input_offset + offset_delta >= edit_end)
+            logger.debug("restarting '%s' at line %d", self.filename,
+                         checkpoint.line_number)
+
+        output = StringIO()
+        states = list(checkpoint.states)
+        defines = dict(checkpoint.defines)
+        if checkpoint.last_line_number is not None:
+            defines['__LINE__'] = checkpoint.last_line_number
+        context = StatementContext(self.filename, output, states,
+                                   defines, self.options,
+                                   self.content_types_db,
+                                   list(checkpoint.preprocessed_files),
+                                   self.substitution_markers)
+        checkpoints = self.checkpoints[:index] + [checkpoint]
+        converged_index = None
+        position = checkpoint.input_offset
+        literal_start = position
+        literal_line_number = checkpoint.line_number
+        candidates = _iter_statement_candidates(text, self.statement_matcher,
+                                                position)
+        for line_number, line_start, line_end, line, match in _iter_statements(
+                text, self.statement_matcher, candidates,
+                checkpoint.line_number, position):
+            if line_start > literal_start:
+                _write_literal_block(text[literal_start:line_start],
+                                     literal_line_number, context)
+            context.defines['__LINE__'] = line_number
+            logger.debug("line %d: %r", line_number, line)
+            _process_statement(context, match, line)
+            if self.options.should_keep_lines:
+                output.write("\n")
+            literal_start = line_end
+            literal_line_number = line_number + 1
+            # A statement on a last line without a newline can be extended
+            # by the next version, so it is not a checkpoint.
+            if len(states) == 1 and text[line_end - 1] == "\n":
+                snapshot = dict(context.defines)
+                new_checkpoint = Checkpoint(
+                    line_end, checkpoint.output_offset + output.tell(),
+                    line_number + 1, tuple(states), snapshot,
+                    snapshot.pop('__LINE__', None),
+                    tuple(context.preprocessed_files))
+                old_index = convergence_points.get(line_end - offset_delta)
+                if (old_index is not None
+                    and self._has_converged(self.checkpoints[old_index],
+                                            new_checkpoint, text)):
+                    converged_index = old_index
+                    break
+                checkpoints.append(new_checkpoint)
+
+        output_prefix = (self.output or "")[:checkpoint.output_offset]
+        if converged_index is None:
+            if literal_start < len(text):
+                _write_literal_block(text[literal_start:],
+                                     literal_line_number, context)
+                literal_start = len(text)
+            defines = context.defines
+            if len(states) > 1:
+                raise PreprocessorError("unterminated #if block",
+                                        defines['__FILE__'], defines['__LINE__'])
+            elif len(states) < 1:
+                raise PreprocessorError("superfluous #endif on or before this line",
+                                        defines['__FILE__'], defines['__LINE__'])
+            self.output = output_prefix + output.getvalue()
+        else:
+            old_checkpoint = self.checkpoints[converged_index]
+            output_delta = new_checkpoint.output_offset - old_checkpoint.output_offset
+            line_delta = new_checkpoint.line_number - old_checkpoint.line_number
+            logger.debug("'%s' converged at line %d", self.filename,
+                         new_checkpoint.line_number)
+            checkpoints.append(new_checkpoint)
+            for c in self.checkpoints[converged_index + 1:]:
+                last_line_number = c.last_line_number
+                if self._is_own_line_number(c.defines):
+                    last_line_number += line_delta
+                checkpoints.append(c._replace(
+                    input_offset=c.input_offset + offset_delta,
+                    output_offset=c.output_offset + output_delta,
+                    line_number=c.line_number + line_delta,
+                    last_line_number=last_line_number))
+            defines = dict(self.defines)
+            if old_checkpoint.input_offset == len(self.text):
+                # Nothing follows the checkpoint.
+                defines['__LINE__'] = new_checkpoint.last_line_number
+            elif self._is_own_line_number(defines):
+                defines['__LINE__'] += line_delta
+            self.output = (output_prefix + output.getvalue()
+                           + self.output[old_checkpoint.output_offset:])
+        self.text = text
+        self.defines = defines
+        self.checkpoints = checkpoints
+        self.reprocessed = (position, literal_start)
+        return self.output
+
+    def _has_converged(self, old_checkpoint, new_checkpoint, text):
+        """
+        Determines whether preprocessing the rest of the input from a new
+        checkpoint gives the same output as from an old checkpoint at the
+        same position in the previous version of the input.
+        """
+        if (old_checkpoint.states != new_checkpoint.states
+            or old_checkpoint.preprocessed_files != new_checkpoint.preprocessed_files):
+            return False
+        if old_checkpoint.line_number != new_checkpoint.line_number:
+            if text.find("__LINE__", new_checkpoint.input_offset) >= 0:
+                return False
+            if self.options.should_substitute:
+                # A substituted value may itself mention __LINE__.
+                for value in new_checkpoint.defines.itervalues():
+                    if "__LINE__" in str(value):
+                        return False
+        return old_checkpoint.defines == new_checkpoint.defines
+
+    def _is_own_line_number(self, defines):
+        # After an #include, __FILE__ and __LINE__ are left at the last line
+        # of the #include'd file.
+        return defines.get('__FILE__') == self.filename
+
+
+# The most flags ``enumerate_variants()`` takes. The assignments of the
+# flags are the bits of integers 2 ** len(flags) bits long, so each flag
+# doubles their length.
+MAX_VARIANT_FLAGS = 20
+
+# A distinct result of preprocessing a file: its ``output``, or the
+# message of the ``error`` it fails with, the ``assignments`` of the flags
+# that give it, as dictionaries, and the same assignments as ``cubes``:
+# dictionaries that leave out the flags that do not matter.
+Variant = namedtuple("Variant", ["output", "error", "assignments", "cubes"])
+
+
+def _get_flag_masks(flag_count):
+    """
+    Returns, for each flag, the mask of the assignments of ``flag_count``
+    flags where it is true. Bit ``i`` of a mask is assignment ``i``, in
+    which flag ``k`` is true if bit ``k`` of ``i`` is set.
+
+    Usage::
+
+        >>> [bin(mask) for mask in _get_flag_masks(2)]
+        ['0b1010', '0b1100']
+    """
+    assignment_count = 1 << flag_count
+    masks = []
+    for k in range(flag_count):
+        run_length = 1 << k
+        mask = ((1 << run_length) - 1) << run_length
+        length = run_length << 1
+        while length < assignment_count:
+            mask |= mask << length
+            length <<= 1
+        masks.append(mask)
+    return masks
+
+
+def _iter_assignment_indexes(mask):
+    while mask:
+        low_bit = mask & -mask
+        yield low_bit.bit_length() - 1
+        mask ^= low_bit
+
+
+def _get_assignment_cubes(mask, flags):
+    """
+    Describes a set of assignments of flags as a list of disjoint cubes,
+    splitting on the last flag first and leaving out the flags that a set
+    does not depend on.
+
+    Usage::
+
+        >>> _get_assignment_cubes(0b1110, ['A', 'B'])
+        [{'A': True, 'B': False}, {'B': True}]
+        >>> _get_assignment_cubes(0b1111, ['A', 'B'])
+        [{}]
+        >>> _get_assignment_cubes(0b0101, ['A', 'B'])
+        [{'A': False}]
+    """
+    if not mask:
+        return []
+    if mask == (1 << (1 << len(flags))) - 1:
+        return [{}]
+    flag = flags[-1]
+    half = 1 << (len(flags) - 1)
+    false_mask = mask & ((1 << half) - 1)
+    true_mask = mask >> half
+    if false_mask == true_mask:
+        return _get_assignment_cubes(false_mask, flags[:-1])
+    cubes = []
+    for value, value_mask in ((False, false_mask), (True, true_mask)):
+        for cube in _get_assignment_cubes(value_mask, flags[:-1]):
+            cube[flag] = value
+            cubes.append(cube)
+    return cubes
+
+
+def _is_same_value(a, b):
+    return a is b or (type(a) is type(b) and a == b)
+
+
+class _VariantAnalyzer(object):
+    """
+    Walks the templates of a file and the files it #includes for all
+    assignments of boolean flags at once.
+
+    Sets of assignments are masks (see ``_get_flag_masks()``). The value
+    of every define is a partition of the assignments into (mask, value)
+    pairs, where ``value`` is ``_missing`` for assignments in which the
+    name is not defined, and each node is walked with the mask of the
+    assignments that reach it. Whatever makes the output differ between
+    assignments, from emitting a literal to failing, adds the mask of
+    the assignments it happens in to ``splits``. Assignments that no
+    split separates give the same output.
+    """
+
+    def __init__(self, flags, defines, options, content_types_db):
+        self.options = options
+        self.content_types_db = content_types_db
+        self.safe = bool(getattr(options, 'should_evaluate_safely', False))
+        self.disk_cache = _get_template_disk_cache(options)
+        self.all_assignments = (1 << (1 << len(flags))) - 1
+        self.flag_masks = _get_flag_masks(len(flags))
+        self.values = {}
+        for name, value in defines.iteritems():
+            self.values[name] = [(self.all_assignments, value)]
+        for flag, mask in zip(flags, self.flag_masks):
+            self.values[flag] = [(self.all_assignments & ~mask, False),
+                                 (mask, True)]
+        # The assignments in which each file, by absolute path, has been
+        # preprocessed.
+        self.preprocessed_files = {}
+        self.splits = set()
+
+    def get_classes(self):
+        """
+        Returns the masks of the sets of assignments that no split
+        separates.
+        """
+        classes = [self.all_assignments]
+        for split in self.splits:
+            refined_classes = []
+            for mask in classes:
+                inside = mask & split
+                if inside and inside != mask:
+                    refined_classes.append(inside)
+                    refined_classes.append(mask & ~split)
+                else:
+                    refined_classes.append(mask)
+            classes = refined_classes
+        return classes
+
+    def analyze_file(self, filename, reached):
+        """
+        Walks a file for the assignments in the mask ``reached``.
+
+        :return:
+            The mask of the assignments that do not fail.
+        """
+        path = absolute_path(filename)
+        included = self.preprocessed_files.get(path, 0)
+        if reached & included:
+            # A recursive #include.
+            self.splits.add(reached & included)
+            reached &= ~included
+            if not reached:
+                return 0
+        self.preprocessed_files[path] = included | reached
+        try:
+            comment_groups = self.content_types_db.get_comment_group_for_path(
+                filename, self.options.default_content_type)
+        except PreprocessorError:
+            self.splits.add(reached)
+            return 0
+        template = _get_file_template(filename, path, comment_groups,
+                                      self.disk_cache)
+        self._assign('__FILE__', filename, reached)
+        if template.nodes is None:
+            # The #if blocks are not nested properly, which fails wherever
+            # the file is preprocessed, but the error may depend on the
+            # defines.
+            self._split_all(reached)
+            return 0
+        return self._analyze_nodes(template.nodes, filename, reached)
+
+    def _analyze_nodes(self, nodes, filename, reached):
+        should_substitute = self.options.should_substitute
+        for node in nodes:
+            if not reached:
+                break
+            if type(node) is Literal:
+                self.splits.add(reached)
+                if should_substitute:
+                    self._split_substitutions(node.text, reached)
+            elif type(node) is Statement:
+                reached = self._analyze_statement(node, filename, reached)
+            else:
+                reached = self._analyze_conditional(node, filename, reached)
+        return reached
+
+    def _analyze_statement(self, statement, filename, reached):
+        groups = statement.groups
+        op = groups['op']
+        self._set_line_number(statement.line_number)
+        if op == 'define':
+            if statement.value is not None:
+                value = statement.value[0]
+            else:
+                value = _parse_define_value(groups['val'], self.safe)
+            self._assign(groups['var'], value, reached)
+        elif op == 'undef':
+            self._assign(groups['var'], _missing, reached)
+        elif op == 'include':
+            if 'var' not in groups:
+                return self._analyze_include(groups['fname'], filename,
+                                             reached)
+            not_failed = 0
+            for mask, value in self._get_partition(groups['var'], reached):
+                if value is _missing:
+                    self.splits.add(mask)
+                else:
+                    not_failed |= self._analyze_include(value, filename, mask)
+            return not_failed
+        elif op == 'error':
+            self.splits.add(reached)
+            return 0
+        return reached
+
+    def _analyze_include(self, include_filename, filename, reached):
+        path = _find_include_file(include_filename, filename,
+                                  self.options.include_paths)
+        if path is None:
+            self.splits.add(reached)
+            return 0
+        return self.analyze_file(path, reached)
+
+    def _analyze_conditional(self, conditional, filename, reached):
+        not_taken = reached
+        not_failed = 0
+        for statement, nodes in conditional.branches:
+            if not not_taken:
+                break
+            op = statement.groups['op']
+            self._set_line_number(statement.line_number)
+            if op == 'else':
+                taken = not_taken
+            else:
+                taken, failed = self._get_condition_masks(
+                    "if" if op == "elif" else op, statement.groups['expr'],
+                    not_taken)
+                not_taken &= ~failed
+                taken &= not_taken
+            not_taken &= ~taken
+            if taken:
+                not_failed |= self._analyze_nodes(nodes, filename, taken)
+        return not_failed | not_taken
+
+    def _get_condition_masks(self, op, expression, reached):
+        """
+        Evaluates the condition of an #if, #ifdef or #ifndef statement for
+        each combination of the values of the names it reads.
+
+        :return:
+            A (true-mask, failed-mask) tuple.
+        """
+        if op == "if":
+            names = get_result_names(expression)
+        elif "'" in expression or "\\" in expression:
+            names = get_result_names("defined('%s')" % expression)
+        else:
+            names = (expression,)
+        if names is None:
+            # Whatever the expression reads, it can only tell apart the
+            # assignments that some define tells apart.
+            names = list(self.values)
+        defines = {}
+        for name, partition in self.values.iteritems():
+            if len(partition) == 1 and partition[0][1] is not _missing:
+                defines[name] = partition[0][1]
+        cells = [(reached, {})]
+        for name in names:
+            if name in self.values:
+                partition = self._get_partition(name, reached)
+                cells = [(cell_mask & mask,
+                          dict(cell_values, **{name: value}))
+                         for cell_mask, cell_values in cells
+                         for mask, value in partition
+                         if cell_mask & mask]
+        true_mask = 0
+        failed_mask = 0
+        for mask, values in cells:
+            cell_defines = dict(defines)
+            for name, value in values.iteritems():
+                if value is _missing:
+                    cell_defines.pop(name, None)
+                else:
+                    cell_defines[name] = value
+            name_count = len(cell_defines)
+            try:
+                if _evaluate_condition(op, expression, cell_defines, self.safe):
+                    true_mask |= mask
+            except (PreprocessorError, KeyError):
+                # The error may depend on the values.
+                self.splits.add(mask)
+                failed_mask |= mask
+            if len(cell_defines) != name_count:
+                raise PreprocessorError("cannot enumerate variants: `%s` "
+                                        "changes the defines" % expression,
+                                        cell_defines['__FILE__'],
+                                        cell_defines['__LINE__'])
+        return true_mask, failed_mask
 
-            >>> assert str(PreprocessorError("whatever", filename="somefile.py", line_number=20, line="blahblah")) == "somefile.py:20: whatever"
-            >>> assert str(PreprocessorError("whatever", line_number=20, line="blahblah")) == "20: whatever"
-            >>> assert str(PreprocessorError("whatever", filename="somefile.py", line="blahblah")) == "somefile.py: whatever"
-            >>> assert str(PreprocessorError("whatever", line="blahblah")) == "whatever"
+    def _get_partition(self, name, reached):
         """
-        s = ":".join([str(f) for f in [self.filename, self.line_number] if f])
-        if s:
-            s += ": "
-        s += self.error_message
-        return s
+        Returns the (mask, value) pairs of a name within a mask.
+        """
+        partition = self.values.get(name)
+        if partition is None:
+            return [(reached, _missing)]
+        return [(mask & reached, value) for mask, value in partition
+                if mask & reached]
 
+    def _assign(self, name, value, reached):
+        """
+        Sets a define, or removes it if ``value`` is ``_missing``, in the
+        assignments of a mask.
+        """
+        if not reached:
+            return
+        partition = [(mask & ~reached, old_value)
+                     for mask, old_value
+                     in self.values.get(name, [(self.all_assignments,
+                                                _missing)])
+                     if mask & ~reached]
+        for index, (mask, old_value) in enumerate(partition):
+            if _is_same_value(old_value, value):
+                partition[index] = (mask | reached, old_value)
+                break
+        else:
+            partition.append((reached, value))
+        if len(partition) == 1 and partition[0][1] is _missing:
+            self.values.pop(name, None)
+        else:
+            self.values[name] = partition
 
-def _evaluate(expression, defines):
-    """Evaluate the given expression string with the given context.
+    def _set_line_number(self, line_number):
+        # Every statement and, with substitution, every literal line sets
+        # __LINE__ before it is read, so it never depends on the flags.
+        self.values['__LINE__'] = [(self.all_assignments, line_number)]
 
-    .. WARNING:
-        This runs eval() on a user string. This is unsafe.
-    """
-    #interpolated = _interpolate(s, defines)
-    try:
-        defined = {'defined': (lambda v: v in defines)}
-        return_value = eval(expression, defined, defines)
-    except Exception, ex:
-        message = str(ex)
-        if message.startswith("name '") and message.endswith("' is not defined"):
-            # A common error (at least this is presumed:) is to have
-            #   defined(FOO)   instead of   defined('FOO')
-            # We should give a little insight into what might be wrong.
-            # message == "name 'FOO' is not defined"
-            #    -->  variable_name == "FOO"
-            variable_name = message[len("name '"):-len("' is not defined")]
-            if expression.find("defined(%s)" % variable_name) > -1:
-                # "defined(FOO)" in expr instead of "defined('FOO')"
-                message += ''' (perhaps you want `defined('%s')` instead of `defined(%s)`)''' % (variable_name, variable_name)
-        elif message.startswith("invalid syntax"):
-            message = "invalid syntax: `%s`" % expression
-        raise PreprocessorError(message, defines['__FILE__'], defines['__LINE__'])
+    def _split_substitutions(self, text, reached):
+        """
+        Splits on the values of the defines that substitution can write
+        into a literal, including those in the values of others.
+        """
+        texts = [text]
+        seen_names = set()
+        while texts:
+            text = texts.pop()
+            for name in self.values:
+                if name in seen_names or name not in text:
+                    continue
+                seen_names.add(name)
+                partition = self._get_partition(name, reached)
+                for mask, value in partition:
+                    if len(partition) > 1:
+                        self.splits.add(mask)
+                    if value is not _missing:
+                        texts.append(str(value))
 
-    logger.debug("evaluate %r -> %s (defines=%r)", expression, return_value, defines)
-    return return_value
+    def _split_all(self, reached):
+        # Tells apart every assignment in a mask.
+        self.splits.add(reached)
+        for mask in self.flag_masks:
+            self.splits.add(reached & mask)
 
 
-def get_statement_regexps(comment_groups):
-    # Generate statement parsing regexes. Basic format:
-    #       <comment-prefix> <preprocessor-stmt> <comment-suffix>
-    #  Examples:
-    #       <!-- #if foo -->
-    #       ...
-    #       <!-- #endif -->
-    #
-    #       # #if BAR
-    #       ...
-    #       # #else
-    #       ...
-    #       # #endif
-    patterns = []
-    for preprocessor_statement_regexp in PREPROCESSOR_STATEMENT_REGEXP_PATTERNS:
-        # The comment group prefix and suffix can either be just a
-        # string or a compiled regex.
-        for cprefix, csuffix in comment_groups:
-            if hasattr(cprefix, "pattern"):
-                pattern = cprefix.pattern
-            else:
-                pattern = r"^\s*%s\s*" % re.escape(cprefix)
-            pattern += preprocessor_statement_regexp
-            if hasattr(csuffix, "pattern"):
-                pattern += csuffix.pattern
-            else:
-                pattern += r"\s*%s\s*$" % re.escape(csuffix)
-            patterns.append(pattern)
-    statement_regexps = [re.compile(p) for p in patterns]
-    return statement_regexps
+def _render_variant(input_filename, defines, options, content_types_db):
+    output = StringIO()
+    try:
+        with open(input_filename, 'rb') as input_file:
+            preprocess(input_file, output, defines=defines, options=options,
+                       content_types_db=content_types_db)
+    except PreprocessorError, ex:
+        return None, str(ex)
+    return output.getvalue(), None
 
 
-def preprocess(input_file,
-               output_file,
-               defines=None,
-               options=None,
-               content_types_db=None,
-               _preprocessed_files=None,
-               _depth=0):
+def enumerate_variants(input_filename,
+                       flags,
+                       options,
+                       content_types_db,
+                       defines=None):
     """
-    Preprocesses the specified file.
+    Finds the distinct outputs of a file over all assignments of boolean
+    flags without preprocessing it for each of them.
+
+    The conditions of the #if blocks of the file and of the files it
+    #includes are evaluated for all assignments at once, only splitting
+    the assignments on the values of the names they read, which sorts the
+    assignments into classes that emit the same text. Each class is then
+    preprocessed once, with its first assignment, and classes with the
+    same output are merged.
 
     :param input_filename:
         The input path.
-    :param output_filename:
-        The output file (NOT path).
-    :param defines:
-        a dictionary of defined variables that will be
-        understood in preprocessor statements. Keys must be strings and,
-        currently, only the truth value of any key's value matters.
+    :param flags:
+        The names of the flags, which are defined as ``True`` or
+        ``False``. At most ``MAX_VARIANT_FLAGS``.
     :param options:
         A ``Namespace`` of command-line options.
     :param content_types_db:
-        is an instance of ``ContentTypesDatabase``.
-    :param _preprocessed_files:
-        (for internal use only) is used to ensure files
-        are not recursively preprocessed.
-    :param _depth:
-        When the call reaches _depth == 0, the output file is actually
-        written. For all internal recursive calls _depth == 1.
+        An instance of ``ContentTypesDatabase``.
+    :param defines:
+        The dictionary of the other defines the file is preprocessed with.
     :return:
-        Modified dictionary of defines or raises ``PreprocessorError`` if
-        an error occurred.
+        A list of ``Variant`` tuples in the order of their first
+        assignments, in which flag ``k`` is true if bit ``k`` of the
+        index of the assignment is set.
     """
-
-    # Options that can later be turned into function parameters.
-    include_paths = options.include_paths
-    should_keep_lines = options.should_keep_lines
-    should_substitute = options.should_substitute
-    default_content_type = options.default_content_type
-    input_filename = input_file.name
-
-    defines = defines or {}
-
-    # Ensure preprocessing isn't cyclic(?).
-    _preprocessed_files = _preprocessed_files or []
-    input_file_absolute_path = absolute_path(input_filename)
-    if input_file_absolute_path in _preprocessed_files:
-        raise PreprocessorError("detected recursive #include of '%s'"\
-                                % input_filename)
-    _preprocessed_files.append(input_file_absolute_path)
-
-    # Determine the content type and comment info for the input file.
-    comment_groups = content_types_db.get_comment_group_for_path(input_filename, default_content_type)
-    statement_regexps = get_statement_regexps(comment_groups)
-
-    # Process the input file.
-    # (Would be helpful if I knew anything about lexing and parsing
-    # simple grammars.)
-    input_lines = input_file.readlines()
-    if _depth == 0:
-        # Only at recursion depth 0 is the temporary buffer created.
-        temp_output_buffer = StringIO()
-    else:
-        # At deeper levels, the temporary buffer is the output file.
-        temp_output_buffer = output_file
-
-    defines['__FILE__'] = input_filename
-    SKIP, EMIT = range(2) # states
-    states = [(EMIT, # a state is (<emit-or-skip-lines-in-this-section>,
-               0, #             <have-emitted-in-this-if-block>,
-               0)]     #             <have-seen-'else'-in-this-if-block>)
-    line_number = 0
-    for line in input_lines:
-        line_number += 1
-        logger.debug("line %d: %r", line_number, line)
-        defines['__LINE__'] = line_number
-
-        # Is this line a preprocessor stmt line?
-        #XXX Could probably speed this up by optimizing common case of
-        #    line NOT being a preprocessor stmt line.
-        for statement_regexp in statement_regexps:
-            match = statement_regexp.match(line)
-            if match:
-                break
-        else:
-            match = None
-
-        if match:
-            op = match.group("op")
-            logger.debug("%r stmt (states: %r)", op, states)
-            if op == "define":
-                if not (states and states[-1][0] == SKIP):
-                    var, val = match.group("var", "val")
-                    if val is None:
-                        val = None
-                    else:
-                        try:
-                            val = eval(val, {}, {})
-                        except:
-                            pass
-                    defines[var] = val
-            elif op == "undef":
-                if not (states and states[-1][0] == SKIP):
-                    var = match.group("var")
-                    try:
-                        del defines[var]
-                    except KeyError:
-                        pass
-            elif op == "include":
-                if not (states and states[-1][0] == SKIP):
-                    if "var" in match.groupdict():
-                        # This is the second include form: #include VAR
-                        var = match.group("var")
-                        f = defines[var]
-                    else:
-                        # This is the first include form: #include "path"
-                        f = match.group("fname")
-
-                    for d in [os.path.dirname(input_filename)] + include_paths:
-                        fname = os.path.normpath(os.path.join(d, f))
-                        if os.path.exists(fname):
-                            break
-                    else:
-                        raise PreprocessorError(
-                            "could not find #include'd file "\
-                            "\"%s\" on include path: %r"\
-                            % (f, include_paths))
-                    with open(fname, 'rb') as f:
-                        defines = preprocess(f,
-                                             temp_output_buffer,
-                                             defines=defines,
-                                             options=options,
-                                             content_types_db=content_types_db,
-                                             _preprocessed_files=_preprocessed_files,
-                                             _depth=1)
-            elif op in ("if", "ifdef", "ifndef"):
-                if op == "if":
-                    expr = match.group("expr")
-                elif op == "ifdef":
-                    expr = "defined('%s')" % match.group("expr")
-                elif op == "ifndef":
-                    expr = "not defined('%s')" % match.group("expr")
-                try:
-                    if states and states[-1][0] == SKIP:
-                        # Were are nested in a SKIP-portion of an if-block.
-                        states.append((SKIP, 0, 0))
-                    elif _evaluate(expr, defines):
-                        states.append((EMIT, 1, 0))
-                    else:
-                        states.append((SKIP, 0, 0))
-                except KeyError:
-                    raise PreprocessorError("use of undefined variable in "\
-                                            "#%s stmt" % op, defines['__FILE__']
-                                            ,
-                                            defines['__LINE__'], line)
-            elif op == "elif":
-                expr = match.group("expr")
-                try:
-                    if states[-1][2]: # already had #else in this if-block
-                        raise PreprocessorError("illegal #elif after #else in "\
-                                                "same #if block",
-                                                defines['__FILE__'],
-                                                defines['__LINE__'], line)
-                    elif states[-1][1]: # if have emitted in this if-block
-                        states[-1] = (SKIP, 1, 0)
-                    elif states[:-1] and states[-2][0] == SKIP:
-                        # Were are nested in a SKIP-portion of an if-block.
-                        states[-1] = (SKIP, 0, 0)
-                    elif _evaluate(expr, defines):
-                        states[-1] = (EMIT, 1, 0)
-                    else:
-                        states[-1] = (SKIP, 0, 0)
-                except IndexError:
-                    raise PreprocessorError("#elif stmt without leading #if "\
-                                            "stmt", defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            elif op == "else":
-                try:
-                    if states[-1][2]: # already had #else in this if-block
-                        raise PreprocessorError("illegal #else after #else in "\
-                                                "same #if block",
-                                                defines['__FILE__'],
-                                                defines['__LINE__'], line)
-                    elif states[-1][1]: # if have emitted in this if-block
-                        states[-1] = (SKIP, 1, 1)
-                    elif states[:-1] and states[-2][0] == SKIP:
-                        # Were are nested in a SKIP-portion of an if-block.
-                        states[-1] = (SKIP, 0, 1)
-                    else:
-                        states[-1] = (EMIT, 1, 1)
-                except IndexError:
-                    raise PreprocessorError("#else stmt without leading #if "\
-                                            "stmt", defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            elif op == "endif":
-                try:
-                    states.pop()
-                except IndexError:
-                    raise PreprocessorError("#endif stmt without leading #if"\
-                                            "stmt", defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            elif op == "error":
-                if not (states and states[-1][0] == SKIP):
-                    error = match.group("error")
-                    raise PreprocessorError("#error: " + error,
-                                            defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            logger.debug("states: %r", states)
-            if should_keep_lines:
-                temp_output_buffer.write("\n")
+    defines = dict(defines or {})
+    if len(set(flags)) != len(flags):
+        raise PreprocessorError("a flag is given more than once: %s"
+                                % ", ".join(flags))
+    if len(flags) > MAX_VARIANT_FLAGS:
+        raise PreprocessorError("cannot enumerate variants of more than %d "
+                                "flags" % MAX_VARIANT_FLAGS)
+    if _custom_statement_ops or not _has_default_statement_handlers():
+        raise PreprocessorError("cannot enumerate variants with custom "
+                                "statement handlers")
+    analyzer = _VariantAnalyzer(flags, defines, options, content_types_db)
+    analyzer.analyze_file(input_filename, analyzer.all_assignments)
+    classes = analyzer.get_classes()
+    logger.debug("%d classes of assignments of %d flags", len(classes),
+                 len(flags))
+    variant_masks = []
+    outcome_indexes = {}
+    for mask in sorted(classes, key=lambda mask: mask & -mask):
+        index = (mask & -mask).bit_length() - 1
+        variant_defines = DefineEnvironment(defines)
+        for k, flag in enumerate(flags):
+            variant_defines[flag] = bool(index >> k & 1)
+        outcome = _render_variant(input_filename, variant_defines, options,
+                                  content_types_db)
+        if outcome in outcome_indexes:
+            variant_masks[outcome_indexes[outcome]][1] |= mask
         else:
-            try:
-                if states[-1][0] == EMIT:
-                    logger.debug("emit line (%s)" % states[-1][1])
-                    # Substitute all defines into line.
-                    # XXX Should avoid recursive substitutions. But that
-                    #     would be a pain right now.
-                    sline = line
-                    if should_substitute:
-                        for name in reversed(sorted(defines, key=len)):
-                            value = defines[name]
-                            sline = sline.replace(name, str(value))
-                    temp_output_buffer.write(sline)
-                elif should_keep_lines:
-                    logger.debug("keep blank line (%s)" % states[-1][1])
-                    temp_output_buffer.write("\n")
-                else:
-                    logger.debug("skip line (%s)" % states[-1][1])
-            except IndexError:
-                raise PreprocessorError("superfluous #endif before this line",
-                                        defines['__FILE__'],
-                                        defines['__LINE__'])
-    if len(states) > 1:
-        raise PreprocessorError("unterminated #if block", defines['__FILE__'],
-                                defines['__LINE__'])
-    elif len(states) < 1:
-        raise PreprocessorError("superfluous #endif on or before this line",
-                                defines['__FILE__'], defines['__LINE__'])
+            outcome_indexes[outcome] = len(variant_masks)
+            variant_masks.append([outcome, mask])
+    variants = []
+    for (output, error), mask in variant_masks:
+        assignments = [dict((flag, bool(index >> k & 1))
+                            for k, flag in enumerate(flags))
+                       for index in _iter_assignment_indexes(mask)]
+        variants.append(Variant(output, error, assignments,
+                                _get_assignment_cubes(mask, list(flags))))
+    return variants
 
-    #if temp_output_buffer != output_file:
-    #    temp_output_buffer.close()
-    if _depth == 0:
-        output_file.write(temp_output_buffer.getvalue())
-        temp_output_buffer.close()
 
-    return defines
+def print_variants(flags, variants, output_file):
+    """
+    Writes the assignments of flags that give each variant from
+    ``enumerate_variants()``, as -D options, one cube per line.
+    """
+    assignment_count = 1 << len(flags)
+    for number, variant in enumerate(variants):
+        output_file.write("variant %d: %d of %d assignments"
+                          % (number + 1, len(variant.assignments),
+                             assignment_count))
+        if variant.error is not None:
+            output_file.write(", error: %s" % variant.error)
+        output_file.write("\n")
+        for cube in variant.cubes:
+            output_file.write("  %s\n" % (" ".join(
+                "-D %s=%s" % (flag, cube[flag])
+                for flag in flags if flag in cube) or "(any)"))
 
 
 def parse_int_token(token):
@@ -662,6 +4803,33 @@ def parse_definitions(definitions):
     return defines
 
 
+def parse_variant_expr(expr):
+    """
+    Parses a variant expression of the form ``<name>:<definitions>``, where
+    <definitions> are comma-separated definition expressions, and returns
+    a (name, defines) tuple.
+
+    Usage::
+
+        >>> name, defines = parse_variant_expr('small:FOO=1,BAR')
+        >>> name, sorted(defines.items())
+        ('small', [('BAR', None), ('FOO', 1)])
+        >>> parse_variant_expr('plain:')
+        ('plain', {})
+        >>> parse_variant_expr('FOO=1')
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid variant expression `FOO=1`
+    """
+    name, separator, definitions = expr.partition(':')
+    name = name.strip()
+    if not separator or not name:
+        raise ValueError("Invalid variant expression `%s`" % expr)
+    return name, parse_definitions([definition for definition
+                                    in definitions.split(',')
+                                    if definition.strip()])
+
+
 def parse_command_line():
     """
     Parses the command line and returns a ``Namespace`` object
@@ -708,7 +4876,10 @@ def parse_command_line():
                         metavar="OUTPUT_FILE",
                         dest='output_filename',
                         default=None,
-                        help='Output file name (default STDOUT)')
+                        help='''\
+Output file name (default STDOUT). With
+--variant, "{variant}" in it is replaced by the
+name of each variant.''')
     parser.add_argument('-f',
                         '--force',
                         dest='should_force_overwrite',
@@ -727,6 +4898,17 @@ will be true) or it can be of the form
 <var>=<val>. An attempt will be made to convert
 <val> to an integer so -D 'FOO=0' will create a
 false value.""")
+    parser.add_argument('--variant',
+                        metavar="NAME:EXPR[,EXPR...]",
+                        dest='variants',
+                        type=parse_variant_expr,
+                        action='append',
+                        help='''\
+Preprocess the input once more with these -D
+definitions added, writing to the -o file name
+with "{variant}" replaced by NAME. Can be given
+any number of times; the input is read and
+parsed once for all variants.''')
     parser.add_argument('-I',
                         '--include',
                         metavar="DIR_PATH",
@@ -751,6 +4933,141 @@ numbers to stay constant.''')
                         help='''\
 Substitute #defines into emitted lines.
 (Disabled by default to avoid polluting strings)''')
+    parser.add_argument('-j',
+                        '--jobs',
+                        metavar="N",
+                        dest='jobs',
+                        type=int,
+                        default=None,
+                        help='''\
+With -s, substitute #defines into the output in
+N processes once all statements have been
+processed, for very large inputs.''')
+    parser.add_argument('--markers',
+                        dest='should_substitute_markers',
+                        action='store_true',
+                        default=False,
+                        help='''\
+With -s, only substitute #defines between the
+substitution markers of the content type, such
+as ${NAME} or @NAME@ (see content-types.yaml),
+instead of wherever their names occur.''')
+    parser.add_argument('--engine',
+                        dest='engine',
+                        choices=ENGINES,
+                        default=None,
+                        help='''\
+Preprocessing engine. "line" matches one line
+at a time. "buffer" reads the whole input and
+copies the text between preprocessor statements
+in bulk, which is faster for large files with
+few statements. "numpy" is the buffer engine
+with statement lines located by NumPy (falls
+back to "buffer" if NumPy is missing).
+"template" parses each file once and reuses
+the parsed form for #include'd files that are
+preprocessed again. "compiled" is the template
+engine with templates compiled into Python
+functions.
+(Default: line, or template with --cache-dir)''')
+    parser.add_argument('--partial',
+                        dest='should_partially_evaluate',
+                        action='store_true',
+                        default=False,
+                        help='''\
+Only evaluate #if blocks whose conditions read
+defined names alone and keep the others, with
+their statement lines, in the output. #define
+and #undef statements are kept as well, so the
+output can be preprocessed again with the
+remaining names defined.''')
+    parser.add_argument('--safe',
+                        dest='should_evaluate_safely',
+                        action='store_true',
+                        default=False,
+                        help='''\
+Evaluate expressions without eval(), for
+untrusted input. #if and #elif expressions may
+only use names, number and string literals,
+tuples, lists, comparisons, and, or, not and
+defined(); others are errors. #define values
+that are not such expressions are kept as
+strings.''')
+    parser.add_argument('--print-symbols',
+                        dest='should_print_symbols',
+                        action='store_true',
+                        default=False,
+                        help='''\
+Write the names of the defines that the input
+file and the files it #includes can read, one
+per line, to the output instead of the
+preprocessed file. The output only depends on
+the values of these defines.''')
+    parser.add_argument('--print-variants',
+                        metavar="NAME[,NAME...]",
+                        dest='variant_flags',
+                        default=None,
+                        help='''\
+Find the distinct outputs of the input file
+over all assignments of these boolean flags
+(at most %d), each defined as True or False,
+without preprocessing it for every assignment.
+Write the assignments that give each output as
+-D options, one set of them per line, leaving
+out the flags that do not matter, to the output
+instead of the preprocessed file.''' % MAX_VARIANT_FLAGS)
+    parser.add_argument('--prelude',
+                        metavar="PATH",
+                        dest='prelude',
+                        default=None,
+                        help='''\
+An #include'd file, such as a configuration file
+of #defines, whose expansion is kept in the
+--prelude-snapshot file.''')
+    parser.add_argument('--prelude-snapshot',
+                        metavar="PATH",
+                        dest='prelude_snapshot',
+                        default=None,
+                        help='''\
+Keep the output of the --prelude file and the
+defines it leaves behind in this file. Later
+runs that #include the prelude with the same
+defines reuse them instead of preprocessing it
+again. A snapshot is rewritten when the prelude
+or the files it #includes change. Once written,
+--prelude may be omitted.''')
+    parser.add_argument('--cache-dir',
+                        metavar="DIR_PATH",
+                        dest='cache_dir',
+                        default=None,
+                        help='''\
+Store parsed templates in this directory so
+that later runs skip parsing unchanged files.
+Used by the template and compiled engines.''')
+    parser.add_argument('--cache-output',
+                        dest='should_cache_output',
+                        action='store_true',
+                        default=False,
+                        help='''\
+Also store preprocessed outputs in the cache
+directory and reuse them when the input, the
+files it #includes, the defines and the options
+are unchanged.''')
+    parser.add_argument('--cache-size-limit',
+                        metavar="MEGABYTES",
+                        dest='cache_size_limit',
+                        type=int,
+                        default=DEFAULT_CACHE_SIZE_LIMIT,
+                        help='''\
+Remove the least recently used templates from
+the cache directory once it grows beyond this
+size. The output cache has a limit of its own.
+(Default: %d)''' % DEFAULT_CACHE_SIZE_LIMIT)
+    parser.add_argument('--cache-stats',
+                        dest='should_print_cache_stats',
+                        action='store_true',
+                        default=False,
+                        help='Display cache statistics when done.')
     parser.add_argument('--default-content-type',
                         metavar="CONTENT_TYPE",
                         dest='default_content_type',
@@ -829,6 +5146,171 @@ def set_up_logging(logger, level, should_be_quiet):
     return logging_level
 
 
+def _open_replacement_file(filename):
+    """
+    Opens a temporary file next to ``filename`` for its new contents,
+    which ``_replace_file()`` then renames over it at once.
+
+    :return:
+        A (file, temporary-path) tuple.
+    """
+    directory = os.path.dirname(os.path.realpath(filename))
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    return os.fdopen(fd, 'wb'), temp_path
+
+
+def _replace_file(temp_path, filename):
+    """
+    Renames a file written with ``_open_replacement_file()`` over
+    ``filename``, with the permissions of the file it replaces or, for a
+    new file, those of ``open()``.
+    """
+    filename = os.path.realpath(filename)
+    if os.path.exists(filename):
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+    os.chmod(temp_path, mode)
+    if sys.platform.startswith('win') and os.path.exists(filename):
+        # Windows cannot rename over an existing file.
+        os.remove(filename)
+    os.rename(temp_path, filename)
+
+
+def _write_output(options, write):
+    """
+    Calls ``write(output_file)`` with the standard output or, given
+    ``options.output_filename``, a file that replaces the output file at
+    once, and only if ``write`` succeeds.
+    """
+    output_filename = options.output_filename
+    if output_filename is None:
+        # No output file specified. Will output to stdout.
+        write(sys.stdout)
+        return
+    if (os.path.exists(output_filename)
+        and not options.should_force_overwrite):
+        raise IOError("File `%s` exists - cannot overwrite. (Use -f to force overwrite.)" % output_filename)
+    output_file, temp_path = _open_replacement_file(output_filename)
+    try:
+        with output_file:
+            write(output_file)
+    except:
+        os.remove(temp_path)
+        raise
+    _replace_file(temp_path, output_filename)
+
+
+def preprocess_variant_files(options, defines, content_types_db):
+    """
+    Preprocesses the input file of the command line for each of its
+    ``--variant`` options into the output file name with ``{variant}``
+    replaced by the name of the variant. A variant that fails is reported
+    without stopping the others, and its output file is left as it was.
+
+    :param options:
+        A ``Namespace`` of command-line options.
+    :param defines:
+        The dictionary of the defines of all variants.
+    :param content_types_db:
+        An instance of ``ContentTypesDatabase``.
+    :return:
+        The exit status: 0 if all variants were preprocessed, 1 otherwise.
+    """
+    output_filename = options.output_filename
+    if not output_filename or "{variant}" not in output_filename:
+        raise PreprocessorError("--variant requires an output file name "
+                                "with {variant} in it")
+    names = [name for name, variant_defines in options.variants]
+    if len(set(names)) != len(names):
+        raise PreprocessorError("a variant name is given more than once: %s"
+                                % ", ".join(names))
+    output_filenames = [output_filename.replace("{variant}", name)
+                        for name in names]
+    if not options.should_force_overwrite:
+        for filename in output_filenames:
+            if os.path.exists(filename):
+                raise IOError("File `%s` exists - cannot overwrite. (Use -f to force overwrite.)" % filename)
+    defines_list = []
+    for name, variant_defines in options.variants:
+        all_defines = DefineEnvironment(defines)
+        all_defines.update(variant_defines)
+        defines_list.append(all_defines)
+    replacements = []
+    try:
+        try:
+            for filename in output_filenames:
+                replacements.append(_open_replacement_file(filename))
+            with open(options.input_filename, 'rb') as input_file:
+                results = preprocess_variants(
+                    input_file,
+                    [output_file for output_file, temp_path in replacements],
+                    defines_list, options, content_types_db)
+        finally:
+            for output_file, temp_path in replacements:
+                output_file.close()
+    except:
+        for output_file, temp_path in replacements:
+            os.remove(temp_path)
+        raise
+    status = 0
+    for name, filename, result, (output_file, temp_path) in zip(
+            names, output_filenames, results, replacements):
+        if isinstance(result, PreprocessorError):
+            os.remove(temp_path)
+            sys.stderr.write("pepe: error: %s: %s\n" % (name, str(result)))
+            status = 1
+        else:
+            _replace_file(temp_path, filename)
+    return status
+
+
+def print_cache_stats(options, output_file):
+    """
+    Writes a summary of the usage of the statement matcher, template,
+    expression, include, disk and output caches.
+
+    :param options:
+        A ``Namespace`` of command-line options.
+    :param output_file:
+        The file to write to.
+    """
+    info = statement_matcher_cache.info()
+    output_file.write("pepe: statement matcher cache: %d hits, %d misses, "
+                      "%d entries\n" % (info.hits, info.misses, info.currsize))
+    info = template_cache.info()
+    output_file.write("pepe: memory cache: %d hits, %d misses, %d entries\n"
+                      % (info.hits, info.misses, info.currsize))
+    info = expression_cache.info()
+    output_file.write("pepe: expression cache: %d hits, %d misses, "
+                      "%d entries\n" % (info.hits, info.misses, info.currsize))
+    if getattr(options, 'should_memoize_includes', False):
+        info = include_cache.info()
+        output_file.write("pepe: include cache: %d hits, %d misses, "
+                          "%d entries\n"
+                          % (info.hits, info.misses, info.currsize))
+    if options.cache_dir:
+        disk_cache = get_disk_cache(options.cache_dir, options.cache_size_limit)
+        info = disk_cache.info()
+        output_file.write("pepe: disk cache: %d hits, %d misses, %d writes, "
+                          "%d evictions, %d entries (%d of %d bytes) in %s\n"
+                          % (info.hits, info.misses, info.writes,
+                             info.evictions, info.entries, info.currsize,
+                             info.maxsize, disk_cache.directory))
+        if options.should_cache_output:
+            output_cache = get_output_cache(options.cache_dir,
+                                            options.cache_size_limit)
+            info = output_cache.info()
+            output_file.write("pepe: output cache: %d hits, %d misses, "
+                              "%d writes, %d evictions, %d entries "
+                              "(%d of %d bytes) in %s\n"
+                              % (info.hits, info.misses, info.writes,
+                                 info.evictions, info.entries, info.currsize,
+                                 info.maxsize, output_cache.directory))
+
+
 def main():
     """
     Entry-point function.
@@ -838,50 +5320,56 @@ def main():
     logging_level = set_up_logging(logger, args.logging_level, args.should_be_quiet)
     defines = parse_definitions(args.definitions)
 
+    status = 0
     try:
         content_types_db = ContentTypesDatabase(DEFAULT_CONTENT_TYPES_FILE)
         for config_file in args.content_types_config_files:
             content_types_db.add_config_file(config_file)
 
-        output_filename = args.output_filename
-
-        with open(args.input_filename, 'rb') as input_file:
-            if output_filename is None:
-                # No output file specified. Will output to stdout.
-                preprocess(input_file=input_file,
-                           output_file=sys.stdout,
-                           defines=defines,
-                           options=args,
-                           content_types_db=content_types_db)
+        if args.should_print_symbols:
+            symbols = get_symbols_read(args.input_filename, args,
+                                       content_types_db, defines)
+            if symbols is None:
+                raise PreprocessorError("cannot determine the defines `%s` "
+                                        "reads" % args.input_filename)
+            _write_output(args, lambda output_file: output_file.write(
+                "".join("%s\n" % symbol for symbol in sorted(symbols))))
+        elif args.variant_flags:
+            flags = [flag.strip() for flag in args.variant_flags.split(",")
+                     if flag.strip()]
+            variants = enumerate_variants(args.input_filename, flags, args,
+                                          content_types_db, defines)
+            _write_output(args, lambda output_file: print_variants(
+                flags, variants, output_file))
+        elif args.variants:
+            status = preprocess_variant_files(args, defines,
+                                              content_types_db)
+        else:
+            if args.should_cache_output:
+                if not args.cache_dir:
+                    raise PreprocessorError("--cache-output requires --cache-dir")
+                preprocess_file = preprocess_cached
             else:
-                if os.path.exists(output_filename):
-                    if args.should_force_overwrite:
-                        # Overwrite existing file.
-                        with open(output_filename, 'wb') as output_file:
-                            preprocess(input_file=input_file,
-                                       output_file=output_file,
-                                       defines=defines,
-                                       options=args,
-                                       content_types_db=content_types_db)
-                    else:
-                        raise IOError("File `%s` exists - cannot overwrite. (Use -f to force overwrite.)" % args.output_filename)
-                else:
-                    # File doesn't exist and output file is provided, so write.
-                    with open(output_filename, 'wb') as output_file:
-                        preprocess(input_file=input_file,
-                                   output_file=output_file,
-                                   defines=defines,
-                                   options=args,
-                                   content_types_db=content_types_db)
+                preprocess_file = preprocess
+
+            with open(args.input_filename, 'rb') as input_file:
+                _write_output(args, lambda output_file: preprocess_file(
+                    input_file=input_file,
+                    output_file=output_file,
+                    defines=defines,
+                    options=args,
+                    content_types_db=content_types_db))
     except PreprocessorError, ex:
         if logging_level == logging.DEBUG:
             import traceback
             traceback.print_exc(file=sys.stderr)
         else:
             sys.stderr.write("pepe: error: %s\n" % str(ex))
-        return 1
+        status = 1
 
-    return 0
+    if args.should_print_cache_stats:
+        print_cache_stats(args, sys.stderr)
+    return status
 
 if __name__ == "__main__":
     sys.exit(main())
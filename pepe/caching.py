@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""
+Caches used by pepe to avoid repeating work across preprocessor runs.
+"""
+
+import os
+import tempfile
+from collections import namedtuple
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+DiskCacheInfo = namedtuple("DiskCacheInfo", ["hits", "misses", "writes",
+                                             "evictions", "entries",
+                                             "maxsize", "currsize"])
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that discards the least recently used entry
+    once it holds more than ``maxsize`` entries. Hits and misses
+    are counted so that cache effectiveness can be inspected.
+
+    Usage::
+
+        >>> cache = LRUCache(maxsize=2)
+        >>> cache.get('a') is None
+        True
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache.get('a')
+        1
+        >>> cache['c'] = 3
+        >>> 'b' in cache
+        False
+        >>> sorted(cache.keys())
+        ['a', 'c']
+        >>> cache.info()
+        CacheInfo(hits=1, misses=1, maxsize=2, currsize=2)
+        >>> cache.clear()
+        >>> cache.info()
+        CacheInfo(hits=0, misses=0, maxsize=2, currsize=0)
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for ``key`` marking it as the most
+        recently used entry, or ``default`` if there is no such entry.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def clear(self):
+        """
+        Discards all entries and resets the hit and miss counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Returns a ``CacheInfo`` tuple describing the cache usage.
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+
+class DiskCache(object):
+    """
+    A cache of pickled values stored as files in a directory, shared by
+    all processes using the same directory. Once the files take up more
+    than ``maxsize`` bytes, the least recently used ones are removed.
+    Files are written to a temporary name first and renamed into place,
+    so readers never see partially written entries.
+
+    :param directory:
+        The cache directory. Created when the first entry is written.
+    :param maxsize:
+        The size limit of the cache in bytes.
+
+    Usage::
+
+        >>> import shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> cache = DiskCache(os.path.join(directory, 'cache'), maxsize=1024)
+        >>> cache.get('a') is None
+        True
+        >>> cache['a'] = [1, 2, 3]
+        >>> cache.get('a')
+        [1, 2, 3]
+        >>> DiskCache(os.path.join(directory, 'cache')).get('a')
+        [1, 2, 3]
+        >>> cache['b'] = 'x' * 2048
+        >>> cache.get('b') is None
+        True
+        >>> info = cache.info()
+        >>> info.hits, info.misses, info.writes, info.evictions, info.entries
+        (1, 2, 1, 0, 1)
+        >>> shutil.rmtree(directory)
+    """
+
+    suffix = ".pickle"
+
+    def __init__(self, directory, maxsize=64 * 1024 * 1024):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._currsize = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _entries(self):
+        """
+        Returns a list of (modification-time, size, path) tuples of the
+        cache entries.
+        """
+        entries = []
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for filename in filenames:
+            if not filename.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat_result.st_mtime, stat_result.st_size, path))
+        return entries
+
+    def _get_currsize(self):
+        if self._currsize is None:
+            self._currsize = sum(size for mtime, size, path in self._entries())
+        return self._currsize
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for ``key`` or ``default`` if there is no
+        such entry. Entries that cannot be read are removed.
+
+        :param key:
+            A string that can be used as a file name, such as a hex digest.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError):
+            self.misses += 1
+            return default
+        except Exception:
+            # Corrupt or written by an incompatible version.
+            self._remove(path)
+            self.misses += 1
+            return default
+        try:
+            # Marks the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxsize:
+            if self._get_currsize() > self.maxsize:
+                self._evict()
+            return
+        currsize = self._get_currsize()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, self._path(key))
+        except:
+            self._remove(temp_path)
+            raise
+        self.writes += 1
+        self._currsize = currsize + len(data)
+        if self._currsize > self.maxsize:
+            self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        ``maxsize`` bytes.
+        """
+        entries = sorted(self._entries())
+        currsize = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if currsize <= self.maxsize:
+                break
+            self._remove(path)
+            currsize -= size
+            self.evictions += 1
+        self._currsize = currsize
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        for mtime, size, path in self._entries():
+            self._remove(path)
+        self._currsize = 0
+
+    def info(self):
+        """
+        Returns a ``DiskCacheInfo`` tuple describing the cache usage.
+        """
+        entries = self._entries()
+        self._currsize = sum(size for mtime, size, path in entries)
+        return DiskCacheInfo(self.hits, self.misses, self.writes,
+                             self.evictions, len(entries), self.maxsize,
+                             self._currsize)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
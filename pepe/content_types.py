@@ -32,6 +32,9 @@ comment-groups:
   text:
   - ['#', '']
 
+substitution-markers:
+  Makefile: ['@', '@']
+
 content-types:
   javascript:
   - .js
@@ -72,6 +75,10 @@ content-types:
 
 test_config = yaml.load(test_content_types_yaml)
 
+# The (prefix, suffix) between which defines are substituted for content
+# types without substitution markers.
+DEFAULT_SUBSTITUTION_MARKERS = ('${', '}')
+
 extension_case_transform_func = (lambda w: w)
 if sys.platform.startswith('win'):
     # We lower the pattern case on Windows to keep stuff case insensitive.
@@ -89,6 +96,7 @@ class ContentTypesDatabase(object):
         self._filename_map = {}
         self._content_types = {}
         self._comment_groups = {}
+        self._substitution_markers = {}
         self._test_config = test_config
 
         if config_file:
@@ -182,6 +190,57 @@ class ContentTypesDatabase(object):
                 "No comment groups for content type `%s` found." % content_type)
 
 
+    def get_substitution_markers_for_path(self, pathname,
+                                          default_content_type=None):
+        """
+        Obtains the substitution markers for a specified pathname.
+
+        :param pathname:
+            The path for which the substitution markers will be obtained.
+        :return:
+            Returns a (prefix, suffix) tuple. Files of unknown content
+            types and of content types without substitution markers use
+            ``DEFAULT_SUBSTITUTION_MARKERS``.
+
+        Usage:
+            >>> db = ContentTypesDatabase()
+            >>> db.add_config(db._test_config, 'test_config.yaml')
+            >>> g = db.get_substitution_markers_for_path
+            >>> g("Makefile")
+            ('@', '@')
+            >>> g("foobar.py")
+            ('${', '}')
+            >>> g("foobar.f37993ajdha73")
+            ('${', '}')
+        """
+        content_type = (self.guess_content_type(pathname)
+                        or default_content_type)
+        return self.get_substitution_markers(content_type)
+
+
+    def get_substitution_markers(self, content_type):
+        """
+        Returns the substitution markers for the specified content type.
+
+        :param content_type:
+            The content type for which the markers will be determined.
+        :return:
+            A (prefix, suffix) tuple, ``DEFAULT_SUBSTITUTION_MARKERS`` if
+            the content type has no substitution markers.
+
+        Usage:
+            >>> db = ContentTypesDatabase()
+            >>> db.add_config(db._test_config, 'test_config.yaml')
+            >>> g = db.get_substitution_markers
+            >>> g("Makefile")
+            ('@', '@')
+            >>> g("python")
+            ('${', '}')
+        """
+        return tuple(self._substitution_markers.get(
+            content_type, DEFAULT_SUBSTITUTION_MARKERS))
+
+
     def add_config_file(self, config_filename):
         """
         Parses the content.types file and updates the content types database.
@@ -210,6 +269,14 @@ class ContentTypesDatabase(object):
         self._comment_groups.update(comment_groups)
         self._content_types.update(content_types)
 
+        for content_type, markers in config.get('substitution-markers',
+                                                {}).iteritems():
+            if len(markers) != 2 or not markers[0]:
+                raise ValueError('''error: config parse error: \
+%s: Substitution markers must be a non-empty prefix and a suffix - `%s`''' % (
+                    config_filename, content_type))
+            self._substitution_markers[content_type] = tuple(markers)
+
         for content_type, patterns in content_types.iteritems():
             if not patterns:
                 raise ValueError('''error: config parse error: \
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""
+Copy-on-write dictionaries of defines.
+"""
+
+from collections import MutableMapping
+
+
+# Marks a name removed in the overlay of a ``DefineEnvironment``.
+_removed = object()
+
+
+class DefineEnvironment(MutableMapping):
+    """
+    A dictionary of defines layered over a base mapping that it never
+    changes. Writes and removals go to a thin overlay, so that a large
+    base dictionary can be shared by any number of environments instead
+    of being copied for each. The base may itself be a
+    ``DefineEnvironment``.
+
+    Usage::
+
+        >>> base = {'A': 1, 'B': 2}
+        >>> defines = DefineEnvironment(base)
+        >>> defines['A'] = 3
+        >>> del defines['B']
+        >>> defines['C'] = 4
+        >>> sorted(defines.items()), 'B' in defines, len(defines)
+        ([('A', 3), ('C', 4)], False, 2)
+        >>> sorted(base.items())
+        [('A', 1), ('B', 2)]
+        >>> sorted(defines.written_names)
+        ['A', 'B', 'C']
+        >>> defines.get('B', 0), defines.get('D', 0)
+        (0, 0)
+        >>> del defines['B']
+        Traceback (most recent call last):
+            ...
+        KeyError: 'B'
+    """
+
+    def __init__(self, base=None):
+        self.base = {} if base is None else base
+        # Values written over the base, or ``_removed``.
+        self.overlay = {}
+
+    @property
+    def written_names(self):
+        """
+        The names that have been set or removed.
+        """
+        return self.overlay.keys()
+
+    def copy(self):
+        """
+        Returns an environment with the same base and a copy of the
+        overlay.
+        """
+        environment = type(self)(self.base)
+        environment.overlay = self.overlay.copy()
+        return environment
+
+    def __getitem__(self, name):
+        overlay = self.overlay
+        if name in overlay:
+            value = overlay[name]
+            if value is _removed:
+                raise KeyError(name)
+            return value
+        return self.base[name]
+
+    def get(self, name, default=None):
+        overlay = self.overlay
+        if name in overlay:
+            value = overlay[name]
+            if value is _removed:
+                return default
+            return value
+        return self.base.get(name, default)
+
+    def __contains__(self, name):
+        overlay = self.overlay
+        if name in overlay:
+            return overlay[name] is not _removed
+        return name in self.base
+
+    def __setitem__(self, name, value):
+        self.overlay[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.overlay[name] = _removed
+
+    def discard(self, name):
+        """
+        Removes a name if it is defined. The removal is recorded in the
+        overlay even if it is not, so that it is among ``written_names``.
+
+            >>> defines = DefineEnvironment({'A': 1})
+            >>> defines.discard('B')
+            >>> 'B' in defines, defines.written_names
+            (False, ['B'])
+        """
+        self.overlay[name] = _removed
+
+    def __iter__(self):
+        # Names are iterated in the order of a dictionary of the same
+        # defines, which orders the substitution of names of equal length.
+        names = dict.fromkeys(self.base)
+        for name, value in self.overlay.iteritems():
+            if value is _removed:
+                names.pop(name, None)
+            else:
+                names[name] = None
+        return iter(names)
+
+    def __len__(self):
+        base = self.base
+        length = len(base)
+        for name, value in self.overlay.iteritems():
+            if name in base:
+                if value is _removed:
+                    length -= 1
+            elif value is not _removed:
+                length += 1
+        return length
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self))
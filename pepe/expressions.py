@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""
+Analysis and safe evaluation of the Python expressions used in #if and
+#elif statements.
+"""
+
+import __builtin__
+import ast
+import operator
+from collections import namedtuple
+
+
+ExpressionNames = namedtuple("ExpressionNames", ["names", "defined_names"])
+
+# Built-ins whose results only depend on their arguments.
+PURE_BUILTINS = frozenset([
+    'True', 'False', 'None', 'abs', 'all', 'any', 'bool', 'chr', 'cmp',
+    'dict', 'divmod', 'float', 'frozenset', 'hex', 'int', 'isinstance',
+    'len', 'list', 'long', 'max', 'min', 'oct', 'ord', 'pow', 'range',
+    'repr', 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'unichr',
+    'unicode', 'xrange',
+])
+
+
+class _NameCollector(ast.NodeVisitor):
+    def __init__(self):
+        self.loaded_names = set()
+        self.bound_names = set()
+        self.defined_names = set()
+        self.is_dynamic = False
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.loaded_names.add(node.id)
+        else:
+            # Targets of comprehensions and parameters of lambdas.
+            self.bound_names.add(node.id)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id == 'defined':
+            if (len(node.args) == 1 and not node.keywords
+                and node.starargs is None and node.kwargs is None
+                and isinstance(node.args[0], ast.Str)):
+                self.defined_names.add(node.args[0].s)
+            else:
+                self.is_dynamic = True
+        self.generic_visit(node)
+
+
+def analyze_expression(expression):
+    """
+    Finds the names an expression reads.
+
+    :param expression:
+        A Python expression as used in #if and #elif statements.
+    :return:
+        An ``ExpressionNames`` tuple of the set of ``names`` the expression
+        reads and the set of ``defined_names`` it checks with
+        ``defined('NAME')``, or ``None`` if the expression cannot be
+        parsed or calls ``defined()`` with anything but a string literal.
+
+    Usage::
+
+        >>> names = analyze_expression("FOO > 1 and defined('BAR')")
+        >>> sorted(names.names), sorted(names.defined_names)
+        (['FOO', 'defined'], ['BAR'])
+        >>> sorted(analyze_expression("[x for x in ITEMS if x]").names)
+        ['ITEMS']
+        >>> analyze_expression("defined(BAR)") is None
+        True
+        >>> analyze_expression("FOO >") is None
+        True
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except (SyntaxError, TypeError, ValueError):
+        return None
+    collector = _NameCollector()
+    collector.visit(tree)
+    if collector.is_dynamic:
+        return None
+    return ExpressionNames(collector.loaded_names - collector.bound_names,
+                           collector.defined_names)
+
+
+def get_expression_names(expression):
+    """
+    Returns the set of names an expression reads, including those it checks
+    with ``defined('NAME')``, or ``None`` if this cannot be determined.
+
+    Usage::
+
+        >>> sorted(get_expression_names("FOO or defined('BAR')"))
+        ['BAR', 'FOO', 'defined']
+    """
+    expression_names = analyze_expression(expression)
+    if expression_names is None:
+        return None
+    return expression_names.names | expression_names.defined_names
+
+
+def get_result_names(expression):
+    """
+    Finds the names whose values alone determine the result of an
+    expression, so that the result can be reused for the same values.
+
+    :return:
+        A sorted tuple of names, or ``None`` if the result may depend on
+        anything else: the expression cannot be analyzed, calls a
+        built-in not in ``PURE_BUILTINS`` or binds names, which list
+        comprehensions leak into the defines.
+
+    Usage::
+
+        >>> get_result_names("len(FOO) > 1 and defined('BAR')")
+        ('BAR', 'FOO', 'defined', 'len')
+        >>> get_result_names("open(FOO)") is None
+        True
+        >>> get_result_names("[x for x in ITEMS]") is None
+        True
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except (SyntaxError, TypeError, ValueError):
+        return None
+    collector = _NameCollector()
+    collector.visit(tree)
+    if collector.is_dynamic or collector.bound_names:
+        return None
+    for name in collector.loaded_names:
+        if (name != 'defined' and hasattr(__builtin__, name)
+            and name not in PURE_BUILTINS):
+            return None
+    return tuple(sorted(collector.loaded_names | collector.defined_names))
+
+
+# An expression compiled by ``compile_safe_expression()``. ``function`` is
+# called with the dictionary of defines and ``names`` are the names it
+# looks up.
+SafeExpression = namedtuple("SafeExpression", ["function", "names"])
+
+_COMPARISON_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+_UNARY_OPERATORS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+# Built-in names that can be read without eval(). Defines may hide them.
+_CONSTANT_NAMES = {'True': True, 'False': False, 'None': None}
+
+
+class _UnsupportedExpression(Exception):
+    pass
+
+
+class _SafeExpressionCompiler(object):
+    """
+    Turns the AST of an expression into nested functions of the dictionary
+    of defines. Each ``compile_<node-type>`` method returns a (function,
+    is-constant) tuple; constant subtrees are evaluated once.
+    """
+
+    def __init__(self):
+        self.names = set()
+
+    def compile(self, node):
+        method = getattr(self, "compile_" + type(node).__name__, None)
+        if method is None:
+            raise _UnsupportedExpression(type(node).__name__)
+        function, is_constant = method(node)
+        if is_constant:
+            try:
+                value = function({})
+            except Exception:
+                # Errors are raised when the expression is evaluated.
+                return function, False
+            return (lambda defines: value), True
+        return function, False
+
+    def compile_all(self, nodes):
+        compiled = [self.compile(node) for node in nodes]
+        return ([function for function, is_constant in compiled],
+                all(is_constant for function, is_constant in compiled))
+
+    def compile_Expression(self, node):
+        return self.compile(node.body)
+
+    def compile_Num(self, node):
+        value = node.n
+        return (lambda defines: value), True
+
+    def compile_Str(self, node):
+        value = node.s
+        return (lambda defines: value), True
+
+    def compile_Name(self, node):
+        name = node.id
+        if not isinstance(node.ctx, ast.Load) or name == 'defined':
+            raise _UnsupportedExpression(name)
+        self.names.add(name)
+        if name in _CONSTANT_NAMES:
+            default = _CONSTANT_NAMES[name]
+            return (lambda defines: defines.get(name, default)), False
+
+        def load(defines):
+            try:
+                return defines[name]
+            except KeyError:
+                raise NameError("name '%s' is not defined" % name)
+        return load, False
+
+    def compile_Tuple(self, node):
+        functions, is_constant = self.compile_all(node.elts)
+        return (lambda defines: tuple(f(defines) for f in functions)), is_constant
+
+    def compile_List(self, node):
+        functions, is_constant = self.compile_all(node.elts)
+        return (lambda defines: [f(defines) for f in functions]), is_constant
+
+    def compile_UnaryOp(self, node):
+        op = _UNARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise _UnsupportedExpression(type(node.op).__name__)
+        operand, is_constant = self.compile(node.operand)
+        return (lambda defines: op(operand(defines))), is_constant
+
+    def compile_BoolOp(self, node):
+        functions, is_constant = self.compile_all(node.values)
+        if isinstance(node.op, ast.And):
+            def evaluate(defines):
+                for function in functions:
+                    value = function(defines)
+                    if not value:
+                        return value
+                return value
+        else:
+            def evaluate(defines):
+                for function in functions:
+                    value = function(defines)
+                    if value:
+                        return value
+                return value
+        return evaluate, is_constant
+
+    def compile_Compare(self, node):
+        left, is_constant = self.compile(node.left)
+        comparators, are_constant = self.compile_all(node.comparators)
+        ops = []
+        for op in node.ops:
+            if type(op) not in _COMPARISON_OPERATORS:
+                raise _UnsupportedExpression(type(op).__name__)
+            ops.append(_COMPARISON_OPERATORS[type(op)])
+        comparisons = zip(ops, comparators)
+
+        def evaluate(defines):
+            a = left(defines)
+            for op, comparator in comparisons:
+                b = comparator(defines)
+                result = op(a, b)
+                if not result:
+                    return result
+                a = b
+            return result
+        return evaluate, is_constant and are_constant
+
+    def compile_Call(self, node):
+        if (not isinstance(node.func, ast.Name) or node.func.id != 'defined'
+            or len(node.args) != 1 or node.keywords
+            or node.starargs is not None or node.kwargs is not None):
+            raise _UnsupportedExpression("call")
+        argument, is_constant = self.compile(node.args[0])
+
+        def defined(defines):
+            if 'defined' in defines:
+                # A define hides the built-in function, as with eval().
+                function = defines['defined']
+                return function(argument(defines))
+            return argument(defines) in defines
+        return defined, False
+
+
+def compile_safe_expression(expression):
+    """
+    Compiles an expression into a function of the dictionary of defines
+    without using ``eval()``. Only names, number and string literals,
+    tuples, lists, comparisons, ``and``, ``or``, ``not``, unary ``-`` and
+    ``+`` and calls of ``defined()`` are allowed. Names are looked up in
+    the defines alone, apart from ``True``, ``False`` and ``None``. Other
+    built-ins cannot be reached.
+
+    :return:
+        A ``SafeExpression``, or ``None`` if the expression cannot be
+        parsed or uses anything else.
+
+    Usage::
+
+        >>> e = compile_safe_expression("A > 1 and not defined('B')")
+        >>> e.function({'A': 2}), e.function({'A': 2, 'B': 0})
+        (True, False)
+        >>> sorted(e.names)
+        ['A']
+        >>> compile_safe_expression("C in ('x', 'y')").function({'C': 'y'})
+        True
+        >>> compile_safe_expression("__import__('os')") is None
+        True
+        >>> compile_safe_expression("A.real") is None
+        True
+        >>> compile_safe_expression("UNDEFINED").function({})
+        Traceback (most recent call last):
+            ...
+        NameError: name 'UNDEFINED' is not defined
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+        compiler = _SafeExpressionCompiler()
+        function, is_constant = compiler.compile(tree)
+    except (SyntaxError, TypeError, ValueError, RuntimeError,
+            _UnsupportedExpression):
+        return None
+    return SafeExpression(function, frozenset(compiler.names))
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -69,5 +69,8 @@ Topic :: Text Processing :: Filters""".split("\n"),
         },
     zip_safe=False,
     install_requires=install_requires,
+    extras_require={
+        'numpy': ['numpy'],
+        },
     **extra
     )
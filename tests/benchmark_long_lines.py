@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Benchmark statement matching on very long lines.
+
+Minified assets often consist of a single line that is several megabytes
+long. Matching such a line must take time linear in its length, including
+lines that start like a preprocessor statement but are not one. Scanning
+a whole buffer for statements must likewise take time linear in the
+length of runs of blank lines.
+
+Usage:
+    python benchmark_long_lines.py [LINE_LENGTH]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pepe
+
+
+COMMENT_GROUPS = [['/*', '*/'], ['//', '']]
+
+# Length of the lines handed to the full statement regular expressions,
+# which backtrack polynomially on long runs of whitespace.
+REGEXP_LINE_LENGTH = 1000
+
+# Number of lines in the runs of blank lines scanned for statements.
+BLANK_LINE_COUNT = 100000
+
+
+def make_lines(length):
+    """Returns (name, line) pairs of roughly ``length`` characters."""
+    return [
+        ("minified code", ("var a=1;" * (length // 8)) + "\n"),
+        ("source map comment",
+         "//# sourceMappingURL=data:application/json;base64,"
+         + ("QUJD" * (length // 4)) + "\n"),
+        ("statement with spaces",
+         "// #if a" + (" " * length) + "b\n"),
+        ("statement with words",
+         "/* #if " + ("a " * (length // 2)) + "b */ x\n"),
+        ("long define",
+         "// #define FOO " + ("x " * (length // 2)) + "\n"),
+    ]
+
+
+def make_blank_runs(count):
+    """Returns (name, text) pairs with runs of ``count`` blank lines."""
+    return [
+        ("empty lines", ("\n" * count) + "x\n"),
+        ("whitespace lines", (" \t\n" * count) + "x\n"),
+        ("before a statement", ("\n" * count) + "// #if A\n"),
+    ]
+
+
+def time_call(function, line):
+    start = time.time()
+    function(line)
+    return time.time() - start
+
+
+def match_regexps(statement_regexps):
+    def match(line):
+        for statement_regexp in statement_regexps:
+            if statement_regexp.match(line):
+                break
+    return match
+
+
+def main(argv):
+    length = int(argv[1]) if len(argv) > 1 else 5 * 1024 * 1024
+    statement_matcher = pepe.StatementMatcher(COMMENT_GROUPS)
+    statement_regexps = pepe.get_statement_regexps(COMMENT_GROUPS)
+
+    print "StatementMatcher.match() on %d character lines:" % length
+    for name, line in make_lines(length):
+        print "  %-24s %8.4fs" % (name, time_call(statement_matcher.match, line))
+
+    print
+    print "StatementMatcher.match() vs. statement regexps on %d character lines:"\
+          % REGEXP_LINE_LENGTH
+    for name, line in make_lines(REGEXP_LINE_LENGTH):
+        print "  %-24s %8.4fs %8.4fs" % (
+            name,
+            time_call(statement_matcher.match, line),
+            time_call(match_regexps(statement_regexps), line))
+
+    print
+    print "Scanning runs of %d blank lines for statements:" % BLANK_LINE_COUNT
+    for name, text in make_blank_runs(BLANK_LINE_COUNT):
+        print "  %-24s %8.4fs" % (name, time_call(
+            lambda text: pepe._scan_statements(text, statement_matcher), text))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
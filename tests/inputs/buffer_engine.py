@@ -0,0 +1,20 @@
+#!python
+# Exercise the buffer engine: literal blocks between statements are
+# copied as whole slices.
+
+# #define FOO 1
+def foo():
+    return 1
+
+# #if FOO
+def bar():
+    return 2
+# #else
+def bar():
+    return 3
+# #endif
+
+# #if __LINE__ == 17
+print "__LINE__ is 17"
+# #endif
+print "done"
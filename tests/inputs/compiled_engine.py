@@ -0,0 +1,214 @@
+#!python
+# Exercise the compiled engine on a file whose #if blocks are nested
+# more deeply than Python can indent blocks: it cannot be compiled, so
+# it is rendered by the template engine instead.
+
+# #define DEPTH 100
+# #define NAME "deep"
+# #if DEPTH >= 1
+# #if DEPTH >= 2
+# #if DEPTH >= 3
+# #if DEPTH >= 4
+# #if DEPTH >= 5
+# #if DEPTH >= 6
+# #if DEPTH >= 7
+# #if DEPTH >= 8
+# #if DEPTH >= 9
+# #if DEPTH >= 10
+# #if DEPTH >= 11
+# #if DEPTH >= 12
+# #if DEPTH >= 13
+# #if DEPTH >= 14
+# #if DEPTH >= 15
+# #if DEPTH >= 16
+# #if DEPTH >= 17
+# #if DEPTH >= 18
+# #if DEPTH >= 19
+# #if DEPTH >= 20
+# #if DEPTH >= 21
+# #if DEPTH >= 22
+# #if DEPTH >= 23
+# #if DEPTH >= 24
+# #if DEPTH >= 25
+# #if DEPTH >= 26
+# #if DEPTH >= 27
+# #if DEPTH >= 28
+# #if DEPTH >= 29
+# #if DEPTH >= 30
+# #if DEPTH >= 31
+# #if DEPTH >= 32
+# #if DEPTH >= 33
+# #if DEPTH >= 34
+# #if DEPTH >= 35
+# #if DEPTH >= 36
+# #if DEPTH >= 37
+# #if DEPTH >= 38
+# #if DEPTH >= 39
+# #if DEPTH >= 40
+# #if DEPTH >= 41
+# #if DEPTH >= 42
+# #if DEPTH >= 43
+# #if DEPTH >= 44
+# #if DEPTH >= 45
+# #if DEPTH >= 46
+# #if DEPTH >= 47
+# #if DEPTH >= 48
+# #if DEPTH >= 49
+# #if DEPTH >= 50
+# #if DEPTH >= 51
+# #if DEPTH >= 52
+# #if DEPTH >= 53
+# #if DEPTH >= 54
+# #if DEPTH >= 55
+# #if DEPTH >= 56
+# #if DEPTH >= 57
+# #if DEPTH >= 58
+# #if DEPTH >= 59
+# #if DEPTH >= 60
+# #if DEPTH >= 61
+# #if DEPTH >= 62
+# #if DEPTH >= 63
+# #if DEPTH >= 64
+# #if DEPTH >= 65
+# #if DEPTH >= 66
+# #if DEPTH >= 67
+# #if DEPTH >= 68
+# #if DEPTH >= 69
+# #if DEPTH >= 70
+# #if DEPTH >= 71
+# #if DEPTH >= 72
+# #if DEPTH >= 73
+# #if DEPTH >= 74
+# #if DEPTH >= 75
+# #if DEPTH >= 76
+# #if DEPTH >= 77
+# #if DEPTH >= 78
+# #if DEPTH >= 79
+# #if DEPTH >= 80
+# #if DEPTH >= 81
+# #if DEPTH >= 82
+# #if DEPTH >= 83
+# #if DEPTH >= 84
+# #if DEPTH >= 85
+# #if DEPTH >= 86
+# #if DEPTH >= 87
+# #if DEPTH >= 88
+# #if DEPTH >= 89
+# #if DEPTH >= 90
+# #if DEPTH >= 91
+# #if DEPTH >= 92
+# #if DEPTH >= 93
+# #if DEPTH >= 94
+# #if DEPTH >= 95
+# #if DEPTH >= 96
+# #if DEPTH >= 97
+# #if DEPTH >= 98
+# #if DEPTH >= 99
+# #if DEPTH >= 100
+print "NAME at depth DEPTH on line __LINE__"
+# #ifdef SHALLOW
+print "shallow"
+# #else
+print "not shallow"
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+# #endif
+print "done on line __LINE__"
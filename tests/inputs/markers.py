@@ -0,0 +1,9 @@
+#!python
+
+# #define VAR foo
+# #define GREETING "hello ${VAR}"
+
+if __name__ == '__main__':
+    ${VAR} = 1
+    print ${VAR}, "VAR", "${GREETING}", "${UNDEFINED}"
+
@@ -0,0 +1,10 @@
+#!python
+
+# #define VAR foo
+# #define LINE_INFO "line __LINE__"
+
+if __name__ == '__main__':
+    foo = 1
+    print VAR, LINE_INFO
+# #undef VAR
+    print VAR, LINE_INFO
@@ -0,0 +1,21 @@
+#!python
+# Exercise partial evaluation: #if blocks that only depend on defined
+# names are evaluated, the others are kept for a later pass.
+
+# #define LOCAL 1
+# #if PLATFORM == "linux"
+print "linux"
+#   #if VARIANT
+print "variant"
+#   #endif
+# #else
+print "not linux"
+# #endif
+# #if VARIANT > 1
+#   #define EXTRA 2
+# #elif LOCAL
+print "local"
+# #endif
+# #ifdef EXTRA
+print "extra"
+# #endif
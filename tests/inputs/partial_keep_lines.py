@@ -0,0 +1,22 @@
+#!python
+# Exercise partial evaluation with -k: the lines of dropped branches are
+# kept as empty lines where they were, also after kept branches, so that
+# a later pass puts every line in the same place as a single pass.
+
+# #if PLATFORM == "linux"
+#   #ifdef VARIANT
+print "variant"
+#   #elif 1
+print "no variant"
+#     #define EXTRA 1
+#   #elif PLATFORM
+print "platform"
+#   #endif
+# #endif
+# #if VARIANT
+print "variant"
+# #elif PLATFORM == "windows"
+print "windows"
+# #else
+print "line __LINE__"
+# #endif
@@ -0,0 +1,24 @@
+#!python
+# Exercise the template engine: the file is parsed into a tree of
+# literal text, statements and #if blocks that is then rendered.
+
+# #define FOO 1
+# #define BAR "bar"
+# #if FOO
+#   #if BAR == "baz"
+print "baz"
+#   #elif BAR == "bar"
+print "bar"
+#   #else
+print "neither"
+#   #endif
+# #else
+print "no FOO"
+# #endif
+# #ifndef BAZ
+print "BAZ is not defined"
+# #endif
+# #if __LINE__ == 21
+print "__LINE__ is 21"
+# #endif
+print "done"
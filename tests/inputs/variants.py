@@ -0,0 +1,12 @@
+# #if DEBUG and VERBOSE
+print "tracing"
+# #elif DEBUG
+print "debugging"
+# #endif
+# #ifndef NAME
+# #define NAME "pepe"
+# #endif
+# #if LEGACY
+# #define NAME "old"
+# #endif
+print NAME
@@ -0,0 +1,12 @@
+#!python
+# Exercise the buffer engine: literal blocks between statements are
+# copied as whole slices.
+
+def foo():
+    return 1
+
+def bar():
+    return 2
+
+print "__LINE__ is 17"
+print "done"
@@ -0,0 +1,8 @@
+#!python
+# Exercise the compiled engine on a file whose #if blocks are nested
+# more deeply than Python can indent blocks: it cannot be compiled, so
+# it is rendered by the template engine instead.
+
+print "deep at depth 100 on line 108"
+print "not shallow"
+print "done on line 214"
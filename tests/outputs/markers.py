@@ -0,0 +1,7 @@
+#!python
+
+
+if __name__ == '__main__':
+    foo = 1
+    print foo, "VAR", "hello ${VAR}", "${UNDEFINED}"
+
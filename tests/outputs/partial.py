@@ -0,0 +1,17 @@
+#!python
+# Exercise partial evaluation: #if blocks that only depend on defined
+# names are evaluated, the others are kept for a later pass.
+
+# #define LOCAL 1
+print "linux"
+#   #if VARIANT
+print "variant"
+#   #endif
+# #if VARIANT > 1
+#   #define EXTRA 2
+# #else
+print "local"
+# #endif
+# #ifdef EXTRA
+print "extra"
+# #endif
@@ -0,0 +1,8 @@
+#!python
+# Exercise the template engine: the file is parsed into a tree of
+# literal text, statements and #if blocks that is then rendered.
+
+print "bar"
+print "BAZ is not defined"
+print "__LINE__ is 21"
+print "done"
@@ -0,0 +1,12 @@
+variant 1: 4 of 16 assignments
+  -D DEBUG=False -D LEGACY=False
+variant 2: 2 of 16 assignments
+  -D DEBUG=True -D VERBOSE=False -D LEGACY=False
+variant 3: 2 of 16 assignments
+  -D DEBUG=True -D VERBOSE=True -D LEGACY=False
+variant 4: 4 of 16 assignments
+  -D DEBUG=False -D LEGACY=True
+variant 5: 2 of 16 assignments
+  -D DEBUG=True -D VERBOSE=False -D LEGACY=True
+variant 6: 2 of 16 assignments
+  -D DEBUG=True -D VERBOSE=True -D LEGACY=True
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Tests the compiled engine (--engine compiled)."""
+
+import os
+import sys
+import unittest
+from argparse import Namespace
+from StringIO import StringIO
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import pepe
+
+
+COMMENT_GROUPS = [['#', '']]
+
+TEXT = """\
+# #define A 1
+# #if A
+A x
+# #endif
+"""
+
+
+def get_nested_text(depth):
+    lines = ["# #if %d" % i for i in range(1, depth + 1)]
+    lines.append("deep")
+    lines.extend(["# #endif"] * depth)
+    return "\n".join(lines) + "\n"
+
+
+class CompiledEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.content_types_db = pepe.ContentTypesDatabase(
+            pepe.DEFAULT_CONTENT_TYPES_FILE)
+        pepe.template_cache.clear()
+
+    def preprocess(self, filename, engine, **options):
+        options = Namespace(default_content_type=None, include_paths=[],
+                            should_keep_lines=options.get('keep_lines', False),
+                            should_substitute=options.get('substitute', False),
+                            should_evaluate_safely=options.get('safe', False),
+                            should_substitute_markers=options.get('markers',
+                                                                  False),
+                            engine=engine)
+        output = StringIO()
+        with open(filename, 'rb') as input_file:
+            pepe.preprocess(input_file, output, {}, options,
+                            self.content_types_db)
+        return output.getvalue()
+
+    def get_template(self, filename):
+        with open(filename, 'rb') as input_file:
+            return pepe.get_template(input_file, COMMENT_GROUPS)
+
+    def test_fallback_to_template_engine(self):
+        template = pepe.parse_template(get_nested_text(100), COMMENT_GROUPS)
+        self.assertEqual(pepe.compile_template(template), None)
+        self.assertEqual(template.render_functions,
+                         {(False, False, False, None): None})
+        template = pepe.parse_template(get_nested_text(5), COMMENT_GROUPS)
+        self.assertNotEqual(pepe.compile_template(template), None)
+
+    def test_fallback_output(self):
+        filename = os.path.join(TESTS_DIR, "inputs", "compiled_engine.py")
+        for options in [{}, {'keep_lines': True},
+                        {'substitute': True, 'safe': True}]:
+            self.assertEqual(self.preprocess(filename, 'compiled', **options),
+                             self.preprocess(filename, 'line', **options))
+        template = self.get_template(filename)
+        self.assertEqual(set(template.render_functions.values()), set([None]))
+
+    def test_render_functions(self):
+        filename = os.path.join(TESTS_DIR, "inputs", "if.py")
+        markers = self.content_types_db.get_substitution_markers_for_path(
+            filename)
+        expected_keys = set()
+        for keep_lines in [False, True]:
+            for substitute in [False, True]:
+                for safe in [False, True]:
+                    for between_markers in [False, True]:
+                        options = dict(keep_lines=keep_lines,
+                                       substitute=substitute, safe=safe,
+                                       markers=between_markers)
+                        self.assertEqual(
+                            self.preprocess(filename, 'compiled', **options),
+                            self.preprocess(filename, 'line', **options))
+                        expected_keys.add((
+                            keep_lines, substitute, safe,
+                            between_markers and substitute and markers or None))
+        render_functions = self.get_template(filename).render_functions
+        self.assertEqual(set(render_functions), expected_keys)
+        self.assertTrue(None not in render_functions.values())
+
+    def test_template_to_python(self):
+        template = pepe.parse_template(TEXT, COMMENT_GROUPS)
+        source, namespace = pepe.template_to_python(template, True, False,
+                                                    True)
+        self.assertEqual(source, """\
+def render(defines, write, context):
+    defines['__LINE__'] = 1
+    defines['A'] = _value1
+    write('\\n')
+    defines['__LINE__'] = 2
+    _taken2 = bool(_evaluate('A', defines, _expression3, True))
+    write('\\n')
+    if _taken2:
+        write(_text4)
+        defines['__LINE__'] = 3
+    else:
+        write('\\n')
+    defines['__LINE__'] = 4
+    write('\\n')
+    return defines
+""")
+        self.assertEqual(namespace['_text4'], "A x\n")
+
+        source, namespace = pepe.template_to_python(template, False, True,
+                                                    False, ('@', '@'))
+        self.assertEqual(source, """\
+def render(defines, write, context):
+    defines['__LINE__'] = 1
+    defines['A'] = _value1
+    defines['__LINE__'] = 2
+    _taken2 = bool(_evaluate('A', defines, _expression3))
+    if _taken2:
+        _write_substituted(_lines4, 3, defines, write, _markers5)
+        defines['__LINE__'] = 3
+    else:
+        pass
+    defines['__LINE__'] = 4
+    return defines
+""")
+        self.assertEqual(namespace['_markers5'], ('@', '@'))
+
+
+def suite():
+    """Return a unittest.TestSuite to be used by test.py."""
+    return unittest.makeSuite(CompiledEngineTestCase)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(suite())
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Tests preprocessing with copy-on-write define environments."""
+
+import os
+import sys
+import unittest
+from argparse import Namespace
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pepe
+from pepe.environment import DefineEnvironment
+
+
+ENGINES = ['line', 'buffer', 'template', 'compiled']
+
+
+class DefineEnvironmentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.content_types_db = pepe.ContentTypesDatabase(
+            pepe.DEFAULT_CONTENT_TYPES_FILE)
+
+    def preprocess(self, text, defines, engine):
+        input_file = StringIO(text)
+        input_file.name = "foo.py"
+        output_file = StringIO()
+        options = Namespace(default_content_type=None, include_paths=[],
+                            should_keep_lines=False, should_substitute=True,
+                            engine=engine)
+        defines = pepe.preprocess(input_file, output_file, defines, options,
+                                  self.content_types_db)
+        return output_file.getvalue(), defines
+
+    def test_empty_environment_is_written(self):
+        for engine in ENGINES:
+            defines = DefineEnvironment({})
+            output, result = self.preprocess("# #define A 1\n", defines,
+                                             engine)
+            self.assertTrue(result is defines, engine)
+            self.assertEqual(defines['A'], 1, engine)
+
+    def test_substitution_order(self):
+        # Names of equal length are substituted in the order of the
+        # defines, so an environment must order them as a dictionary does.
+        text = "# #define Y A\nY A\n"
+        for base in [{}, {'A': 'B', 'B': 2}, {'A': 0, 'Y': 1}]:
+            for engine in ENGINES:
+                self.assertEqual(
+                    self.preprocess(text, DefineEnvironment(base), engine)[0],
+                    self.preprocess(text, dict(base), engine)[0],
+                    (base, engine))
+
+
+def suite():
+    """Return a unittest.TestSuite to be used by test.py."""
+    return unittest.makeSuite(DefineEnvironmentTestCase)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(suite())
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Tests memoization of #include'd files (--memoize-includes)."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from argparse import Namespace
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pepe
+
+
+class IncludeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.content_types_db = pepe.ContentTypesDatabase(
+            pepe.DEFAULT_CONTENT_TYPES_FILE)
+        pepe.include_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(text)
+        return path
+
+    def preprocess(self, filename, defines, **options):
+        options = Namespace(default_content_type=None,
+                            include_paths=[self.directory],
+                            should_keep_lines=False,
+                            should_substitute=options.get('substitute', False),
+                            should_memoize_includes=True,
+                            engine=options.get('engine'))
+        output = StringIO()
+        with open(filename, 'rb') as input_file:
+            pepe.preprocess(input_file, output, dict(defines), options,
+                            self.content_types_db)
+        return output.getvalue()
+
+    def test_hit(self):
+        self.write_file("inc.py", "# #if A\na\n# #endif\n# #define C 1\n")
+        main = self.write_file("main.py", '# #include "inc.py"\nC\n')
+        self.assertEqual(self.preprocess(main, {'A': 1, 'B': 1}), "a\nC\n")
+        self.assertEqual(pepe.include_cache.info().hits, 0)
+        # B is not read by inc.py.
+        self.assertEqual(self.preprocess(main, {'A': 1, 'B': 2}), "a\nC\n")
+        self.assertEqual(pepe.include_cache.info().hits, 1)
+        # The replayed expansion also defines C.
+        self.assertEqual(self.preprocess(main, {'A': 1}, substitute=True),
+                         "a\n1\n")
+
+    def test_invalidation_by_read_define(self):
+        self.write_file("inc.py", "# #if A\na\n# #endif\n")
+        main = self.write_file("main.py", '# #include "inc.py"\n')
+        self.assertEqual(self.preprocess(main, {'A': 1}), "a\n")
+        self.assertEqual(self.preprocess(main, {'A': 0}), "")
+        self.assertEqual(pepe.include_cache.info().hits, 0)
+
+    def test_invalidation_by_substituted_value(self):
+        # AA is substituted with B, which is then substituted in turn.
+        self.write_file("inc.py", "AA\n")
+        main = self.write_file("main.py", '# #include "inc.py"\n')
+        self.assertEqual(self.preprocess(main, {'AA': 'B', 'B': 'x'},
+                                         substitute=True), "x\n")
+        self.assertEqual(self.preprocess(main, {'AA': 'B', 'B': 'y'},
+                                         substitute=True), "y\n")
+        self.assertEqual(pepe.include_cache.info().hits, 0)
+        self.assertEqual(self.preprocess(main, {'AA': 'B', 'B': 'y'},
+                                         substitute=True), "y\n")
+        self.assertEqual(pepe.include_cache.info().hits, 1)
+
+    def test_removed_defines(self):
+        # The #undef'd names are not read, so the recorded expansions must
+        # remove them even if they were not defined when recorded.
+        self.write_file("h1.py", "# #define B 0\n# #undef B\n")
+        self.write_file("h2.py", 'A\n# #include "h1.py"\n')
+        self.write_file("u.py", "# #undef B\n")
+        for include in ["h2.py", "u.py"]:
+            main = self.write_file("main.py", '# #include "%s"\n'
+                                              '# #ifdef B\n'
+                                              'B\n'
+                                              '# #endif\n' % include)
+            for engine in ['line', 'template', 'compiled']:
+                pepe.include_cache.clear()
+                expected = "A\n" if include == "h2.py" else ""
+                self.assertEqual(self.preprocess(main, {}, engine=engine),
+                                 expected)
+                self.assertEqual(self.preprocess(main, {'B': 0},
+                                                 engine=engine),
+                                 expected)
+                self.assertEqual(pepe.include_cache.info().hits, 1)
+
+    def test_invalidation_by_changed_file(self):
+        include = self.write_file("inc.py", "a\n")
+        main = self.write_file("main.py", '# #include "inc.py"\n')
+        self.assertEqual(self.preprocess(main, {}), "a\n")
+        self.write_file("inc.py", "bb\n")
+        os.utime(include, (0, 0))
+        self.assertEqual(self.preprocess(main, {}), "bb\n")
+        self.assertEqual(pepe.include_cache.info().hits, 0)
+
+
+def suite():
+    """Return a unittest.TestSuite to be used by test.py."""
+    return unittest.makeSuite(IncludeCacheTestCase)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(suite())
+    sys.exit(not result.wasSuccessful())
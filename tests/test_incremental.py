@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Compares IncrementalPreprocessor.update() with full preprocess() runs."""
+
+import os
+import random
+import sys
+import unittest
+from argparse import Namespace
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pepe
+
+
+NAMES = ['A', 'B', 'FOO']
+
+# Pieces that edits insert, including partial statements and lines that
+# do not end in a newline.
+EDIT_PIECES = ['\n', 'x', '1', 'A', 'FOO', '__LINE__', '# #define FOO 2',
+               '# #define A ', '# #undef A\n', '# #if A\n', '# #endif\n',
+               '# #else\n', '# #ifdef B\n']
+
+
+def generate_text(r):
+    lines = []
+    depth = 0
+    for i in range(r.randint(0, 12)):
+        k = r.random()
+        if k < 0.2:
+            lines.append("# #define %s %s" % (r.choice(NAMES),
+                                              r.choice(['1', '0', '21', 'x'])))
+        elif k < 0.3:
+            lines.append("# #undef %s" % r.choice(NAMES))
+        elif k < 0.4:
+            lines.append("# #if %s" % r.choice(NAMES + ['1', '0']))
+            depth += 1
+        elif k < 0.45 and depth:
+            lines.append("# #else")
+        elif k < 0.55 and depth:
+            lines.append("# #endif")
+            depth -= 1
+        else:
+            lines.append(" ".join(r.choice(NAMES + ['x', '__LINE__'])
+                                  for j in range(r.randint(0, 3))))
+    lines.extend(["# #endif"] * depth)
+    text = "\n".join(lines)
+    if r.random() < 0.5:
+        text += "\n"
+    return text
+
+
+def edit_text(r, text):
+    start = r.randint(0, len(text))
+    k = r.random()
+    if k < 0.3:
+        # Appends to the end, which may extend the last line.
+        start = len(text)
+        end = start
+    elif k < 0.6:
+        end = start
+    else:
+        end = min(len(text), start + r.randint(1, 6))
+    return text[:start] + r.choice(EDIT_PIECES) + text[end:]
+
+
+def preprocess_text(text, defines, options, content_types_db):
+    input_file = StringIO(text)
+    input_file.name = "foo.py"
+    output_file = StringIO()
+    options = Namespace(engine='buffer', **vars(options))
+    defines = pepe.preprocess(input_file, output_file, dict(defines), options,
+                              content_types_db)
+    return output_file.getvalue(), defines
+
+
+def run(f, *args):
+    try:
+        return f(*args)
+    except pepe.PreprocessorError, ex:
+        return "error: %s" % ex
+
+
+class IncrementalPreprocessorTestCase(unittest.TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.content_types_db = pepe.ContentTypesDatabase(
+            pepe.DEFAULT_CONTENT_TYPES_FILE)
+
+    def check_updates(self, texts, defines, options):
+        p = pepe.IncrementalPreprocessor("foo.py", defines, options,
+                                         self.content_types_db)
+        for text in texts:
+            expected = run(preprocess_text, text, defines, options,
+                           self.content_types_db)
+            if isinstance(expected, tuple):
+                output = run(p.update, text)
+                self.assertEqual((output, p.defines), expected,
+                                 "after update(%r)" % text)
+            else:
+                self.assertEqual(run(p.update, text), expected,
+                                 "after update(%r)" % text)
+
+    def test_extending_last_statement_line(self):
+        options = Namespace(default_content_type=None, include_paths=[],
+                            should_keep_lines=False, should_substitute=True)
+        self.check_updates(["# #define FOO 2", "# #define FOO 21\nFOO"],
+                           {}, options)
+        self.check_updates(["a\n# #define A 1", "a\n# #define A 1x"],
+                           {}, options)
+
+    def test_random_edits(self):
+        r = random.Random(16)
+        for i in range(300):
+            options = Namespace(default_content_type=None, include_paths=[],
+                                should_keep_lines=r.random() < 0.5,
+                                should_substitute=r.random() < 0.5)
+            defines = {'A': r.choice([0, 1])}
+            texts = [generate_text(r)]
+            for j in range(6):
+                texts.append(edit_text(r, texts[-1]))
+            self.check_updates(texts, defines, options)
+
+
+def suite():
+    """Return a unittest.TestSuite to be used by test.py."""
+    return unittest.makeSuite(IncrementalPreprocessorTestCase)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(suite())
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Tests the temporary output buffer of preprocess()."""
+
+import os
+import sys
+import unittest
+from argparse import Namespace
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pepe
+
+
+ENGINES = ['line', 'buffer', 'template', 'compiled']
+
+TEXT = u"h\xe9llo\n# #if 1\nA €\n# #endif\n" * 3
+
+EXPECTED = u"h\xe9llo\n1 €\n" * 3
+
+
+class OutputSpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.content_types_db = pepe.ContentTypesDatabase(
+            pepe.DEFAULT_CONTENT_TYPES_FILE)
+        self.spool_size = pepe.OUTPUT_SPOOL_SIZE
+        self.chunk_size = pepe.OUTPUT_SPOOL_CHUNK_SIZE
+
+    def tearDown(self):
+        pepe.OUTPUT_SPOOL_SIZE = self.spool_size
+        pepe.OUTPUT_SPOOL_CHUNK_SIZE = self.chunk_size
+
+    def preprocess(self, text, engine):
+        input_file = StringIO(text)
+        input_file.name = "foo.py"
+        output_file = StringIO()
+        options = Namespace(default_content_type=None, include_paths=[],
+                            should_keep_lines=False, should_substitute=True,
+                            engine=engine)
+        pepe.preprocess(input_file, output_file, {'A': 1}, options,
+                        self.content_types_db)
+        return output_file.getvalue()
+
+    def test_unicode_in_memory(self):
+        for engine in ENGINES:
+            self.assertEqual(self.preprocess(TEXT, engine), EXPECTED, engine)
+
+    def test_unicode_on_disk(self):
+        pepe.OUTPUT_SPOOL_SIZE = 5
+        # Splits the UTF-8 encoding of characters between chunks.
+        pepe.OUTPUT_SPOOL_CHUNK_SIZE = 1
+        for engine in ENGINES:
+            self.assertEqual(self.preprocess(TEXT, engine), EXPECTED, engine)
+
+    def test_bytes_on_disk(self):
+        pepe.OUTPUT_SPOOL_SIZE = 5
+        text = TEXT.encode("utf-8")
+        for engine in ENGINES:
+            output = self.preprocess(text, engine)
+            self.assertEqual(type(output), str, engine)
+            self.assertEqual(output, EXPECTED.encode("utf-8"), engine)
+
+
+def suite():
+    """Return a unittest.TestSuite to be used by test.py."""
+    return unittest.makeSuite(OutputSpoolTestCase)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(suite())
+    sys.exit(not result.wasSuccessful())
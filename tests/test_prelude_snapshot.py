@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Tests prelude snapshots (--prelude and --prelude-snapshot)."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from argparse import Namespace
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pepe
+
+
+class PreludeSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.content_types_db = pepe.ContentTypesDatabase(
+            pepe.DEFAULT_CONTENT_TYPES_FILE)
+        self.prelude = self.write_file("prelude.py", "# #define A 1\n")
+        self.snapshot = os.path.join(self.directory, "prelude.snapshot")
+        self.main = self.write_file("main.py",
+                                    '# #include "prelude.py"\nA\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, text, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def preprocess(self):
+        options = Namespace(default_content_type=None,
+                            include_paths=[self.directory],
+                            should_keep_lines=False, should_substitute=True,
+                            prelude=self.prelude,
+                            prelude_snapshot=self.snapshot)
+        output = StringIO()
+        with open(self.main, 'rb') as input_file:
+            pepe.preprocess(input_file, output, {}, options,
+                            self.content_types_db)
+        return output.getvalue()
+
+    def test_unchanged_prelude(self):
+        self.assertEqual(self.preprocess(), "1\n")
+        os.utime(self.snapshot, (0, 0))
+        self.assertEqual(self.preprocess(), "1\n")
+        # The snapshot was used rather than written again.
+        self.assertEqual(os.stat(self.snapshot).st_mtime, 0)
+
+    def test_changed_prelude(self):
+        self.assertEqual(self.preprocess(), "1\n")
+        self.assertEqual(self.preprocess(), "1\n")
+        self.write_file("prelude.py", "# #define A 2\n", mtime=0)
+        self.assertEqual(pepe.load_prelude_snapshot(self.snapshot), None)
+        self.assertEqual(self.preprocess(), "2\n")
+        self.assertNotEqual(pepe.load_prelude_snapshot(self.snapshot), None)
+
+    def test_removed_snapshot(self):
+        self.assertEqual(self.preprocess(), "1\n")
+        self.assertNotEqual(pepe.load_prelude_snapshot(self.snapshot), None)
+        os.remove(self.snapshot)
+        self.assertEqual(pepe.load_prelude_snapshot(self.snapshot), None)
+        self.assertEqual(self.preprocess(), "1\n")
+
+
+def suite():
+    """Return a unittest.TestSuite to be used by test.py."""
+    return unittest.makeSuite(PreludeSnapshotTestCase)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(suite())
+    sys.exit(not result.wasSuccessful())